@@ -7,14 +7,21 @@ Python wrapper for 'BeamOptikDLL.dll'.
 # therefore be simply included in another application without having to
 # install or provide anything else (except for the actual DLL of course).
 
-from collections import namedtuple
+from bisect import bisect_left
+from collections import namedtuple, Counter
 from ctypes import c_double as Double, c_int as Int, POINTER
 import ctypes
 import logging
 import platform
+import threading
+import time
 
 is_64bit = platform.architecture()[0] == '64bit'
 
+log = logging.getLogger(__name__)
+
+_clock = getattr(time, 'perf_counter', time.time)     # py2: time.time
+
 try:
     basestring
 except NameError:
@@ -78,6 +85,10 @@ ExecOptions = make_enum('ExecOptions', ['CalcAll', 'CalcDif', 'SimplyStore'])
 GetSDOptions = make_enum('GetSDOptions', ['Current', 'Database', 'Test'])
 
 
+class ParameterNotFound(RuntimeError):
+    """Raised if a parameter is not in the internal DVM list."""
+
+
 class BeamOptikDLL(object):
 
     """
@@ -95,13 +106,15 @@ class BeamOptikDLL(object):
 
     filename = 'BeamOptikDLL64.dll' if is_64bit else 'BeamOptikDLL.dll'
 
-    def __init__(self, lib=filename, variant='HIT'):
+    def __init__(self, lib=filename, variant='HIT', stats_interval=None):
         """
         Load library and initialize member variables.
 
         :param str lib: filename or DLL proxy object
         :param str variant: 'HIT' or 'MIT', decides whether the `_RKA` set of
                             functions will be used internally
+        :param float stats_interval: if given, log the call statistics every
+                                     ``stats_interval`` seconds
         """
         if isinstance(lib, basestring):
             lib = ctypes.windll.LoadLibrary(lib)
@@ -109,6 +122,9 @@ class BeamOptikDLL(object):
         self._funcs = _load_functions(lib)
         self._iid = None
         self._variant = variant
+        self.stats = CallStats(self.error_messages)
+        self.stats_interval = stats_interval
+        self._last_dump = _clock()
 
     def __bool__(self):
         """Check if the object belongs to an initialized interface instance."""
@@ -294,7 +310,7 @@ class BeamOptikDLL(object):
         :raises RuntimeError: if the exit code indicates any error
         """
         value = Double()
-        func = ('GetLastFloatValueSD' if self.variant == 'HIT' else
+        func = ('GetLastFloatValueSD' if self._variant == 'HIT' else
                 'GetLastFloatValueSD_RKA')
         self._call(func, self.iid, Str(name),
                    value, Int(vaccnum), Int(options),
@@ -346,6 +362,16 @@ class BeamOptikDLL(object):
             self._call('GetMEFIValue_RKA', self.iid, *values)
             return (EFI(*[v.value for v in values]), None)
 
+    def get_stats(self):
+        """
+        Return the call statistics, see :meth:`CallStats.snapshot`.
+        """
+        return self.stats.snapshot()
+
+    def dump_stats(self, level=logging.INFO):
+        """Log a summary of the call statistics."""
+        log.log(level, 'BeamOptikDLL call statistics:\n%s', self.stats)
+
     # internal methods
 
     def _call(self, function, *params):
@@ -364,10 +390,17 @@ class BeamOptikDLL(object):
             params.insert(6, done)
         else:
             params.append(done)
-        if function != 'GetFloatValueSD':
-            logging.debug('{}{}'.format(function, tuple(params)))
+        if function != 'GetFloatValueSD' and log.isEnabledFor(logging.DEBUG):
+            log.debug('%s%s', function, tuple(params))
         func = self._funcs[function]
+        start = _clock()
         func(*params)
+        stop = _clock()
+        self.stats.record(function, stop - start, done.value)
+        if (self.stats_interval is not None and
+                stop - self._last_dump >= self.stats_interval):
+            self._last_dump = stop
+            self.dump_stats()
         self.check_return(done.value)
 
     @classmethod
@@ -376,14 +409,19 @@ class BeamOptikDLL(object):
         Check DLL-API exit code for errors and raise exception.
 
         :param int done: exit code of an DLL function
+        :raises ParameterNotFound: if the parameter does not exist
         :raises RuntimeError: if the exit code is a known error code != 0
         :raises ValueError: if the exit code is unknown
         """
+        if done == cls.PARAM_NOT_FOUND:
+            raise ParameterNotFound(cls.error_messages[done])
         if 0 < done and done < len(cls.error_messages):
             raise RuntimeError(cls.error_messages[done])
         elif done != 0:
             raise ValueError("Unknown error: %i" % done)
 
+    PARAM_NOT_FOUND = 2
+
     error_messages = [
         None,
         "Invalid Interface ID.",
@@ -398,6 +436,93 @@ class BeamOptikDLL(object):
         "Invalid offset for ramp function."]
 
 
+class CallStats(object):
+
+    """
+    Call counts, latency histograms and error counters of DLL functions.
+
+    Latencies are sorted into logarithmic bins with the upper bounds in
+    :attr:`bins` (in seconds), the last bin collects all slower calls.
+    Recording a call only involves a few additions.
+
+    :param list messages: error messages indexed by exit code
+    """
+
+    bins = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0)
+
+    def __init__(self, messages):
+        self.messages = messages
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # {function: [count, total time, max time, histogram]}
+            self._calls = {}
+            # {(function, exit code): count}
+            self._errors = Counter()
+
+    def record(self, function, elapsed, done):
+        """Record a call of ``function`` that took ``elapsed`` seconds."""
+        index = bisect_left(self.bins, elapsed)
+        with self._lock:
+            entry = self._calls.get(function)
+            if entry is None:
+                entry = self._calls[function] = [
+                    0, 0.0, 0.0, [0] * (len(self.bins) + 1)]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            entry[3][index] += 1
+            if done:
+                self._errors[function, done] += 1
+
+    def message(self, done):
+        if 0 < done < len(self.messages):
+            return self.messages[done]
+        return "Unknown error: %i" % done
+
+    def snapshot(self):
+        """
+        Return the statistics as dict with the keys:
+
+        - ``calls``: ``{function: {count, total, mean, max, histogram}}``,
+          where histogram is a list of ``(upper bound, count)``
+        - ``errors``: ``{function: {message: count}}``
+        """
+        with self._lock:
+            calls = {
+                function: {
+                    'count': count,
+                    'total': total,
+                    'mean': total / count,
+                    'max': max_time,
+                    'histogram': list(zip(self.bins + (float('inf'),),
+                                          histogram)),
+                }
+                for function, (count, total, max_time, histogram)
+                in self._calls.items()
+            }
+            errors = {}
+            for (function, done), count in self._errors.items():
+                errors.setdefault(function, {})[self.message(done)] = count
+        return {'calls': calls, 'errors': errors}
+
+    def __str__(self):
+        stats = self.snapshot()
+        lines = ['{:<24} {:>8} {:>10} {:>10} {:>10}'.format(
+            'function', 'calls', 'total [s]', 'mean [ms]', 'max [ms]')]
+        for function, call in sorted(stats['calls'].items()):
+            lines.append('{:<24} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                function, call['count'], call['total'],
+                call['mean'] * 1e3, call['max'] * 1e3))
+        for function, errors in sorted(stats['errors'].items()):
+            for message, count in sorted(errors.items()):
+                lines.append('{:<24} {:>8} x {}'.format(
+                    function, count, message))
+        return '\n'.join(lines)
+
+
 def _load_functions(lib):
     """Load the function pointers for all exported functions and
     initialize their argtypes. Return as dict ``{name: function}``."""
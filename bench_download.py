@@ -0,0 +1,121 @@
+# encoding: utf-8
+"""
+Benchmark for the parameter download against the mock DLL.
+
+Downloads the parameters in ``params.txt`` for a grid of MEFI settings into
+a temporary folder and reports the throughput in parameters written per
+second, together with the number of DLL reads. The GUI worker is run in a
+background thread just like when started from the dialog (without showing
+the window), the headless downloader directly. The GUI is skipped if Qt is
+not available. A plain loop over ``BeamOptikDLL.GetFloatValue`` serves as
+reference.
+
+Usage:
+
+    bench_download.py [NUM_ENERGIES] [LATENCY_MS]
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import itertools
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import download_settings
+from download_settings import Downloader, MEFI, read_params
+from beamoptikdll import BeamOptikDLL
+from mock_beamoptikdll import MockBeamOptikDLL
+
+
+def plain_loop(dll, params, mefis):
+    """Read all parameters for all settings without writing anything."""
+    for mefi in itertools.product(*mefis):
+        if mefi[0] != dll.GetSelectedVAcc():
+            dll.SelectVAcc(mefi[0])
+        dll.SelectMEFI(*mefi)
+        for param in params:
+            try:
+                dll.GetFloatValue(param)
+            except RuntimeError:
+                pass
+
+
+def gui_worker(window, params, mefis, adaptive):
+    """Run the download thread of the dialog and wait for it to finish."""
+    from download_gui import QtGui
+    window.running = True
+    worker = threading.Thread(
+        target=window.downloader.download,
+        args=(params, mefis, True, adaptive))
+    worker.start()
+    while worker.is_alive():
+        QtGui.QApplication.processEvents()
+        worker.join(0.01)
+    QtGui.QApplication.processEvents()
+    window.ctrl_log.clear()
+
+
+def run(name, func, lib, num_values):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print("{:>18}: {:8.2f} s, {:8.0f} params/s, {:6} DLL reads".format(
+        name, elapsed, num_values / elapsed, lib.calls['GetFloatValue']))
+
+
+def main(num_energies=10, latency_ms=1.0):
+    num_energies = int(num_energies)
+    latency = float(latency_ms) / 1000
+    folder = tempfile.mkdtemp()
+    download_settings.AVAILABILITY_FILE = os.path.join(folder, 'avail.json')
+    try:
+        params = read_params(download_settings.PARAM_FILE)
+        mefis = MEFI([1], list(range(1, num_energies+1)), [1, 2], [1], [0])
+        num_values = len(params) * num_energies * 2
+        print("{} params x {} settings, {} ms latency per call".format(
+            len(params), num_energies * 2, latency_ms))
+
+        def connect():
+            lib = MockBeamOptikDLL(latency=latency)
+            dll = BeamOptikDLL(lib)
+            dll.GetInterfaceInstance()
+            dll.SelectVAcc(1)
+            return lib, dll
+
+        lib, dll = connect()
+        run('plain loop', lambda: plain_loop(dll, params, mefis),
+            lib, num_values)
+        try:
+            from download_gui import MainWindow, QtGui
+        except ImportError as e:
+            print("Skipping the GUI: {}".format(e))
+        else:
+            app = QtGui.QApplication(sys.argv)
+            window = MainWindow()
+            window.downloader.folder = os.path.join(folder, 'params')
+            for adaptive in (False, True):
+                lib, window.downloader.dll = connect()
+                run('gui' + ' adaptive' * adaptive,
+                    lambda: gui_worker(window, params, mefis, adaptive),
+                    lib, num_values)
+            del app
+        for adaptive in (False, True):
+            lib, dll = connect()
+            downloader = Downloader(dll, log=lambda text: None,
+                                    folder=os.path.join(folder, 'params'))
+            run('headless' + ' adaptive' * adaptive,
+                lambda: downloader.download(params, mefis, True, adaptive),
+                lib, num_values)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
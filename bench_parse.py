@@ -0,0 +1,98 @@
+# encoding: utf-8
+"""
+Micro-benchmark for reading the summary of device exports.
+
+Generates synthetic exports with large raw measurement blocks (with LF and
+CRLF line endings) in a temporary folder and compares the header reader in
+``device_export`` with naive line-by-line parsing of the whole file. Also
+measures the computation of the beam widths from the raw profiles for all
+files at once.
+
+Usage:
+
+    bench_parse.py [NUM_FILES] [NUM_RAW_LINES]
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+
+from device_export import parse_device_export
+from profiles import profile_widths, parse_columns
+
+
+# layout of the raw rows written by write_export:
+COLUMNS = parse_columns('1,2,3,4')
+
+HEADER = [
+    '<HEADER>',
+    'Gerät;H1DG1G',
+    'VAcc ID;5',
+    'Mefi;E1 F4 I1 G0',
+    'Integrationszeit [s];0.5',
+    '</HEADER>',
+    '<CUSTOM>',
+    'Schwerpunkt X;0.1',
+    'Schwerpunkt Y;-0.2',
+    'FWHM X;4.5',
+    'FWHM Y;3.5',
+    '</CUSTOM>',
+]
+
+
+def write_export(filename, num_raw_lines, newline):
+    lines = [line.encode('latin1') for line in HEADER]
+    lines += [
+        '{};{:.3f};{:.3f};{:.3f};{:.3f}'.format(
+            i, i*0.5, i % 97, i*0.5, i % 89).encode('latin1')
+        for i in range(num_raw_lines)
+    ]
+    with open(filename, 'wb') as f:
+        f.write(newline.join(lines) + newline)
+
+
+def parse_naive(filename):
+    """Decode and split every line of the file."""
+    data = {}
+    with open(filename, 'rb') as f:
+        for line in f:
+            parts = line.decode('latin1').split(';')
+            if len(parts) == 2:
+                data[parts[0].strip()] = parts[1].strip()
+    return data
+
+
+def main(num_files=200, num_raw_lines=20000):
+    num_files = int(num_files)
+    num_raw_lines = int(num_raw_lines)
+    folder = tempfile.mkdtemp()
+    try:
+        files = [os.path.join(folder, 'export{}.csv'.format(i))
+                 for i in range(num_files)]
+        for i, filename in enumerate(files):
+            write_export(filename, num_raw_lines, (b'\n', b'\r\n')[i % 2])
+        for name, func in [('naive', parse_naive),
+                           ('header', parse_device_export)]:
+            best = min(timeit.repeat(
+                lambda: [func(filename) for filename in files],
+                number=1, repeat=3))
+            print("{:>8}: {:8.2f} ms total, {:8.1f} µs/file".format(
+                name, best*1e3, best/num_files*1e6))
+        for method in ('rms', 'gauss'):
+            best = min(timeit.repeat(
+                lambda: profile_widths(files, COLUMNS, method),
+                number=1, repeat=3))
+            print("{:>8}: {:8.2f} ms total, {:8.1f} µs/file".format(
+                method, best*1e3, best/num_files*1e6))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
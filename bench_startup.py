@@ -0,0 +1,96 @@
+# encoding: utf-8
+"""
+Startup time of the ``emit.py`` commands.
+
+Every command is run several times in a fresh interpreter. The fastest run
+is compared against the time budget of the command, and the heavy modules
+(cpymad, matplotlib, Qt) loaded by the command are listed. ``parse`` and
+``extract`` do actual work on a temporary empty folder and the DVM
+parameter export, the other commands only show their help.
+
+Usage:
+
+    bench_startup.py [NUM_RUNS]
+
+Exits with status 1 if any command exceeds its budget.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+
+HEAVY_MODULES = ('cpymad', 'matplotlib', 'PyQt4', 'PyQt5')
+
+# maximum startup time per command in seconds:
+BUDGETS = {
+    'parse': 0.2,
+    'extract': 0.2,
+    'download': 0.3,
+    'calc': 0.5,
+    'plot': 0.5,
+}
+
+# runs emit.main() and reports the heavy modules on the last stderr line:
+SCRIPT = '''
+import sys, emit
+try:
+    emit.main(sys.argv[1:])
+except SystemExit:
+    pass
+sys.stderr.write("\\n" + ",".join(
+    m for m in {modules!r} if m in sys.modules) + "\\n")
+'''.format(modules=HEAVY_MODULES)
+
+
+def run(args):
+    """Run a command, returns ``(seconds, heavy modules)``."""
+    folder = os.path.dirname(os.path.abspath(__file__))
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        proc = subprocess.Popen(
+            [sys.executable, '-c', SCRIPT] + args, cwd=folder,
+            stdout=devnull, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        elapsed = time.time() - start
+    return elapsed, err.decode('utf-8').rstrip('\n').rsplit('\n', 1)[-1]
+
+
+def main(num_runs=5):
+    num_runs = int(num_runs)
+    folder = tempfile.mkdtemp()
+    try:
+        commands = {
+            'parse': ['parse', folder,
+                      '--index', os.path.join(folder, 'index.sqlite')],
+            'extract': ['extract', 'DVM-Parameter_v2.10.0-HIT.csv'],
+            'download': ['download', '--help'],
+            'calc': ['calc', '--help'],
+            'plot': ['plot', '--help'],
+        }
+        baseline = min(run([])[0] for _ in range(num_runs))
+        print("{:>10}: {:6.0f} ms".format('(none)', baseline*1000))
+        failed = []
+        for name, args in sorted(commands.items()):
+            results = [run(args) for _ in range(num_runs)]
+            elapsed = min(t for t, _ in results)
+            heavy = results[-1][1]
+            ok = elapsed <= BUDGETS[name]
+            if not ok:
+                failed.append(name)
+            print("{:>10}: {:6.0f} ms (budget {:4.0f} ms) {:4} {}".format(
+                name, elapsed*1000, BUDGETS[name]*1000,
+                'ok' if ok else 'FAIL', heavy and 'loads ' + heavy or ''))
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
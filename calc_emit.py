@@ -6,6 +6,98 @@ Dreigitter-Prozedur.
 Usage:
 
     calc_emit.py <DATA_FOLDER> <MADX_MODEL_FILE> <MADX_SEQUENCE_NAME> <OUTPUT_FILE>
+                 [--fresh] [--jobs N] [--cache DIR] [--cache-size MB]
+                 [--bootstrap N] [--index FILE]
+                 [--watch [--interval SECONDS] [--monitors NAMES]]
+                 [--store FILE] [--widths METHOD [--profile-columns COLS]]
+                 [--strengths FILE]
+                 [--engine ENGINE] [--tolerance TOL] [--subsets FILE]
+                 [--surrogate STEP] [--checkpoint FILE] [--recompute]
+
+Options:
+
+    --fresh             start a new MAD-X instance for every MEFI setting
+                        instead of keeping the model loaded in a single
+                        session (slow, mainly useful to cross-check the
+                        session mode)
+    --jobs N            compute the sectormaps in N worker processes, each
+                        keeping its own MAD-X session
+    --cache DIR         keep computed sectormaps in a persistent cache folder
+                        and reuse them when model, strengths, monitors and
+                        TWISS arguments are unchanged. The model includes
+                        all files loaded with ``call, file=...``; files that
+                        are read otherwise (e.g. with names built by macros)
+                        are not tracked, use --recompute and a new cache
+                        folder after changing those
+    --cache-size MB     maximum size of the cache [default: 256]
+    --bootstrap N       also estimate the standard errors by resampling the
+                        individual shots N times. They are written as extra
+                        columns boot_dex, boot_dey, boot_dalfx, boot_dalfy,
+                        boot_dbetx and boot_dbety, the analytic errors are
+                        kept. NaN for settings with
+                        fewer than two shots for any monitor.
+    --index FILE        index of the parsed device exports, only new or
+                        changed files are parsed [default: a file per
+                        DATA_FOLDER in ~/.cache/calc_emit, or
+                        $XDG_CACHE_HOME/calc_emit]
+    --watch             keep running and evaluate every MEFI setting as soon
+                        as exports for all monitors and the strength file
+                        exist; the output file is updated in place
+    --interval SECONDS  polling interval for --watch [default: 10]
+    --monitors NAMES    comma separated list of required monitors for
+                        --watch [default: all monitors seen so far]
+    --store FILE        binary results store (full precision, including fit
+                        diagnostics), new settings are added to an existing
+                        store [default: <OUTPUT_FILE> with extension .npy].
+                        If OUTPUT_FILE has the extension .npy, no text
+                        output is written.
+    --widths METHOD     'fwhm' to convert the FWHM from the export summary to
+                        RMS assuming gaussian beams, 'rms' to compute the
+                        background subtracted RMS widths from the raw
+                        profiles, 'gauss' to fit gaussians to the raw
+                        profiles [default: fwhm]
+    --profile-columns COLS
+                        comma separated (zero based) column numbers of the
+                        wire position and amplitude in x and y in the raw
+                        profiles, e.g. 1,2,3,4 for rows of the form
+                        'wire;pos x;amp x;pos y;amp y'. Required for
+                        --widths=rms and --widths=gauss. Exports whose
+                        profiles can not be read or fitted are skipped.
+    --strengths FILE    read the magnet strengths from a consolidated
+                        strength store (see strength_store.py) instead of
+                        the files in params/. The values are passed to
+                        MAD-X in a single input per setting.
+    --engine ENGINE     'madx' to compute the sectormaps with MAD-X, 'numpy'
+                        to compute them for all settings at once with the
+                        linear optics engine (see linear_optics.py), 'auto'
+                        to use the numpy engine only if it supports the
+                        model and agrees with MAD-X for a few settings
+                        [default: madx]
+    --tolerance TOL     maximum deviation from MAD-X for --engine=auto
+                        [default: 1e-6]
+    --subsets FILE      write the best monitor subset (ranked by condition
+                        number and chi² of all subsets of at least three
+                        monitors) and the leave-one-out stability of the
+                        emittances per setting to this file. The values are
+                        always included in the results store.
+    --surrogate STEP    quick-look mode: compute the sectormaps only for
+                        every STEP-th (STEP >= 2) energy channel of each
+                        VAcc/focus/intensity/gantry combination and
+                        interpolate the others (see surrogate.py). Provisional results are
+                        written right away to <OUTPUT_FILE> with the
+                        extension .provisional.txt (not to the results
+                        store), then the remaining sectormaps are computed
+                        and the exact results are written as usual. The
+                        provisional file is removed at the end of the run.
+                        Not supported with --watch.
+    --checkpoint FILE   every evaluated setting is committed to this file
+                        together with the fingerprint of its inputs (data,
+                        strengths, model and options). A rerun only
+                        evaluates settings whose inputs changed or that
+                        failed before. Failing settings are recorded with
+                        their error instead of aborting the run [default:
+                        <OUTPUT_FILE> with extension .checkpoint.sqlite]
+    --recompute         evaluate all settings, ignoring the checkpoints
 """
 
 from __future__ import unicode_literals
@@ -15,15 +107,28 @@ from __future__ import print_function
 
 import os
 import sys
-from math import sqrt, log
+import json
+import time
+import numbers
+import signal
+import hashlib
+import tempfile
+import warnings
+import argparse
+import multiprocessing
 
 import numpy as np
 
-# need cpymad installed:
-from cpymad.madx import Madx
-
 # imported from this folder:
-from emit_math import calc_emit
+from emit_math import calc_emit_batch, bootstrap_emit, rank_monitor_subsets
+from sectormap_cache import SectormapCache, file_digest, model_digest
+from export_index import ExportIndex, default_index
+from results_store import append_results, replace_file, VALUE_FIELDS
+from profiles import parse_columns
+from strength_store import read_strengths, load_store
+from surrogate import surrogate_sectormaps
+from checkpoints import Checkpoints
+from linear_optics import LinearOptics, UnsupportedModel, max_deviation
 
 
 def makedirs(path):
@@ -35,13 +140,31 @@ def makedirs(path):
 
 
 def init_madx(files):
-    """Start MAD-X instance and initialize with the given files."""
+    """
+    Start MAD-X instance and initialize with the given files. Instead of a
+    filename, a list of ``(name, value)`` assignments can be given.
+    """
+    # need cpymad installed, imported here to keep the startup fast for
+    # tasks that do not need MAD-X:
+    from cpymad.madx import Madx
     madx = Madx(stdout=False)
     for f in files:
-        madx.call(f, chdir=True)
+        if isinstance(f, (list, tuple)):
+            madx.input(format_assignments(f))
+        else:
+            madx.call(f, chdir=True)
     return madx
 
 
+def format_assignments(assignments):
+    """Format ``(name, value)`` pairs as MAD-X input."""
+    return '\n'.join(
+        '{} = {!r};'.format(name, float(value))
+        if isinstance(value, numbers.Number) else
+        '{} := {};'.format(name, value)
+        for name, value in assignments)
+
+
 def get_sectormaps(twiss, elems, files):
     """
     Start MAD-X instance and compute sectormaps between the elements.
@@ -49,101 +172,1048 @@ def get_sectormaps(twiss, elems, files):
     :param dict twiss: arguments for TWISS, must include ``sequence``
     :param list elems: monitor names, must be sorted according to
                        occurence in the sequence!
-    :param list files: initialization files for MAD-X
+    :param list files: initialization files for MAD-X, see :func:`init_madx`
     :returns:          the sectormaps between the individual monitors
     """
     return init_madx(files).sectormap(elems, **twiss)
 
 
-def parse_device_export(filename):
-    """
-    Parse beam position and FWHM from pseudo .CSV file generated by the
-    "Laufender export" functionality in the control system.
-    """
-    data = {}
-    with open(filename, 'rb') as f:
-        for line in f:
-            parts = line.decode('latin1').split(';')
-            if len(parts) == 2:
-                data[parts[0].strip()] = parts[1].strip()
-            # we only need the summary from the <HEADER/> and <CUSTOM/>
-            # blocks - and can ignore the raw measurements that follow:
-            if line == b'</CUSTOM>\n':
-                break
-    mefi = data['Mefi'].split()
-    assert mefi[0][0] == 'E'
-    assert mefi[1][0] == 'F'
-    assert mefi[2][0] == 'I'
-    assert mefi[3][0] == 'G'
-    fwhm_to_rms = 2*sqrt(2*log(2))
+# Written to the strength files by download_settings.py, but only labels the
+# intensity channel and does not enter the optics:
+NON_OPTICS_VARIABLES = ('intensity_value',)
+
+
+# TWISS arguments that would lead to a non-zero orbit, which is not
+# supported by the numpy engine:
+ORBIT_ARGUMENTS = ('x', 'px', 'y', 'py', 't', 'pt', 'deltap')
+
+# Maximum deviation of the numpy engine from MAD-X (see
+# linear_optics.max_deviation) to use it with --engine=auto:
+DEFAULT_TOLERANCE = 1e-6
+
+# Number of settings compared with MAD-X with --engine=auto:
+NUM_VALIDATE = 3
+
+
+def strengths_fingerprint(source, ignore=NON_OPTICS_VARIABLES):
+    """
+    Return a hash of the normalized assignments in the strength file (or
+    list of ``(name, value)`` pairs).
+
+    Files with the same fingerprint result in the same optics, even if they
+    differ in formatting, order of assignments or the ignored variables.
+    """
+    assignments = {}
+    for name, value in strength_assignments(source):
+        name = name.lower()             # MAD-X is case insensitive
+        try:
+            value = repr(float(value))
+        except ValueError:
+            value = ''.join(value.lower().split())
+        assignments[name] = value       # last assignment wins
+    for name in ignore:
+        assignments.pop(name, None)
+    text = ';'.join('{}={}'.format(*item) for item in sorted(assignments.items()))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def strength_assignments(source):
+    """
+    Return the ``(name, value)`` pairs of a strength file, or pass through
+    a list of assignments.
+    """
+    if isinstance(source, (list, tuple)):
+        return source
+    return read_strengths(source)
+
+
+def strength_source(mefi, store=None):
+    """
+    Return the strengths of a MEFI setting: the assignments from the
+    strength store if given, else the name of the strength file.
+    """
+    if store is None:
+        return strength_file(mefi)
+    return store.get(mefi)
+
+
+class Session(object):
+
+    """
+    MAD-X instance that keeps the model loaded across multiple MEFI settings.
+
+    Every strength file is applied on top of the model after the globals that
+    were overwritten by the previously applied file have been restored to
+    their original definition. This gives the same state as re-initializing
+    MAD-X with ``[madx_file, strengths]``, without re-parsing the model.
+    """
+
+    def __init__(self, madx_file):
+        self.madx = init_madx([madx_file])
+        self._overwritten = {}
+        self._optics = {}
+
+    def load_strengths(self, source):
+        """
+        Restore the model defaults and apply the given strength file, or
+        list of ``(name, value)`` pairs. In the latter case, restoring and
+        assigning is done with a single MAD-X input.
+        """
+        globals_ = self.madx.globals
+        assignments = strength_assignments(source)
+        previous = self._overwritten
+        # undefined variables evaluate to zero in MAD-X:
+        self._overwritten = {
+            name: previous[name] if name in previous else
+            globals_.defs[name] if name in globals_ else 0.0
+            for name, _ in assignments
+        }
+        restore = format_assignments([
+            (name, definition) for name, definition in previous.items()
+            if name not in self._overwritten])
+        if isinstance(source, (list, tuple)):
+            self.madx.input(restore + '\n' + format_assignments(assignments))
+        else:
+            if restore:
+                self.madx.input(restore)
+            self.madx.call(source, chdir=True)
+
+    def sectormaps(self, twiss, elems, strengths):
+        """
+        Compute sectormaps between the elements for the given strength file.
+        See :func:`get_sectormaps`.
+        """
+        self.load_strengths(strengths)
+        return self.madx.sectormap(elems, **twiss)
+
+    def linear_optics(self, seq_name):
+        """
+        Return the numpy optics engine for the sequence, see
+        :class:`linear_optics.LinearOptics`. The element list is extracted
+        only once.
+
+        :raises UnsupportedModel: if the sequence can not be handled
+        """
+        if seq_name not in self._optics:
+            optics = LinearOptics(self.madx, seq_name)
+            # the engine must see the model defaults, not the values of the
+            # currently loaded strengths:
+            optics.definitions.update(self._overwritten)
+            self._optics[seq_name] = optics
+        return self._optics[seq_name]
+
+
+# MAD-X session of the current worker process, see WorkerPool:
+_worker_session = None
+_worker_model = None
+
+
+def _init_worker(madx_file):
+    global _worker_session, _worker_model
+    # Ctrl-C is handled by the main process, see WorkerPool.terminate:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_model = madx_file
+    _worker_session = Session(madx_file)
+
+
+def _worker_sectormaps(args):
+    global _worker_session
+    if _worker_session is None:
+        _worker_session = Session(_worker_model)
+    try:
+        return _worker_session.sectormaps(*args)
+    except Exception:
+        # MAD-X may not be usable anymore after an error:
+        _worker_session = None
+        raise
+
+
+class WorkerPool(object):
+
+    """
+    Worker processes that each keep the MAD-X model loaded in a
+    :class:`Session`. A worker whose session failed starts a new one for
+    its next task, so the pool can be used for many calls of
+    :func:`compute_sectormaps`.
+
+    :param str madx_file: MAD-X model file
+    :param int jobs: number of worker processes
+    """
+
+    def __init__(self, madx_file, jobs):
+        self.pool = multiprocessing.Pool(jobs, _init_worker, (madx_file,))
+
+    def sectormaps(self, twiss, elems, strength_files):
+        """Compute the sectormaps for every strength file."""
+        # map() returns results in input order regardless of which worker
+        # finishes first:
+        return self.pool.map(_worker_sectormaps, [
+            (twiss, elems, strengths) for strengths in strength_files
+        ], chunksize=1)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        """Stop the workers without waiting for running tasks."""
+        self.pool.terminate()
+        self.pool.join()
+
+
+def compute_sectormaps(madx_file, twiss, elems, strength_files,
+                       session=None, fresh=False, jobs=1, cache=None,
+                       engine='madx', tolerance=DEFAULT_TOLERANCE,
+                       pool=None, stats=None):
+    """
+    Compute the sectormaps between the elements for every strength file.
+
+    :param str madx_file:       MAD-X model file
+    :param dict twiss:          arguments for TWISS, see :func:`get_sectormaps`
+    :param list elems:          monitor names, sorted by position
+    :param list strength_files: one strength file (or list of assignments)
+                                per MEFI setting
+    :param Session session:     session to use (serial mode only)
+    :param bool fresh:          new MAD-X instance for every setting
+    :param int jobs:            number of worker processes
+    :param SectormapCache cache: reuse and store results in this cache
+    :param str engine:          'madx', 'numpy' to use the numpy engine, or
+                                'auto' to use the numpy engine if it agrees
+                                with MAD-X within ``tolerance``
+    :param float tolerance:     see :func:`numpy_sectormaps`
+    :param WorkerPool pool:     pool to use if ``jobs > 1``, instead of
+                                starting a new one for this call
+    :param dict stats:          if given, receives the number of sectormaps
+                                taken from the cache ('cached') and computed
+                                ('computed'), and the engine that computed
+                                them ('engine')
+    :returns: list of sectormaps, in the same order as ``strength_files``
+    """
+    if stats is None:
+        stats = {}
+    if cache is None:
+        results, stats['engine'] = _compute_sectormaps(
+            madx_file, twiss, elems, strength_files, session, fresh, jobs,
+            engine, tolerance, pool)
+        stats.update(cached=0, computed=len(strength_files))
+        return results
+    model = model_digest(madx_file)
+    # results of the numpy engine are kept apart from the MAD-X results:
+    extra = [] if engine == 'madx' else ['numpy', tolerance]
+    keys = [cache.key(model, strengths_digest(strengths), elems, twiss,
+                      *extra)
+            for strengths in strength_files]
+    results = [cache.load(key) for key in keys]
+    missing = [i for i, res in enumerate(results) if res is None]
+    computed, stats['engine'] = _compute_sectormaps(
+        madx_file, twiss, elems, [strength_files[i] for i in missing],
+        session, fresh, jobs, engine, tolerance, pool)
+    stats.update(cached=len(results) - len(missing), computed=len(missing))
+    for i, sectormaps in zip(missing, computed):
+        cache.store(keys[i], sectormaps)
+        results[i] = sectormaps
+    return results
+
+
+def strengths_digest(source):
+    """Return the content hash of a strength file, or the assignments."""
+    if isinstance(source, (list, tuple)):
+        return [[name, value] for name, value in source]
+    return file_digest(source)
+
+
+def _compute_sectormaps(madx_file, twiss, elems, strength_files,
+                        session, fresh, jobs, engine='madx',
+                        tolerance=DEFAULT_TOLERANCE, pool=None):
+    """Return the sectormaps and the engine that computed them."""
+    if not strength_files:
+        return [], None
+    if engine != 'madx':
+        session = session or Session(madx_file)
+        try:
+            return numpy_sectormaps(
+                session, twiss, elems, strength_files,
+                tolerance if engine == 'auto' else None), 'numpy'
+        except UnsupportedModel as e:
+            if engine == 'numpy':
+                raise
+            print("Using MAD-X for the sectormaps: {}".format(e))
+    if fresh:
+        return [get_sectormaps(twiss, elems, [madx_file, strengths])
+                for strengths in strength_files], 'madx'
+    if jobs <= 1:
+        session = session or Session(madx_file)
+        return [session.sectormaps(twiss, elems, strengths)
+                for strengths in strength_files], 'madx'
+    if pool is not None:
+        return pool.sectormaps(twiss, elems, strength_files), 'madx'
+    pool = WorkerPool(madx_file, jobs)
+    try:
+        return pool.sectormaps(twiss, elems, strength_files), 'madx'
+    finally:
+        pool.close()
+
+
+def numpy_sectormaps(session, twiss, elems, strength_files, tolerance=None):
+    """
+    Compute the sectormaps for all strength files in a single pass with the
+    numpy engine. MAD-X is used only to extract the element list.
+
+    :param float tolerance: if given, compare the results for a few
+                            settings with MAD-X first
+    :returns: array of shape (len(strength_files), len(elems), 7, 7)
+    :raises UnsupportedModel: if the engine can not be used, or the results
+                              deviate from MAD-X by more than ``tolerance``
+    """
+    if any(twiss.get(arg) for arg in ORBIT_ARGUMENTS):
+        raise UnsupportedModel("initial orbit is not supported")
+    optics = session.linear_optics(twiss['sequence'])
+    sectormaps = optics.sectormaps(
+        elems, [strength_assignments(s) for s in strength_files])
+    if not np.all(np.isfinite(sectormaps)):
+        raise UnsupportedModel("numpy engine gives non-finite sectormaps")
+    if tolerance is not None:
+        num = len(strength_files)
+        for i in sorted(set(np.linspace(0, num-1, NUM_VALIDATE).astype(int))):
+            reference = session.sectormaps(twiss, elems, strength_files[i])
+            deviation = max_deviation(sectormaps[i], reference)
+            # NaN must not pass the check:
+            if not deviation <= tolerance:
+                raise UnsupportedModel(
+                    "numpy engine deviates from MAD-X by {:.2g}"
+                    .format(deviation))
+    return sectormaps
+
+
+def select_engine(session, twiss, elems, strength_files,
+                  tolerance=DEFAULT_TOLERANCE):
+    """
+    Decide once for ``--engine=auto`` which engine to use for the given
+    settings, by comparing the numpy engine with MAD-X for a few of them,
+    see :func:`numpy_sectormaps`.
+
+    :returns: 'numpy' or 'madx'
+    """
+    num = len(strength_files)
+    sample = [strength_files[i] for i in
+              sorted(set(np.linspace(0, num-1, NUM_VALIDATE).astype(int)))]
+    try:
+        numpy_sectormaps(session, twiss, elems, sample, tolerance)
+    except UnsupportedModel as e:
+        print("Using MAD-X for the sectormaps: {}".format(e))
+        return 'madx'
+    return 'numpy'
+
+
+def strength_file(mefi):
+    """Return the name of the strength file for the given MEFI setting."""
+    basename = 'M{}-E{}-F{}-I{}-G{}'.format(*mefi)
+    return os.path.join('params', basename + '.str')
+
+
+RESULT_COLUMNS = ('ex', 'ey', 'pt', 'alfx', 'alfy', 'betx', 'bety',
+                  'dex', 'dey', 'dalfx', 'dalfy', 'dbetx', 'dbety')
+
+# Standard errors from --bootstrap, written in addition to RESULT_COLUMNS:
+BOOTSTRAP_COLUMNS = ('boot_dex', 'boot_dey', 'boot_dalfx', 'boot_dalfy',
+                     'boot_dbetx', 'boot_dbety')
+
+
+def load_records(data_folder, index=None, jobs=1, verbose=True,
+                 widths='fwhm', columns=None):
+    """
+    Read all valid measurements, parsing only new or changed files.
+    Reports the number of parsed files if ``verbose`` or if any were parsed.
+
+    :param str widths: 'fwhm' to use the envelopes from the FWHM summary,
+                       'rms' or 'gauss' to compute them from the raw profiles
+    :param dict columns: column layout of the raw profiles, required for
+                         'rms' and 'gauss', see :func:`profiles.parse_columns`
+
+    :returns: ``{mefi: {device: [records]}}``
+    """
+    index = ExportIndex(index or default_index(data_folder))
+    try:
+        num_parsed = index.update(data_folder, jobs)
+        skipped = index.skipped()
+        records = index.records()
+        if widths != 'fwhm':
+            if columns is None:
+                raise ValueError(
+                    "the column layout of the raw profiles is required")
+            profiles = index.widths(
+                data_folder, [data['path'] for data in records],
+                widths, columns, jobs)
+    finally:
+        index.close()
+    if verbose or num_parsed:
+        print("Parsed {} new or changed files, skipping {} files"
+              .format(num_parsed, len(skipped)))
+    if widths != 'fwhm':
+        failed = []
+        for data, (x, y, error) in zip(records, profiles):
+            data['envx'] = x
+            data['envy'] = y
+            if error:
+                failed.append((data['path'], error))
+        if failed:
+            print("Skipping {} exports without {} widths, e.g. {}: {}"
+                  .format(len(failed), widths, *failed[0]))
+        failed = set(path for path, _ in failed)
+        records = [data for data in records if data['path'] not in failed]
+    all_records = {}
+    for data in records:
+        all_records\
+            .setdefault(data['mefi'], {})\
+            .setdefault(data['device'], [])\
+            .append(data)
+    return all_records
+
+
+def sort_monitors(madx_file, seq_name, monitors, session=None, cache=None):
+    """
+    Sort the monitors according to their occurence in the sequence.
+
+    :returns: ``(elements, session)``, where session is ``None`` if the
+              order was found in the cache and no session was given.
+    """
+    elements = sorted(monitors)
+    if cache is not None:
+        order_key = cache.key(model_digest(madx_file), seq_name, elements)
+        order = cache.load(order_key)
+        if order is not None:
+            return [str(el) for el in order], session
+    session = session or Session(madx_file)
+    sequence = session.madx.sequences[seq_name]
+    elements = sorted(elements, key=sequence.elements.index)
+    if cache is not None:
+        cache.store(order_key, elements)
+    return elements, session
+
+
+def compute_unique_sectormaps(mefis, madx_file, twiss, elements,
+                              optics=None, strengths=None, **kwargs):
+    """
+    Compute the sectormaps for the given MEFI settings, but only once per
+    group of settings with the same optics. Keyword arguments are passed to
+    :func:`compute_sectormaps`.
+
+    :param dict optics: precomputed ``{mefi: strengths_fingerprint}``
+    :param StrengthStore strengths: use this store instead of the files
+    :returns: list of sectormaps in the same order as ``mefis``
+    """
+    if optics is None:
+        optics = {mefi: strengths_fingerprint(strength_source(mefi, strengths))
+                  for mefi in mefis}
+    groups = {}
+    for mefi in mefis:
+        groups.setdefault(optics[mefi], mefi)
+    unique = sorted(groups.values())
+    stats = {}
+    unique_sectormaps = dict(zip(unique, compute_sectormaps(
+        madx_file, twiss, elements,
+        [strength_source(m, strengths) for m in unique], stats=stats,
+        **kwargs)))
+    print("Computed {} sectormaps{} for {} settings ({} from the cache, {}"
+          " shared by settings with equal optics)".format(
+              stats['computed'], ENGINE_NAMES.get(stats['engine'], ''),
+              len(mefis), stats['cached'], len(mefis) - len(unique)))
+    return [unique_sectormaps[groups[optics[m]]] for m in mefis]
+
+
+# Used in the progress messages:
+ENGINE_NAMES = {'madx': ' with MAD-X', 'numpy': ' with the numpy engine'}
+
+
+def measured_envelopes(mefis, all_records, elements):
+    """
+    Collect the individual shots of the monitors for the given settings.
+
+    :returns: ``(shots, envelopes, errors)``, where ``shots`` has the shape
+              (n_settings, n_monitors, n_shots, 2), padded with NaN to the
+              same number of shots per monitor, and ``envelopes``,
+              ``errors`` are the mean and its standard error with shape
+              (n_settings, n_monitors, 2)
+    """
+    num_shots = max(len(all_records[mefi][el])
+                    for mefi in mefis for el in elements)
+    shots = np.full((len(mefis), len(elements), num_shots, 2), np.nan)
+    for i, mefi in enumerate(mefis):
+        for j, el in enumerate(elements):
+            items = all_records[mefi][el]
+            shots[i, j, :len(items)] = [
+                (item['envx'], item['envy']) for item in items]
+    envelopes = np.nanmean(shots, axis=2)
+    num = (~np.isnan(shots)).sum(axis=2)
+    with warnings.catch_warnings():
+        # no error estimate for single shots:
+        warnings.simplefilter('ignore', RuntimeWarning)
+        errors = np.nanstd(shots, axis=2, ddof=1) / np.sqrt(num)
+    return shots, envelopes, errors
+
+
+def evaluate(mefis, all_records, elements, all_sectormaps, bootstrap=0):
+    """
+    Calculate emittances and twiss parameters for the given settings.
+
+    :returns: ``{mefi: {column: value}}`` for the results and diagnostics
+              in :data:`results_store.VALUE_FIELDS`
+    """
+    shots, envelopes, errors = measured_envelopes(
+        mefis, all_records, elements)
+    results = calc_emit_batch(envelopes, all_sectormaps,
+                              calc_long=True, calc_4D=False,
+                              envelope_errors=errors)
+    if bootstrap:
+        errors_bs = bootstrap_emit(shots, all_sectormaps, bootstrap,
+                                   calc_long=True, calc_4D=False)
+    else:
+        errors_bs = {}
+    # kept apart from the analytic errors:
+    for key in BOOTSTRAP_COLUMNS:
+        results[key] = errors_bs.get(key[len('boot_'):],
+                                     np.full(len(mefis), np.nan))
+    results.update(monitor_subsets(elements, envelopes, all_sectormaps,
+                                   errors))
     return {
-        'device': data['Gerät'].lower(),
-        'mefi': (int(data['VAcc ID']),
-                 int(mefi[0][1:]),
-                 int(mefi[1][1:]),
-                 int(mefi[2][1:]),
-                 int(mefi[3][1:])),
-        'tint': float(data['Integrationszeit [s]']),
-        'posx': float(data['Schwerpunkt X']),
-        'posy': float(data['Schwerpunkt Y']),
-        'envx': float(data['FWHM X']) / 1000 / fwhm_to_rms,
-        'envy': float(data['FWHM Y']) / 1000 / fwhm_to_rms,
+        mefi: {key: results[key][i] for key in VALUE_FIELDS}
+        for i, mefi in enumerate(mefis)
     }
 
 
-def main(data_folder, madx_file, seq_name, output_file='results.txt'):
+# Relative change of the emittance when leaving out a single monitor above
+# which the result is reported as unstable:
+LOO_THRESHOLD = 0.1
 
-    # read all valid measurements:
-    all_records = {}
-    for dirpath, dirnames, filenames in os.walk(data_folder):
-        for filename in filenames:
-            data = parse_device_export(os.path.join(dirpath, filename))
-            if data['envx'] != -9999.0 and data['envy'] != -9999.0:
-                all_records\
-                    .setdefault(data['mefi'], {})\
-                    .setdefault(data['device'], [])\
-                    .append(data)
-
-    # average measurements for same mefi setting and device
-    averaged = {
-        mefi: {
-            device: {key: np.mean([item[key] for item in items])
-                     for key in ('posx', 'posy', 'envx', 'envy')}
-            for device, items in devices.items()
-        } for mefi, devices in all_records.items()
+
+def monitor_subsets(elements, envelopes, all_sectormaps, errors):
+    """
+    Rank all subsets of at least three monitors, see
+    :func:`emit_math.rank_monitor_subsets`.
+
+    :returns: dict of arrays with the fields 'cond' (condition number with
+              all monitors), 'subset' (comma separated names of the best
+              monitor subset), 'cond_subset', 'loo_ex' and 'loo_ey'
+    """
+    ranking = rank_monitor_subsets(envelopes, all_sectormaps,
+                                   calc_long=True, envelope_errors=errors)
+    best = ranking['best']
+    rows = np.arange(len(best))
+    full = len(ranking['subsets']) - 1
+    return {
+        'cond': ranking['cond'][:,full],
+        'cond_subset': np.where(best != -1, ranking['cond'][rows, best],
+                                np.nan),
+        'subset': [','.join(elements[j] for j in ranking['subsets'][i])
+                   if i != -1 else '' for i in best],
+        'loo_ex': ranking['loo_ex'],
+        'loo_ey': ranking['loo_ey'],
     }
 
+
+def print_warnings(rows, elements):
+    """
+    Print a summary of the fit diagnostics of the results ``{mefi: {column:
+    value}}``.
+    """
+    def count(condition):
+        return sum(1 for row in rows.values() if condition(row))
+    all_monitors = ','.join(elements)
+    messages = [
+        ("Warning: coupled lattice in {} settings",
+         count(lambda row: row['coupled'])),
+        ("Warning: dispersive lattice in {} settings",
+         count(lambda row: row['dispersive'])),
+        ("Warning: no monitor subset gives valid results in {} settings",
+         count(lambda row: not row['subset'])),
+        ("Note: a monitor subset is better conditioned than all monitors"
+         " in {} settings",
+         count(lambda row: row['subset'] not in ('', all_monitors))),
+        ("Warning: leaving out a single monitor changes the emittance by"
+         " more than {:.0%} in {{}} settings".format(LOO_THRESHOLD),
+         count(lambda row: np.fmax(row['loo_ex'], row['loo_ey']) >
+               LOO_THRESHOLD)),
+    ]
+    for message, num in messages:
+        if num:
+            print(message.format(num))
+
+
+def write_subsets(filename, rows):
+    """
+    Write the best monitor subset and the leave-one-out stability of the
+    results ``{mefi: {column: value}}`` as text file.
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    with os.fdopen(fd, 'wt') as f:
+        print("# vacc energy focus intensity gantry cond cond_subset"
+              " loo_ex loo_ey subset", file=f)
+        for mefi in sorted(rows):
+            row = rows[mefi]
+            M, E, F, I, G = mefi
+            chn = format_channel
+            print(chn(M, 2), chn(E, 3), chn(F, 2), chn(I, 2), chn(G, 3),
+                  *[format_float(row[key]) for key in (
+                      'cond', 'cond_subset', 'loo_ex', 'loo_ey')] +
+                  [row['subset'] or '-'], file=f)
+    replace_file(tmp, filename)
+
+
+def write_results(output_file, rows, bootstrap=False):
+    """
+    Write the results ``{mefi: {column: value}}`` as text file. The file is
+    replaced atomically, so readers never see a partially written file.
+
+    :param bool bootstrap: append the :data:`BOOTSTRAP_COLUMNS`
+    """
+    columns = RESULT_COLUMNS + (BOOTSTRAP_COLUMNS if bootstrap else ())
+    folder = os.path.dirname(os.path.abspath(output_file))
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    with os.fdopen(fd, 'wt') as f:
+        print("# vacc energy focus intensity gantry", *columns, file=f)
+        for mefi in sorted(rows):
+            twiss_init = [rows[mefi][key] for key in columns]
+
+            M, E, F, I, G = mefi
+            chn = format_channel
+
+            print(chn(M, 2), chn(E, 3), chn(F, 2), chn(I, 2), chn(G, 3),
+                  *map(format_float, twiss_init), file=f)
+    replace_file(tmp, output_file)
+
+
+def save_results(output_file, rows, store=None, subsets=None, remove=(),
+                 bootstrap=False):
+    """
+    Write the results as text file and add them to the binary results
+    store. If the output file has the extension ``.npy``, only the store is
+    written.
+
+    :param str store: results store file [default: output file with
+                      extension ``.npy``]
+    :param str subsets: also write the monitor subset report to this file
+    :param remove: MEFI settings whose old results are deleted from the
+                   store, see :func:`results_store.append_results`
+    :param bool bootstrap: include the bootstrap errors in the text file
+    """
+    base, ext = os.path.splitext(output_file)
+    if ext != '.npy':
+        write_results(output_file, rows, bootstrap)
+    if subsets is not None:
+        write_subsets(subsets, rows)
+    append_results(store or base + '.npy', rows, remove)
+
+
+def main(data_folder, madx_file, seq_name, output_file='results.txt',
+         fresh=False, jobs=1, cache=None, cache_size=256, bootstrap=0,
+         index=None, watch=False, interval=10, monitors=None, store=None,
+         widths='fwhm', strengths=None, engine='madx',
+         tolerance=DEFAULT_TOLERANCE, subsets=None, surrogate=None,
+         checkpoint=None, recompute=False, profile_columns=None):
+
+    if cache is not None:
+        cache = SectormapCache(cache, cache_size*1024*1024)
+
+    if watch:
+        return watch_folder(
+            data_folder, madx_file, seq_name, output_file,
+            interval=interval, monitors=monitors, fresh=fresh, jobs=jobs,
+            cache=cache, bootstrap=bootstrap, index=index, store=store,
+            widths=widths, profile_columns=profile_columns,
+            strengths=strengths, engine=engine, tolerance=tolerance,
+            subsets=subsets)
+
+    all_records = load_records(data_folder, index, jobs, widths=widths,
+                               columns=profile_columns)
+
     # get a sorted list of monitors
-    sequence = init_madx([madx_file]).sequences[seq_name]
-    elements = set(dev for devs in averaged.values() for dev in devs)
-    elements = sorted(elements, key=sequence.elements.index)
-    del sequence
+    elements, session = sort_monitors(
+        madx_file, seq_name,
+        set(dev for devs in all_records.values() for dev in devs),
+        cache=cache)
 
     # TODO: initialize beam with correct particle + energy (?)
     # NOTE: initial coordinates X=0:
     twiss = dict(sequence=seq_name, betx=1, bety=1)
 
-    f = open(output_file, 'wt', 1)
-    print("# vacc energy focus intensity gantry ex ey pt alfx alfy betx bety", file=f)
-    for mefi, devices in averaged.items():
-        basename = 'M{}-E{}-F{}-I{}-G{}'.format(*mefi)
+    mefis = sorted(all_records)
+    if strengths is not None:
+        strengths, mefis = load_strength_store(strengths, mefis)
+
+    checkpoints = Checkpoints(
+        checkpoint or os.path.splitext(output_file)[0] + CHECKPOINT_SUFFIX)
+    pool = None
+    try:
+        options = [model_digest(madx_file), twiss, widths,
+                   sorted((profile_columns or {}).items()), bootstrap,
+                   engine, tolerance]
+        fingerprints, optics = prepare_settings(
+            mefis, all_records, elements, strengths, options, checkpoints)
+        finished = {} if recompute else checkpoints.finished(
+            fingerprints, VALUE_FIELDS)
+        todo = [mefi for mefi in mefis
+                if mefi in fingerprints and mefi not in finished]
+        if finished:
+            print("Skipping {} unchanged settings".format(len(finished)))
+
+        # the session, worker pool and engine are set up only once, not
+        # for every chunk of evaluate_checkpointed:
+        sessions = [session]
+        exact = {}
+
+        if engine == 'auto' and todo:
+            sessions[0] = sessions[0] or Session(madx_file)
+            try:
+                engine = select_engine(
+                    sessions[0], twiss, elements,
+                    [strength_source(mefi, strengths) for mefi in todo],
+                    tolerance)
+            except Exception as e:
+                print("Using MAD-X for the sectormaps: {}".format(e))
+                sessions[0] = None
+                engine = 'madx'
+        if todo and jobs > 1 and not fresh and engine == 'madx':
+            pool = WorkerPool(madx_file, jobs)
+
+        def compute(mefis):
+            if sessions[0] is None and not fresh and (
+                    jobs <= 1 or engine != 'madx'):
+                sessions[0] = Session(madx_file)
+            missing = [mefi for mefi in mefis if mefi not in exact]
+            try:
+                exact.update(zip(missing, compute_unique_sectormaps(
+                    missing, madx_file, twiss, elements, optics=optics,
+                    strengths=strengths, session=sessions[0], fresh=fresh,
+                    jobs=jobs, cache=cache, engine=engine,
+                    tolerance=tolerance, pool=pool)))
+            except Exception:
+                # MAD-X may not be usable anymore after an error:
+                sessions[0] = None
+                raise
+            return [exact[mefi] for mefi in mefis]
+
+        if surrogate and todo:
+            try:
+                approx, _ = surrogate_sectormaps(todo, compute, surrogate)
+            except Exception as e:
+                print("Skipping the provisional results: {}".format(e))
+            else:
+                rows = dict(finished)
+                rows.update(evaluate(todo, all_records, elements, approx))
+                write_results(provisional_file(output_file), rows)
+                print("Wrote provisional results to {}, refining {} settings"
+                      .format(provisional_file(output_file),
+                              len(todo) - len(exact)))
 
-        strengths = os.path.join('params', basename + '.str')
-        sectormaps = get_sectormaps(twiss, elements, [madx_file, strengths])
-        measurements = [devices[el] for el in elements]
+        evaluate_checkpointed(
+            todo, optics, fingerprints, checkpoints,
+            lambda mefis: evaluate(mefis, all_records, elements,
+                                   compute(mefis), bootstrap))
 
-        results = calc_emit(measurements, sectormaps,
-                            calc_long=True, calc_4D=False)
+        rows = checkpoints.finished(fingerprints, VALUE_FIELDS)
+        errors = checkpoints.errors(mefis)
+    finally:
+        checkpoints.close()
+        if pool is not None:
+            pool.close()
 
-        twiss_init = (results['ex'], results['ey'], results['pt'],
-                      results['alfx'], results['alfy'],
-                      results['betx'], results['bety'])
+    print_warnings(rows, elements)
+    if errors:
+        print("Warning: {} settings failed:".format(len(errors)))
+        for mefi, error in sorted(errors.items()):
+            print("  M{}-E{}-F{}-I{}-G{}: {}".format(*(mefi + (error,))))
+    # settings of the data folder without valid results must not keep old
+    # results in the store:
+    save_results(output_file, rows, store, subsets,
+                 remove=set(all_records) - set(rows),
+                 bootstrap=bool(bootstrap))
+    # interpolated results must not outlive the exact ones:
+    if os.path.exists(provisional_file(output_file)):
+        os.remove(provisional_file(output_file))
 
-        M, E, F, I, G = mefi
-        chn = format_channel
 
-        print(chn(M, 2), chn(E, 3), chn(F, 2), chn(I, 2), chn(G, 3),
-              *map(format_float, twiss_init), file=f)
+def provisional_file(output_file):
+    """Return the name of the file for the results of --surrogate."""
+    return os.path.splitext(output_file)[0] + '.provisional.txt'
+
+
+# Appended to the output file name (without extension) for the default
+# checkpoint file:
+CHECKPOINT_SUFFIX = '.checkpoint.sqlite'
+
+# Number of settings that are evaluated and committed together:
+CHECKPOINT_CHUNK = 50
+
+
+def prepare_settings(mefis, all_records, elements, strengths, options,
+                     checkpoints):
+    """
+    Compute the input fingerprints of the settings. Settings that lack data
+    for one of the monitors, or whose strengths can not be read, are
+    recorded as failed in the checkpoints.
+
+    :param list options: everything else that affects the results
+    :returns: ``(fingerprints, optics)``, where ``optics`` maps the settings
+              to their strength fingerprints
+    """
+    fingerprints = {}
+    optics = {}
+    for mefi in mefis:
+        missing = missing_monitors(all_records[mefi], elements)
+        if missing:
+            checkpoints.fail(mefi, None, "no data for monitors: {}"
+                             .format(', '.join(missing)))
+            continue
+        try:
+            optics[mefi] = strengths_fingerprint(
+                strength_source(mefi, strengths))
+        except (IOError, OSError, ValueError) as e:
+            checkpoints.fail(mefi, None, "{}: {}".format(type(e).__name__, e))
+            continue
+        fingerprints[mefi] = input_fingerprint(
+            all_records[mefi], elements, optics[mefi], options)
+    return fingerprints, optics
+
+
+def missing_monitors(devices, elements):
+    """Return the monitors without data in ``{device: [records]}``."""
+    return [el for el in elements if el not in devices]
+
+
+def evaluate_checkpointed(mefis, optics, fingerprints, checkpoints, process,
+                          chunk_size=CHECKPOINT_CHUNK):
+    """
+    Evaluate the settings in chunks and commit every chunk to the
+    checkpoints. Settings with the same optics are kept in the same chunk,
+    so that their sectormaps are computed only once. If a chunk fails, its
+    settings are evaluated one by one, and the errors of the failing
+    settings are recorded instead of aborting.
+
+    :param process: function that returns the results ``{mefi: {column:
+                    value}}`` for a list of settings
+    """
+    groups = {}
+    for mefi in mefis:
+        groups.setdefault(optics[mefi], []).append(mefi)
+    chunks = [[]]
+    for group in sorted(groups.values()):
+        if len(chunks[-1]) >= chunk_size:
+            chunks.append([])
+        chunks[-1].extend(group)
+    for chunk in filter(None, chunks):
+        try:
+            checkpoints.commit(process(chunk), fingerprints)
+        except Exception as e:
+            if len(chunk) == 1:
+                mefi = chunk[0]
+                print("Error in M{}-E{}-F{}-I{}-G{}: {}".format(*(mefi + (e,))))
+                checkpoints.fail(mefi, fingerprints[mefi],
+                                 "{}: {}".format(type(e).__name__, e))
+                continue
+            for mefi in chunk:
+                evaluate_checkpointed([mefi], optics, fingerprints,
+                                      checkpoints, process)
+
+
+def load_strength_store(filename, mefis):
+    """
+    Load the strength store and drop the settings that are not contained.
+
+    :returns: ``(store, mefis)``
+    """
+    store = load_store(filename)
+    missing = [mefi for mefi in mefis if mefi not in store]
+    if missing:
+        print("Warning: skipping {} settings without strengths"
+              .format(len(missing)))
+    return store, [mefi for mefi in mefis if mefi in store]
+
+
+def watch_folder(data_folder, madx_file, seq_name, output_file,
+                 interval=10, monitors=None, bootstrap=0, index=None,
+                 store=None, widths='fwhm', profile_columns=None,
+                 strengths=None, subsets=None, fresh=False, jobs=1,
+                 cache=None, engine='madx', tolerance=DEFAULT_TOLERANCE):
+    """
+    Follow the data folder and the ``params/`` folder (or strength store)
+    and evaluate each MEFI setting as soon as exports for all monitors and
+    the strengths are available. Settings are only recomputed if their
+    inputs changed. The output file is rewritten after every update.
+
+    Errors are reported per setting, see :func:`evaluate_checkpointed`, and
+    the failing settings are retried when their inputs change. Strength
+    files that can not be read (e.g. because they are still being written)
+    are retried on the next poll.
+
+    :param float interval: polling interval in seconds
+    :param list monitors: required monitors (default: all monitors that
+                          were seen so far)
+    :param str store: results store file, see :func:`save_results`
+    :param str strengths: strength store file to use instead of params/
+    :param str subsets: monitor subset report file, see :func:`save_results`
+
+    The other arguments are passed to :func:`compute_sectormaps`. The MAD-X
+    session and worker pool are kept for the whole run, and with
+    ``engine='auto'`` the engine is chosen once per list of monitors.
+    """
+    sessions = [Session(madx_file)]
+    pool = WorkerPool(madx_file, jobs) if jobs > 1 and not fresh else None
+    engines = {}            # {tuple(elements): engine}
+    twiss = dict(sequence=seq_name, betx=1, bety=1)
+    optics_cache = {}       # {filename: (stat, fingerprint)}
+    strength_store = (None, None, {})   # (stat, store, {mefi: fingerprint})
+    state = WatchState()
+    try:
+        while True:
+            all_records = load_records(
+                data_folder, index, jobs, verbose=False,
+                widths=widths, columns=profile_columns)
+            seen = set(dev for devs in all_records.values() for dev in devs)
+            elements, sessions[0] = sort_monitors(
+                madx_file, seq_name, monitors or seen,
+                session=sessions[0], cache=cache)
+
+            if strengths is not None:
+                try:
+                    stat = os.stat(strengths)
+                    stat = (stat.st_size, stat.st_mtime)
+                except OSError:
+                    stat = None
+                if strength_store[0] != stat:
+                    try:
+                        strength_store = (stat, load_store(strengths), {})
+                    except (IOError, OSError, ValueError) as e:
+                        print("Can not read {}, retrying: {}"
+                              .format(strengths, e))
+            _, strength_data, store_optics = strength_store
+
+            optics = {}
+            for mefi, devices in all_records.items():
+                filename = strength_file(mefi)
+                if len(elements) < 3 or not all(
+                        el in devices for el in elements):
+                    continue
+                if strength_data is not None:
+                    if mefi not in strength_data:
+                        continue
+                    if mefi not in store_optics:
+                        store_optics[mefi] = strengths_fingerprint(
+                            strength_data.get(mefi))
+                    optics[mefi] = store_optics[mefi]
+                    continue
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                stat = (stat.st_size, stat.st_mtime)
+                if optics_cache.get(filename, (None,))[0] != stat:
+                    try:
+                        optics_cache[filename] = (
+                            stat, strengths_fingerprint(filename))
+                    except (IOError, OSError, ValueError) as e:
+                        print("Can not read {}, retrying: {}"
+                              .format(filename, e))
+                        continue
+                optics[mefi] = optics_cache[filename][1]
+
+            fingerprints = {
+                mefi: input_fingerprint(
+                    all_records[mefi], elements, optics[mefi])
+                for mefi in optics
+            }
+            changed = sorted(mefi for mefi in optics
+                             if state.inputs.get(mefi) != fingerprints[mefi])
+            if changed and tuple(elements) not in engines:
+                if engine != 'auto':
+                    engines[tuple(elements)] = engine
+                else:
+                    if sessions[0] is None:
+                        sessions[0] = Session(madx_file)
+                    try:
+                        engines[tuple(elements)] = select_engine(
+                            sessions[0], twiss, elements,
+                            [strength_source(mefi, strength_data)
+                             for mefi in changed], tolerance)
+                    except Exception as e:
+                        print("Using MAD-X for the sectormaps: {}".format(e))
+                        sessions[0] = None
+                        engines[tuple(elements)] = 'madx'
+            if changed:
+
+                def process(mefis):
+                    if sessions[0] is None:
+                        sessions[0] = Session(madx_file)
+                    try:
+                        all_sectormaps = compute_unique_sectormaps(
+                            mefis, madx_file, twiss, elements, optics=optics,
+                            strengths=strength_data, session=sessions[0],
+                            fresh=fresh, jobs=jobs, cache=cache,
+                            engine=engines[tuple(elements)],
+                            tolerance=tolerance, pool=pool)
+                    except Exception:
+                        # MAD-X may not be usable anymore after an error:
+                        sessions[0] = None
+                        raise
+                    return evaluate(mefis, all_records, elements,
+                                    all_sectormaps, bootstrap)
+
+                evaluate_checkpointed(changed, optics, fingerprints, state,
+                                      process)
+                rows = {mefi: state.rows[mefi] for mefi in changed
+                        if mefi in state.rows}
+                print_warnings(rows, elements)
+                save_results(output_file, state.rows, store, subsets,
+                             remove=state.failed, bootstrap=bool(bootstrap))
+                print("Updated {} settings, {} settings complete, {} failed"
+                      .format(len(rows), len(state.rows), len(state.failed)))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+class WatchState(object):
+
+    """
+    Results of :func:`watch_folder`, with the same ``commit`` and ``fail``
+    methods as :class:`checkpoints.Checkpoints`, but kept in memory.
+    """
+
+    def __init__(self):
+        self.rows = {}          # {mefi: {column: value}}
+        self.inputs = {}        # {mefi: fingerprint of the inputs}
+        self.failed = {}        # {mefi: error}
+
+    def commit(self, rows, fingerprints):
+        for mefi, values in rows.items():
+            self.rows[mefi] = values
+            self.inputs[mefi] = fingerprints[mefi]
+            self.failed.pop(mefi, None)
+
+    def fail(self, mefi, fingerprint, error):
+        # the previous results do not belong to the current inputs:
+        self.rows.pop(mefi, None)
+        self.inputs[mefi] = fingerprint
+        self.failed[mefi] = error
+
+
+def input_fingerprint(devices, elements, optics, options=None):
+    """
+    Return a hash of the inputs of a single MEFI setting, i.e. the shots of
+    the used monitors and the fingerprint of the strength file, as well as
+    the (JSON serializable) options of the evaluation, if given.
+    """
+    data = [optics, elements, [
+        [(item['envx'], item['envy']) for item in devices[el]]
+        for el in elements
+    ]]
+    if options is not None:
+        data.append(options)
+    text = json.dumps(data)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
 
 
 def format_channel(num, width):
@@ -154,5 +1224,64 @@ def format_float(num):
     return '{:>12}'.format('{:+.5e}'.format(num))
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Calculate RMS emittances from Dreigitter FWHM widths.")
+    parser.add_argument('data_folder')
+    parser.add_argument('madx_file')
+    parser.add_argument('seq_name')
+    parser.add_argument('output_file', nargs='?', default='results.txt')
+    parser.add_argument('--fresh', action='store_true',
+                        help="new MAD-X instance for every MEFI setting")
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                        help="number of worker processes for MAD-X")
+    parser.add_argument('--cache', metavar='DIR',
+                        help="persistent sectormap cache folder (tracks the"
+                             " model and the files it calls)")
+    parser.add_argument('--cache-size', type=int, default=256, metavar='MB',
+                        help="maximum size of the sectormap cache")
+    parser.add_argument('--bootstrap', type=int, default=0, metavar='N',
+                        help="number of bootstrap samples for additional"
+                             " error columns")
+    parser.add_argument('--index', metavar='FILE',
+                        help="index file of the parsed device exports")
+    parser.add_argument('--watch', action='store_true',
+                        help="follow the data folder and update results")
+    parser.add_argument('--interval', type=float, default=10,
+                        metavar='SECONDS', help="polling interval for --watch")
+    parser.add_argument('--monitors', type=lambda s: s.lower().split(','),
+                        metavar='NAMES', help="required monitors for --watch")
+    parser.add_argument('--store', metavar='FILE',
+                        help="binary results store")
+    parser.add_argument('--widths', choices=('fwhm', 'rms', 'gauss'),
+                        default='fwhm', help="source of the beam widths")
+    parser.add_argument('--profile-columns', type=parse_columns,
+                        metavar='COLS',
+                        help="columns posx,ampx,posy,ampy of the raw profiles")
+    parser.add_argument('--strengths', metavar='FILE',
+                        help="strength store to use instead of params/")
+    parser.add_argument('--engine', choices=('madx', 'numpy', 'auto'),
+                        default='madx', help="how to compute the sectormaps")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        metavar='TOL',
+                        help="maximum deviation from MAD-X for --engine=auto")
+    parser.add_argument('--subsets', metavar='FILE',
+                        help="monitor subset report")
+    parser.add_argument('--surrogate', type=int, metavar='STEP',
+                        help="provisional results from interpolated"
+                             " sectormaps first (STEP >= 2)")
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help="checkpoint file for resuming")
+    parser.add_argument('--recompute', action='store_true',
+                        help="ignore the checkpoints")
+    args = parser.parse_args(argv)
+    if args.widths != 'fwhm' and args.profile_columns is None:
+        parser.error("--widths={} requires --profile-columns"
+                     .format(args.widths))
+    if args.surrogate is not None and args.surrogate < 2:
+        parser.error("--surrogate STEP must be at least 2")
+    return vars(args)
+
+
 if __name__ == '__main__':
-    sys.exit(main(*sys.argv[1:]))
+    sys.exit(main(**parse_args()))
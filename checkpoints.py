@@ -0,0 +1,103 @@
+# encoding: utf-8
+"""
+Checkpoints of the evaluated MEFI settings, for resuming calc_emit runs.
+
+Every finished setting is stored in a SQLite database together with the
+fingerprint of its inputs, either with its results or with the error that
+prevented its evaluation. Settings are committed as soon as they are done,
+so an interrupted run loses nothing. A restart only needs to evaluate the
+settings whose inputs changed or that failed before.
+"""
+
+from __future__ import unicode_literals
+
+import json
+import sqlite3
+
+import numpy as np
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS settings (
+    vacc        INTEGER,
+    energy      INTEGER,
+    focus       INTEGER,
+    intensity   INTEGER,
+    gantry      INTEGER,
+    fingerprint TEXT,
+    result      TEXT,
+    error       TEXT,
+    PRIMARY KEY (vacc, energy, focus, intensity, gantry)
+)
+'''
+
+
+class Checkpoints(object):
+
+    """
+    Results and errors of the evaluated settings.
+
+    :param str filename: SQLite database file, created if necessary
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def finished(self, fingerprints, fields=()):
+        """
+        Return the results of the settings that were evaluated successfully
+        with the given input fingerprints.
+
+        :param dict fingerprints: ``{mefi: fingerprint}``
+        :param fields: columns that the results must contain, results
+                       written by older versions without them are ignored
+        :returns: ``{mefi: {column: value}}``
+        """
+        rows = {
+            tuple(row[:5]): json.loads(row[6])
+            for row in self.db.execute(
+                'SELECT * FROM settings WHERE error IS NULL')
+            if fingerprints.get(tuple(row[:5])) == row[5]
+        }
+        return {mefi: values for mefi, values in rows.items()
+                if all(field in values for field in fields)}
+
+    def errors(self, mefis=None):
+        """Return ``{mefi: error}`` of the failed settings."""
+        errors = {tuple(row[:5]): row[5] for row in self.db.execute(
+            'SELECT vacc, energy, focus, intensity, gantry, error '
+            'FROM settings WHERE error IS NOT NULL')}
+        if mefis is not None:
+            errors = {mefi: errors[mefi] for mefi in mefis if mefi in errors}
+        return errors
+
+    def commit(self, rows, fingerprints):
+        """
+        Store the results ``{mefi: {column: value}}`` in one transaction.
+        """
+        self._store([
+            (mefi, fingerprints[mefi], json.dumps(_to_json(values)), None)
+            for mefi, values in rows.items()
+        ])
+
+    def fail(self, mefi, fingerprint, error):
+        """Record the error of a setting."""
+        self._store([(mefi, fingerprint, None, error)])
+
+    def _store(self, entries):
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO settings VALUES (?,?,?,?,?,?,?,?)',
+                [tuple(mefi) + (fingerprint, result, error)
+                 for mefi, fingerprint, result, error in entries])
+
+
+def _to_json(values):
+    """Convert numpy scalars to python values."""
+    return {key: value.item() if isinstance(value, np.generic) else value
+            for key, value in values.items()}
@@ -0,0 +1,99 @@
+# encoding: utf-8
+"""
+Reader for the pseudo .CSV files generated by the "Laufender export"
+functionality in the control system.
+
+The files consist of a short summary in the <HEADER/> and <CUSTOM/> blocks,
+followed by the (possibly large) raw measurements of the individual wires.
+For the emittance calculation only the summary is needed.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+
+from math import sqrt, log
+
+
+HEADER_END = b'</CUSTOM>'
+
+# summary fields used by parse_device_export:
+HEADER_KEYS = (
+    'Gerät',
+    'VAcc ID',
+    'Mefi',
+    'Integrationszeit [s]',
+    'Schwerpunkt X',
+    'Schwerpunkt Y',
+    'FWHM X',
+    'FWHM Y',
+)
+
+
+def read_export_header(filename, keys=None, chunk_size=1<<16):
+    """
+    Read the key/value pairs from the summary blocks of a device export.
+
+    Reading stops at the ``</CUSTOM>`` marker, independent of the line
+    endings used in the file. Only the lines of the requested keys are
+    decoded.
+
+    :param str filename: export file
+    :param keys: names of the fields to return (default: all)
+    :param int chunk_size: number of bytes to read at once
+    :returns: dict ``{key: value}`` with string values
+    """
+    chunks = []
+    with open(filename, 'rb') as f:
+        tail = b''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            # the marker may be split across chunk boundaries:
+            end = (tail + chunk).find(HEADER_END)
+            if end != -1:
+                chunks.append(chunk[:max(0, end - len(tail))])
+                break
+            chunks.append(chunk)
+            tail = chunk[-len(HEADER_END):]
+    header = b''.join(chunks)
+    if keys is not None:
+        keys = {key.encode('latin1'): key for key in keys}
+    data = {}
+    for line in header.splitlines():
+        parts = line.split(b';')
+        if len(parts) != 2:
+            continue
+        key = parts[0].strip()
+        if keys is None:
+            data[key.decode('latin1')] = parts[1].strip().decode('latin1')
+        elif key in keys:
+            data[keys[key]] = parts[1].strip().decode('latin1')
+    return data
+
+
+def parse_device_export(filename):
+    """
+    Parse beam position and FWHM from pseudo .CSV file generated by the
+    "Laufender export" functionality in the control system.
+    """
+    data = read_export_header(filename, HEADER_KEYS)
+    mefi = data['Mefi'].split()
+    assert mefi[0][0] == 'E'
+    assert mefi[1][0] == 'F'
+    assert mefi[2][0] == 'I'
+    assert mefi[3][0] == 'G'
+    fwhm_to_rms = 2*sqrt(2*log(2))
+    return {
+        'device': data['Gerät'].lower(),
+        'mefi': (int(data['VAcc ID']),
+                 int(mefi[0][1:]),
+                 int(mefi[1][1:]),
+                 int(mefi[2][1:]),
+                 int(mefi[3][1:])),
+        'tint': float(data['Integrationszeit [s]']),
+        'posx': float(data['Schwerpunkt X']),
+        'posy': float(data['Schwerpunkt Y']),
+        'envx': float(data['FWHM X']) / 1000 / fwhm_to_rms,
+        'envy': float(data['FWHM Y']) / 1000 / fwhm_to_rms,
+    }
@@ -0,0 +1,251 @@
+"""
+GUI for the parameter download from BeamOptikDll, see download_settings.py.
+"""
+
+from __future__ import division
+
+import os
+import sys
+import signal
+import logging
+import threading
+
+# Load Qt4 or Qt5
+try:
+    import types
+    from PyQt5 import QtCore, QtGui, uic, QtWidgets
+    QtGuiCompat = types.ModuleType('QtGui')
+    QtGuiCompat.__dict__.update(QtGui.__dict__)
+    QtGuiCompat.__dict__.update(QtWidgets.__dict__)
+    QtGui = QtGuiCompat
+except ImportError:
+    import sip
+    sip.setapi('QString', 2)
+    sip.setapi('QVariant', 2)
+    from PyQt4 import QtCore, QtGui, uic
+
+from download_settings import (
+    DATA_FOLDER, PARAM_FILE, MEFIS_FILE, MEFI, Downloader,
+    fmt_ints, parse_ints, parse_conf, read_params)
+
+
+class MainWindow(QtGui.QWidget):
+
+    worker = None
+    logged = QtCore.pyqtSignal(str)
+
+    def __init__(self, param_file=None, mefis_file=None):
+        super(MainWindow, self).__init__()
+        uic.loadUi(os.path.join(DATA_FOLDER, 'dialog.ui'), self)
+        self.downloader = Downloader(log=self.logged.emit)
+        self.availability = self.downloader.availability
+        self.load_mefis(mefis_file or MEFIS_FILE)
+        self.load_params(param_file or PARAM_FILE)
+        self.update_ui()
+        self.connect_signals()
+
+    def load_mefis(self, filename):
+        self._mefis_file = os.path.abspath(filename)
+        with open(filename) as f:
+            text = f.read()
+        self.set_mefis(dict(parse_conf(text)))
+
+    def set_mefis(self, mefis):
+        self.ctrl_vacc.setText(fmt_ints(mefis['VACCS']))
+        self.ctrl_energy.setText(fmt_ints(mefis['ENERGIES']))
+        self.ctrl_focus.setText(fmt_ints(mefis['FOCUSES']))
+        self.ctrl_intensity.setText(fmt_ints(mefis['INTENSITIES']))
+        self.ctrl_angle.setText(fmt_ints(mefis['ANGLES']))
+        self._mefis = mefis
+
+    def connect_signals(self):
+        Btn = QtGui.QDialogButtonBox
+        self.mefi_buttons.button(Btn.Open).clicked.connect(self.open_mefi)
+        self.mefi_buttons.button(Btn.Save).clicked.connect(self.save_mefi)
+        self.btn_download.clicked.connect(self.start)
+        self.btn_cancel.clicked.connect(self.cancel)
+        self.ctrl_vacc.textChanged.connect(self.update_ui)
+        self.ctrl_energy.textChanged.connect(self.update_ui)
+        self.ctrl_focus.textChanged.connect(self.update_ui)
+        self.ctrl_intensity.textChanged.connect(self.update_ui)
+        self.ctrl_angle.textChanged.connect(self.update_ui)
+        self.logged.connect(self.ctrl_log.appendPlainText)
+
+    def closeEvent(self, event):
+        self.cancel()
+        super(MainWindow, self).closeEvent(event)
+
+    @property
+    def running(self):
+        return self.downloader.running
+
+    @running.setter
+    def running(self, running):
+        self.downloader.running = running
+
+    def load_params(self, param_file=None):
+        self.ctrl_params.clear()
+        self.ctrl_params.addItems(read_params(param_file))
+
+    def update_ui(self):
+        running = self.running
+        mefis = MEFI(*map(bool, self.mefi()))
+        can_start = all(mefis)
+        self.btn_download.setEnabled(can_start and not self.running)
+        self.mefi_buttons.button(QtGui.QDialogButtonBox.Save).setEnabled(can_start)
+        self.btn_cancel.setEnabled(running)
+        self.ctrl_vacc.setReadOnly(running)
+        self.ctrl_energy.setReadOnly(running)
+        self.ctrl_focus.setReadOnly(running)
+        self.ctrl_intensity.setReadOnly(running)
+        self.ctrl_angle.setReadOnly(running)
+
+        color = [QtCore.Qt.red, None]
+        set_base_color(self.ctrl_vacc,      color[mefis.vacc])
+        set_base_color(self.ctrl_energy,    color[mefis.energy])
+        set_base_color(self.ctrl_focus,     color[mefis.focus])
+        set_base_color(self.ctrl_intensity, color[mefis.intensity])
+        set_base_color(self.ctrl_angle,     color[mefis.angle])
+
+        if can_start:
+            params = [self.ctrl_params.item(i).text()
+                      for i in range(self.ctrl_params.count())]
+            skipped = self.availability.num_skipped(self.mefi(), params)
+            self.lbl_skipped.setText(
+                'Skipping {} known failing reads'.format(skipped)
+                if skipped else '')
+
+    def save_mefis(self, filename, mefis):
+        self._mefis_file = os.path.abspath(filename)
+        text = (
+            "VACCS       = {}\n"
+            "ENERGIES    = {}\n"
+            "FOCUSES     = {}\n"
+            "INTENSITIES = {}\n"
+            "ANGLES      = {}\n"
+        ).format(*mefis)
+        with open(filename, 'wt') as f:
+            f.write(text)
+
+    def open_mefi(self):
+        folder = os.path.dirname(self._mefis_file)
+        filename = _fileDialog(
+            QtGui.QFileDialog.AcceptOpen,
+            QtGui.QFileDialog.ExistingFile,
+            self, 'Open file', folder, [
+                ("TXT files", "*.txt"),
+                ("All files", "*"),
+            ])
+        if filename:
+            self.load_mefis(filename)
+
+    def save_mefi(self):
+        folder = os.path.dirname(self._mefis_file)
+        filename = _fileDialog(
+            QtGui.QFileDialog.AcceptSave,
+            QtGui.QFileDialog.AnyFile,
+            self, 'Open file', folder, [
+                ("TXT files", "*.txt"),
+                ("All files", "*"),
+            ])
+        if filename:
+            self.save_mefis(filename, self.mefi())
+
+    def mefi(self):
+        return MEFI(parse_ints(self.ctrl_vacc.text()),
+                    parse_ints(self.ctrl_energy.text()),
+                    parse_ints(self.ctrl_focus.text()),
+                    parse_ints(self.ctrl_intensity.text()),
+                    parse_ints(self.ctrl_angle.text()))
+
+    def start(self):
+        self.ctrl_tab.setCurrentIndex(2)
+        self.running = True
+        self.update_ui()
+        try:
+            mefi = self.mefi()
+            pars = [self.ctrl_params.item(i).text()
+                    for i in range(self.ctrl_params.count())]
+            args = (pars, mefi,
+                    self.chk_refresh.isChecked(),
+                    self.chk_adaptive.isChecked())
+            self.worker = threading.Thread(
+                target=self.downloader.download, args=args)
+            self.worker.start()
+        except:
+            self.running = False
+            self.update_ui()
+            raise
+
+    def cancel(self):
+        self.running = False
+        self.update_ui()
+
+
+def set_base_color(widget, color):
+    palette = widget.parent().palette();
+    if color is not None:
+        palette.setColor(QtGui.QPalette.Base, color);
+    widget.setPalette(palette)
+
+
+def make_filters(wildcards):
+    """
+    Create wildcard string from multiple wildcard tuples.
+
+    For example:
+
+        >>> make_filters([
+        ...     ('All files', '*'),
+        ...     ('Text files', '*.txt', '*.log'),
+        ... ])
+        ['All files (*)', 'Text files (*.txt *.log)']
+    """
+    return ["{0} ({1})".format(w[0], " ".join(w[1:]))
+            for w in wildcards]
+
+
+def _fileDialog(acceptMode, fileMode,
+                parent=None, caption='', directory='', filters=(),
+                selectedFilter=None, options=0):
+
+    nameFilters = make_filters(filters)
+
+    dialog = QtGui.QFileDialog(parent, caption, directory)
+    dialog.setNameFilters(nameFilters)
+    dialog.setAcceptMode(acceptMode)
+    dialog.setFileMode(fileMode)
+    dialog.setOptions(QtGui.QFileDialog.Options(options))
+    if selectedFilter is not None:
+        dialog.selectNameFilter(nameFilters[selectedFilter])
+
+    if dialog.exec_() != QtGui.QDialog.Accepted:
+        return None
+
+    filename = dialog.selectedFiles()[0]
+    selectedFilter = nameFilters.index(dialog.selectedNameFilter())
+
+    _, ext = os.path.splitext(filename)
+
+    if not ext:
+        ext = filters[selectedFilter][1]    # use first extension
+        if ext.startswith('*.') and ext != '*.*':
+            return filename + ext[1:]       # remove leading '*'
+    return filename
+
+
+def main(param_file=None, mefis_file=None):
+    """Invoke GUI application."""
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    app = QtGui.QApplication(sys.argv)
+    window = MainWindow(param_file, mefis_file)
+
+    logging.basicConfig(level=logging.INFO)
+
+    window.show()
+    return app.exec_()
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
@@ -1,43 +1,63 @@
 """
 Parameter download from BeamOptikDll.
+
+Usage:
+
+    download_settings.py [<PARAM_FILE> [<MEFIS_FILE>]]
+    download_settings.py download [--params FILE] [--mefis FILE] [options]
+
+Without arguments (or with the names of the parameter and MEFI files), the
+GUI is started. The ``download`` command downloads the parameters without
+GUI and writes the progress as one JSON object per line to stdout.
+
+Options of the download command:
+
+    --params FILE           list of parameters [default: params.txt]
+    --mefis FILE            MEFI combinations [default: mefi_combinations.txt]
+    --output FOLDER         folder for the .str files [default: params]
+    --refresh               download completed settings again
+    --adaptive              do not read parameters again that did not vary
+                            along a MEFI axis, see DownloadPlanner
+    --dll FILE              filename of the BeamOptikDLL
+    --mock                  use the mock DLL (for testing)
+
+The exit code is non-zero if the download failed or was interrupted.
 """
 
 from __future__ import division
+from __future__ import print_function
 
 import os
 import sys
-import signal
+import json
+import math
+import time
+import hashlib
 import logging
+import argparse
 import threading
 import itertools
 import functools
-import collections
 import re
 from collections import namedtuple
 
-# Load Qt4 or Qt5
-try:
-    import types
-    from PyQt5 import QtCore, QtGui, uic, QtWidgets
-    QtGuiCompat = types.ModuleType('QtGui')
-    QtGuiCompat.__dict__.update(QtGui.__dict__)
-    QtGuiCompat.__dict__.update(QtWidgets.__dict__)
-    QtGui = QtGuiCompat
-except ImportError:
-    import sip
-    sip.setapi('QString', 2)
-    sip.setapi('QVariant', 2)
-    from PyQt4 import QtCore, QtGui, uic
-
 DATA_FOLDER = os.path.dirname(__file__)
 
 # allow shipping and importing beamoptikdll.py from same folder
 sys.path.append(DATA_FOLDER)
-from beamoptikdll import BeamOptikDLL
+from beamoptikdll import BeamOptikDLL, ParameterNotFound
 
 
 MEFI = namedtuple('MEFI', ['vacc', 'energy', 'focus', 'intensity', 'angle'])
 
+AVAILABILITY_FILE = os.path.join(DATA_FOLDER, 'param_availability.json')
+
+PARAMS_FOLDER = os.path.join(DATA_FOLDER, 'params')
+MANIFEST_FILENAME = 'manifest.json'
+
+PARAM_FILE = os.path.join(DATA_FOLDER, 'params.txt')
+MEFIS_FILE = os.path.join(DATA_FOLDER, 'mefi_combinations.txt')
+
 
 def fmt_ints(ints):
     return ', '.join(map(str, ints))
@@ -56,177 +76,411 @@ def parse_conf(text):
             yield m.group(1), parse_ints(m.group(2))
 
 
-class MainWindow(QtGui.QWidget):
+class ParamAvailability(object):
 
-    worker = None
-    dll = None
-    running = False
-    logged = QtCore.pyqtSignal(str)
-
-    def __init__(self, param_file=None, mefis_file=None):
-        super(MainWindow, self).__init__()
-        uic.loadUi(os.path.join(DATA_FOLDER, 'dialog.ui'), self)
-        self.load_mefis(
-            mefis_file or os.path.join(DATA_FOLDER, 'mefi_combinations.txt'))
-        self.load_params(
-            param_file or os.path.join(DATA_FOLDER, 'params.txt'))
-        self.update_ui()
-        self.connect_signals()
-
-    def load_mefis(self, filename):
-        self._mefis_file = os.path.abspath(filename)
-        with open(filename) as f:
-            text = f.read()
-        self.set_mefis(dict(parse_conf(text)))
-
-    def set_mefis(self, mefis):
-        self.ctrl_vacc.setText(fmt_ints(mefis['VACCS']))
-        self.ctrl_energy.setText(fmt_ints(mefis['ENERGIES']))
-        self.ctrl_focus.setText(fmt_ints(mefis['FOCUSES']))
-        self.ctrl_intensity.setText(fmt_ints(mefis['INTENSITIES']))
-        self.ctrl_angle.setText(fmt_ints(mefis['ANGLES']))
-        self._mefis = mefis
-
-    def connect_signals(self):
-        Btn = QtGui.QDialogButtonBox
-        self.mefi_buttons.button(Btn.Open).clicked.connect(self.open_mefi)
-        self.mefi_buttons.button(Btn.Save).clicked.connect(self.save_mefi)
-        self.btn_download.clicked.connect(self.start)
-        self.btn_cancel.clicked.connect(self.cancel)
-        self.ctrl_vacc.textChanged.connect(self.update_ui)
-        self.ctrl_energy.textChanged.connect(self.update_ui)
-        self.ctrl_focus.textChanged.connect(self.update_ui)
-        self.ctrl_intensity.textChanged.connect(self.update_ui)
-        self.ctrl_angle.textChanged.connect(self.update_ui)
-        self.logged.connect(self.ctrl_log.appendPlainText)
-
-    def closeEvent(self, event):
-        self.cancel()
-        super(MainWindow, self).closeEvent(event)
-
-    def load_params(self, param_file=None):
-        with open(param_file) as f:
-            params = [line.strip() for line in f]
-        self.ctrl_params.clear()
-        self.ctrl_params.addItems(sorted(params))
-
-    def update_ui(self):
-        running = self.running
-        mefis = MEFI(*map(bool, self.mefi()))
-        can_start = all(mefis)
-        self.btn_download.setEnabled(can_start and not self.running)
-        self.mefi_buttons.button(QtGui.QDialogButtonBox.Save).setEnabled(can_start)
-        self.btn_cancel.setEnabled(running)
-        self.ctrl_vacc.setReadOnly(running)
-        self.ctrl_energy.setReadOnly(running)
-        self.ctrl_focus.setReadOnly(running)
-        self.ctrl_intensity.setReadOnly(running)
-        self.ctrl_angle.setReadOnly(running)
-
-        color = [QtCore.Qt.red, None]
-        set_base_color(self.ctrl_vacc,      color[mefis.vacc])
-        set_base_color(self.ctrl_energy,    color[mefis.energy])
-        set_base_color(self.ctrl_focus,     color[mefis.focus])
-        set_base_color(self.ctrl_intensity, color[mefis.intensity])
-        set_base_color(self.ctrl_angle,     color[mefis.angle])
-
-    def save_mefis(self, filename, mefis):
-        self._mefis_file = os.path.abspath(filename)
-        text = (
-            "VACCS       = {}\n"
-            "ENERGIES    = {}\n"
-            "FOCUSES     = {}\n"
-            "INTENSITIES = {}\n"
-            "ANGLES      = {}\n"
-        ).format(*mefis)
-        with open(filename, 'wt') as f:
-            f.write(text)
-
-    def open_mefi(self):
-        folder = os.path.dirname(self._mefis_file)
-        filename = _fileDialog(
-            QtGui.QFileDialog.AcceptOpen,
-            QtGui.QFileDialog.ExistingFile,
-            self, 'Open file', folder, [
-                ("TXT files", "*.txt"),
-                ("All files", "*"),
-            ])
-        if filename:
-            self.load_mefis(filename)
-
-    def save_mefi(self):
-        folder = os.path.dirname(self._mefis_file)
-        filename = _fileDialog(
-            QtGui.QFileDialog.AcceptSave,
-            QtGui.QFileDialog.AnyFile,
-            self, 'Open file', folder, [
-                ("TXT files", "*.txt"),
-                ("All files", "*"),
-            ])
-        if filename:
-            self.save_mefis(filename, self.mefi())
-
-    def mefi(self):
-        return MEFI(parse_ints(self.ctrl_vacc.text()),
-                    parse_ints(self.ctrl_energy.text()),
-                    parse_ints(self.ctrl_focus.text()),
-                    parse_ints(self.ctrl_intensity.text()),
-                    parse_ints(self.ctrl_angle.text()))
-
-    def start(self):
-        self.ctrl_tab.setCurrentIndex(2)
-        self.running = True
-        self.update_ui()
+    """
+    Persistent record of the parameters that do not exist for a VAcc.
+
+    Parameters that the DLL reports as not found are remembered across
+    sessions, so that the DLL is not asked again for parameters that do not
+    exist on a beamline. Entries expire after ``max_age`` seconds, after
+    which the parameters are tried again. Other failures are not recorded.
+    """
+
+    def __init__(self, filename, max_age=7*24*3600):
+        self.filename = filename
+        self.max_age = max_age
+        self._lock = threading.Lock()
         try:
-            mefi = self.mefi()
-            pars = [self.ctrl_params.item(i).text()
-                    for i in range(self.ctrl_params.count())]
-            args = (pars, mefi)
-            self.worker = threading.Thread(target=self.download, args=args)
-            self.worker.start()
-        except:
-            self.running = False
-            self.update_ui()
-            raise
+            with open(filename) as f:
+                self._failed = json.load(f)
+        except (IOError, ValueError):
+            self._failed = {}
+
+    def failed(self, vacc):
+        """Return the set of unexpired failed parameters for the VAcc."""
+        limit = time.time() - self.max_age
+        with self._lock:
+            return {param for param, stamp in
+                    self._failed.get(str(vacc), {}).items()
+                    if stamp > limit}
+
+    def available(self, vacc, params):
+        """Return the parameters that are not known to fail for the VAcc."""
+        failed = self.failed(vacc)
+        return [param for param in params if param not in failed]
+
+    def num_skipped(self, mefis, params):
+        """Return the number of DLL calls that will be skipped."""
+        num_efi = functools.reduce(lambda a, b: a * b, map(len, mefis[1:]))
+        return sum(len(self.failed(vacc).intersection(params)) * num_efi
+                   for vacc in set(mefis[0]))
+
+    def mark_failed(self, vacc, param):
+        with self._lock:
+            self._failed.setdefault(str(vacc), {})[param] = time.time()
+
+    def mark_ok(self, vacc, param):
+        with self._lock:
+            self._failed.get(str(vacc), {}).pop(param, None)
+
+    def save(self):
+        with self._lock:
+            text = json.dumps(self._failed, indent=1, sort_keys=True)
+        write_atomic(self.filename, text)
+
+
+class DownloadPlanner(object):
 
-    def cancel(self):
-        self.running = False
-        self.update_ui()
+    """
+    Learns along which MEFI axes the parameters vary, and provides the
+    values of parameters that were already read for an equivalent setting.
+
+    For every VAcc, the first downloaded setting is the reference. For each
+    axis, the first ``num_probes`` settings that differ from the reference
+    only along this axis are read completely (probes). Parameters that have
+    the same value in all probes and in the reference are assumed not to
+    depend on this axis and are not read again for settings that only
+    differ along axes they do not depend on.
+
+    Of the reused values, the fraction ``check_fraction`` (at least one)
+    is read anyway for every setting, in turn. If a value differs, the assumption is dropped for the parameter,
+    which is then read for every setting, and the parameter is reported by
+    :meth:`pop_rejected`.
+
+    The settings must be passed in the order of ``itertools.product``, so
+    that the probes are downloaded before the settings that vary along their
+    axis. Axes that were not probed completely are always considered
+    relevant.
+    """
+
+    AXES = (1, 2, 3, 4)     # energy, focus, intensity, angle
+
+    def __init__(self, num_probes=2, check_fraction=0.1):
+        self.num_probes = num_probes
+        self.check_fraction = check_fraction
+        self._base = {}         # {vacc: (mefi, {param: value})}
+        self._probes = {}       # {vacc: {axis: [{param: value}]}}
+        self._values = {}       # {vacc: {param: (axes, {key: value})}}
+        self._rejected = []     # [(vacc, param)]
+        self._num_checked = 0
+
+    def probe_axis(self, mefi):
+        """
+        Return the axis that is probed by this setting, 0 if it becomes the
+        reference, or ``None`` if it is no probe.
+        """
+        vacc = mefi[0]
+        if vacc not in self._base:
+            return 0
+        base = self._base[vacc][0]
+        diff = [axis for axis in self.AXES if mefi[axis] != base[axis]]
+        if len(diff) == 1 and len(
+                self._probes[vacc].get(diff[0], ())) < self.num_probes:
+            return diff[0]
+        return None
+
+    def dependencies(self, vacc):
+        """Return ``{param: axes}`` with the relevant axes of all params."""
+        return {param: axes for param, (axes, _) in
+                self._values.get(vacc, {}).items()}
+
+    def cached(self, mefi):
+        """Return ``{param: value}`` for the known params of the setting."""
+        if self.probe_axis(mefi) is not None:
+            return {}
+        return {
+            param: values[key]
+            for param, (axes, values) in self._values[mefi[0]].items()
+            for key in [tuple(mefi[axis] for axis in axes)]
+            if key in values
+        }
+
+    def spot_checks(self, cached):
+        """Return the reused parameters that should be read anyway."""
+        params = sorted(cached)
+        if not params:
+            return set()
+        num = min(len(params),
+                  max(1, int(math.ceil(self.check_fraction * len(params)))))
+        start = self._num_checked % len(params)
+        self._num_checked += num
+        return set((params + params)[start:start+num])
+
+    def reject(self, vacc, param):
+        """Consider all axes relevant for the parameter from now on."""
+        self._values[vacc][param] = (self.AXES, {})
+        self._rejected.append((vacc, param))
+
+    def pop_rejected(self):
+        """Return and forget the list of rejected ``(vacc, param)``."""
+        rejected, self._rejected = self._rejected, []
+        return rejected
+
+    def update(self, mefi, values):
+        """Record the parameter values that were read for the setting."""
+        vacc = mefi[0]
+        axis = self.probe_axis(mefi)
+        if axis == 0:
+            self._base[vacc] = (mefi, dict(values))
+            self._probes[vacc] = {}
+            self._values[vacc] = {}
+        elif axis is not None:
+            probes = self._probes[vacc].setdefault(axis, [])
+            probes.append(dict(values))
+            if len(probes) == self.num_probes:
+                base = self._base[vacc][1]
+                for param, value in base.items():
+                    if all(probe.get(param) == value for probe in probes):
+                        self._drop_axis(vacc, param, axis)
+        known = self._values[vacc]
+        for param, value in values.items():
+            axes, cache = known.setdefault(param, (self.AXES, {}))
+            cache[tuple(mefi[axis] for axis in axes)] = value
+
+    def _drop_axis(self, vacc, param, axis):
+        axes, cache = self._values[vacc][param]
+        keep = [i for i, a in enumerate(axes) if a != axis]
+        self._values[vacc][param] = (
+            tuple(axes[i] for i in keep),
+            {tuple(key[i] for i in keep): value
+             for key, value in cache.items()})
+
+
+class DownloadManifest(object):
+
+    """
+    Record of the completely downloaded MEFI settings.
+
+    For every finished settings file, the time of download, the number of
+    read parameters, a digest of the requested parameter list and the
+    parameters whose values were reused from other settings (see
+    :class:`DownloadPlanner`) are stored. This allows to resume cancelled or crashed downloads without
+    fetching the same settings again. Settings that were downloaded for a
+    different parameter list are not considered complete.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def is_complete(self, mefi, params):
+        """
+        Check if the settings file was completely downloaded for the given
+        list of parameters.
+        """
+        basename = mefi_basename(mefi)
+        folder = os.path.dirname(self.filename)
+        entry = self.entries.get(basename, {})
+        return (entry.get('params') == params_digest(params) and
+                os.path.exists(os.path.join(folder, basename + '.str')))
+
+    def mark_complete(self, mefi, num_params, params, reused=()):
+        self.entries[mefi_basename(mefi)] = {
+            'time': time.time(),
+            'num_params': num_params,
+            'params': params_digest(params),
+            'reused': sorted(reused),
+        }
+
+    def discard(self, mefi):
+        """Mark the settings file as incomplete."""
+        self.entries.pop(mefi_basename(mefi), None)
+
+    def save(self):
+        write_atomic(self.filename,
+                     json.dumps(self.entries, indent=1, sort_keys=True))
+
+
+def params_digest(params):
+    """Return a hash of the list of requested parameters."""
+    text = '\n'.join(sorted(params))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def mefi_basename(mefi):
+    return 'M{}-E{}-F{}-I{}-G{}'.format(*mefi)
+
+
+def write_atomic(filename, text):
+    """Write the file under a temporary name and move it into place."""
+    tmp = filename + '.part'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    replace_file(tmp, filename)
+
+
+def replace_file(src, dst):
+    """Move ``src`` to ``dst``, replacing ``dst`` if it exists."""
+    try:
+        os.replace(src, dst)
+    except AttributeError:      # py2
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def read_params(filename):
+    with open(filename) as f:
+        return sorted(filter(None, (line.strip() for line in f)))
+
+
+def read_mefis(filename):
+    with open(filename) as f:
+        mefis = dict(parse_conf(f.read()))
+    return MEFI(mefis['VACCS'], mefis['ENERGIES'], mefis['FOCUSES'],
+                mefis['INTENSITIES'], mefis['ANGLES'])
+
+
+class Downloader(object):
+
+    """
+    Downloads the parameters for all MEFI combinations into .str files.
+
+    This class does not depend on Qt and is used by both the GUI and the
+    command line. Set :attr:`running` to ``False`` from another thread to
+    cancel the download.
+
+    :param dll: connected :class:`BeamOptikDLL`, if ``None`` the DLL will
+                be loaded on first use
+    :param log: ``callable(text)`` receiving status messages
+    :param report: ``callable(event)`` receiving progress dicts
+    :param str folder: output folder for the .str files
+    """
+
+    running = False
+
+    def __init__(self, dll=None, log=None, report=None,
+                 folder=PARAMS_FOLDER, availability=None):
+        self.dll = dll
+        self._log = log or logging.getLogger(__name__).info
+        self.report = report or (lambda event: None)
+        self.folder = folder
+        self.availability = availability or ParamAvailability(
+            AVAILABILITY_FILE)
 
     def log(self, text, *args, **kwargs):
-        self.logged.emit(text.format(*args, **kwargs))
+        self._log(text.format(*args, **kwargs))
 
-    def load_dll(self):
+    def load_dll(self, lib=BeamOptikDLL.filename):
         self.log('Connecting DLL')
-        dll = BeamOptikDLL()
+        dll = BeamOptikDLL(lib, stats_interval=60)
         dll.GetInterfaceInstance()
         dll.SelectVAcc(1)
         self.dll = dll
         self.log('Connected')
 
-    def download(self, params, mefis):
+    def download(self, params, mefis, refresh=False, adaptive=False):
+        """
+        Download all settings in the product of ``mefis``.
+
+        :param bool adaptive: reuse values of parameters that do not vary,
+                              see :class:`DownloadPlanner`. If a spot check
+                              shows that a reused value was wrong, the
+                              settings of this run that reused the parameter
+                              are downloaded again at the end.
+        :returns: number of completely downloaded settings. Settings where
+                  parameters failed for other reasons than not existing are
+                  not complete and are downloaded again in the next run.
+        """
+        self.running = True
         if self.dll is None:
             self.load_dll()
-        par = collections.defaultdict(lambda: list(params))
+        try:
+            os.makedirs(self.folder)
+        except OSError:     # no exist_ok on py2
+            pass
+        manifest = DownloadManifest(
+            os.path.join(self.folder, MANIFEST_FILENAME))
+        planner = DownloadPlanner() if adaptive else None
+        reused = {}         # {mefi: reused params} of this run
+        par = {}
         mul = lambda a, b: a * b
         num = functools.reduce(mul, map(len, mefis))
-        for i, mefi in enumerate(itertools.product(*mefis)):
+        todo = [mefi for mefi in itertools.product(*mefis)
+                if refresh or not manifest.is_complete(mefi, params)]
+        self.report({'event': 'start', 'total': num, 'todo': len(todo)})
+        if len(todo) < num:
+            self.log('Skipping {} completed settings', num - len(todo))
+        num_done = 0
+        for i, mefi in enumerate(todo):
             if not self.running:
                 break
             vacc = mefi[0]
-            progress = '{}/{} = {:.0f}%'.format(i, num, i/num*100)
-            self.download_mefi(par[vacc], mefi, progress)
-
-    def download_mefi(self, params, mefi, progress):
-
-        folder = os.path.join(DATA_FOLDER, 'params')
+            if vacc not in par:
+                par[vacc] = self.availability.available(vacc, params)
+                if len(par[vacc]) < len(params):
+                    self.log('Skipping {} parameters known to fail for '
+                             'VAcc {}', len(params) - len(par[vacc]), vacc)
+            progress = '{}/{} = {:.0f}%'.format(
+                i, len(todo), i/len(todo)*100)
+            result = self.download_mefi(par[vacc], mefi, progress, planner)
+            # parameters that failed for other reasons than not existing
+            # are missing in the file, try again in the next run:
+            failed = set(params) - set(par[vacc]) - \
+                self.availability.failed(vacc)
+            if result is not None and failed:
+                self.log('Not marking M{} E{} F{} I{} G{} as complete, {} '
+                         'parameters failed', *(tuple(mefi) + (len(failed),)))
+            elif result is not None:
+                num_read, reused[mefi] = result
+                num_done += 1
+                manifest.mark_complete(mefi, num_read, params, reused[mefi])
+                manifest.save()
+                self.report({'event': 'setting', 'mefi': list(mefi),
+                             'index': i + 1, 'todo': len(todo),
+                             'num_read': num_read,
+                             'num_params': len(params)})
+            self.availability.save()
+            if planner is not None:
+                for vacc, param in planner.pop_rejected():
+                    redo = [m for m in sorted(reused)
+                            if m[0] == vacc and param in reused[m]]
+                    self.log('Warning: {} varies unexpectedly, downloading'
+                             ' {} settings again', param, len(redo))
+                    for m in redo:
+                        del reused[m]
+                        manifest.discard(m)
+                    manifest.save()
+                    todo.extend(redo)
+                    num_done -= len(redo)
+        self.log('DLL call statistics:\n{}\n', self.dll.stats)
+        self.report({'event': 'finished', 'completed': num_done,
+                     'todo': len(todo), 'cancelled': not self.running})
+        self.running = False
+        return num_done
+
+    def download_mefi(self, params, mefi, progress, planner=None):
+        """
+        Download the parameters for a single MEFI setting. The settings file
+        is written under a temporary name and only moved into place if the
+        download was not cancelled. Parameters known to the planner are
+        not read again.
+
+        :returns: ``(num_params, reused)`` with the number of written
+                  parameters and the set of reused parameters, or ``None``
+                  if cancelled
+        """
+        filename = os.path.join(self.folder, mefi_basename(mefi) + '.str')
+        tmp = filename + '.part'
         try:
-            os.makedirs(folder)
-        except OSError:     # no exist_ok on py2
-            pass
-        basename = 'M{}-E{}-F{}-I{}-G{}.str'.format(*mefi)
-        filename = os.path.join(folder, basename)
+            result = self._download_mefi(
+                tmp, params, mefi, progress, planner)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if not self.running:
+            os.remove(tmp)
+            return None
+        replace_file(tmp, filename)
+        return result
 
+    def _download_mefi(self, filename, params, mefi, progress, planner):
         with open(filename, 'w') as f:
             vacc = mefi[0]
             if vacc != self.dll.GetSelectedVAcc():
@@ -240,13 +494,25 @@ class MainWindow(QtGui.QWidget):
                     'gantry_angle = {};\n'
                     .format(*mefi_values))
 
+            cached = planner.cached(mefi) if planner else {}
+            checks = planner.spot_checks(cached) if planner else set()
+            read = {}
             num_params = len(params)
             for param in list(params):
                 if not self.running:
                     break
+                if param in cached and param not in checks:
+                    f.write('{} = {};\n'.format(param, cached[param]))
+                    continue
                 try:
                     val = self.dll.GetFloatValue(param)
                     #self.log('{} -> {}', param, val)
+                except ParameterNotFound as e:
+                    self.log('{} -> FAILED: {}', param, e)
+                    # forget this parameter for current VAcc, also in later
+                    # sessions:
+                    params.remove(param)
+                    self.availability.mark_failed(vacc, param)
                 except RuntimeError as e:
                     self.log('{} -> FAILED: {}', param, e)
                     # forget this parameter for current VAcc for efficiency:
@@ -255,74 +521,85 @@ class MainWindow(QtGui.QWidget):
                     self.log('{} -> ERROR: {}', param, e)
                     raise
                 else:
+                    self.availability.mark_ok(vacc, param)
+                    read[param] = val
+                    if param in checks and val != cached[param]:
+                        self.log('{} -> {}, but reused {}', param, val,
+                                 cached[param])
+                        planner.reject(vacc, param)
                     # MADX compatible output format:
                     f.write('{} = {};\n'.format(param, val))
+            if planner is not None and self.running:
+                planner.update(mefi, read)
+            reused = set(cached) - checks
+            if reused:
+                self.log('Reused {} unchanged values', len(reused))
             self.log('FINISHED M{2} E{3} F{4} I{5} G{6}, read {0}/{1} params\n', len(params), num_params, *mefi)
-
-
-def set_base_color(widget, color):
-    palette = widget.parent().palette();
-    if color is not None:
-        palette.setColor(QtGui.QPalette.Base, color);
-    widget.setPalette(palette)
-
-
-def make_filters(wildcards):
+            return len(params), reused
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='download_settings.py download',
+        description="Download the parameters without GUI.")
+    parser.add_argument('--params', default=PARAM_FILE, metavar='FILE',
+                        help="list of parameters")
+    parser.add_argument('--mefis', default=MEFIS_FILE, metavar='FILE',
+                        help="MEFI combinations")
+    parser.add_argument('--output', default=PARAMS_FOLDER, metavar='FOLDER',
+                        help="folder for the .str files")
+    parser.add_argument('--refresh', action='store_true',
+                        help="download completed settings again")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="do not read parameters again that did not vary")
+    parser.add_argument('--dll', default=BeamOptikDLL.filename,
+                        metavar='FILE', help="filename of the BeamOptikDLL")
+    parser.add_argument('--mock', action='store_true',
+                        help="use the mock DLL (for testing)")
+    return vars(parser.parse_args(argv))
+
+
+def print_event(event):
+    print(json.dumps(event, sort_keys=True))
+    sys.stdout.flush()
+
+
+def download(params=PARAM_FILE, mefis=MEFIS_FILE, output=PARAMS_FOLDER,
+             refresh=False, adaptive=False, dll=BeamOptikDLL.filename,
+             mock=False):
     """
-    Create wildcard string from multiple wildcard tuples.
+    Download the parameters without GUI. Progress is written as JSON lines
+    to stdout, log messages go to stderr.
 
-    For example:
-
-        >>> make_filters([
-        ...     ('All files', '*'),
-        ...     ('Text files', '*.txt', '*.log'),
-        ... ])
-        ['All files (*)', 'Text files (*.txt *.log)']
+    :returns: exit code
     """
-    return ["{0} ({1})".format(w[0], " ".join(w[1:]))
-            for w in wildcards]
-
-
-def _fileDialog(acceptMode, fileMode,
-                parent=None, caption='', directory='', filters=(),
-                selectedFilter=None, options=0):
-
-    nameFilters = make_filters(filters)
-
-    dialog = QtGui.QFileDialog(parent, caption, directory)
-    dialog.setNameFilters(nameFilters)
-    dialog.setAcceptMode(acceptMode)
-    dialog.setFileMode(fileMode)
-    dialog.setOptions(QtGui.QFileDialog.Options(options))
-    if selectedFilter is not None:
-        dialog.selectNameFilter(nameFilters[selectedFilter])
-
-    if dialog.exec_() != QtGui.QDialog.Accepted:
-        return None
-
-    filename = dialog.selectedFiles()[0]
-    selectedFilter = nameFilters.index(dialog.selectedNameFilter())
-
-    _, ext = os.path.splitext(filename)
-
-    if not ext:
-        ext = filters[selectedFilter][1]    # use first extension
-        if ext.startswith('*.') and ext != '*.*':
-            return filename + ext[1:]       # remove leading '*'
-    return filename
-
-
-def main(param_file=None, mefis_file=None):
-    """Invoke GUI application."""
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
-
-    app = QtGui.QApplication(sys.argv)
-    window = MainWindow(param_file, mefis_file)
-
     logging.basicConfig(level=logging.INFO)
-
-    window.show()
-    return app.exec_()
+    downloader = Downloader(report=print_event, folder=output)
+    try:
+        if mock:
+            from mock_beamoptikdll import MockBeamOptikDLL
+            dll = MockBeamOptikDLL()
+        params = read_params(params)
+        mefis = read_mefis(mefis)
+        downloader.load_dll(dll)
+        downloader.download(params, mefis, refresh, adaptive)
+    except KeyboardInterrupt:
+        print_event({'event': 'error', 'error': 'interrupted'})
+        return 130
+    except Exception as e:
+        logging.exception('Download failed')
+        print_event({'event': 'error', 'error': '{}: {}'.format(
+            type(e).__name__, e)})
+        return 1
+    return 0
+
+
+def main(*args):
+    """Run the download command, or invoke the GUI application."""
+    if args and args[0] == 'download':
+        return download(**parse_args(args[1:]))
+    from download_gui import main as gui_main
+    return gui_main(*args)
 
 
 if __name__ == '__main__':
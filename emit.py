@@ -0,0 +1,86 @@
+# encoding: utf-8
+"""
+Common entry point for the evaluation scripts.
+
+Usage:
+
+    emit.py parse <DATA_FOLDER> [options]
+    emit.py calc <DATA_FOLDER> <MADX_MODEL_FILE> <MADX_SEQUENCE_NAME> [<OUTPUT_FILE>] [options]
+    emit.py plot [<RESULTS_FILE>] [options]
+    emit.py download [options]
+    emit.py extract <DVM_PARAMETER_CSV>
+
+Commands:
+
+    parse       update the index of the device exports (export_index.py)
+    calc        calculate the emittances (calc_emit.py)
+    plot        plot the results (plot_emit.py)
+    download    download the magnet strengths without GUI
+                (download_settings.py download)
+    extract     list the MAD-X relevant parameters of the DVM parameter
+                export (extract_params.py)
+
+Use ``emit.py <COMMAND> --help`` for the options of a command. The modules
+of a command, and with them cpymad, matplotlib or Qt, are imported only when
+the command is run, so that e.g. ``emit.py parse`` starts quickly.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+
+def parse(args):
+    from export_index import main, parse_args
+    return main(**parse_args(args))
+
+
+def calc(args):
+    from calc_emit import main, parse_args
+    return main(**parse_args(args))
+
+
+def plot(args):
+    from plot_emit import main, parse_args
+    return main(**parse_args(args))
+
+
+def download(args):
+    from download_settings import main
+    return main('download', *args)
+
+
+def extract(args):
+    from extract_params import extract
+    if len(args) != 1:
+        print("Usage: emit.py extract <DVM_PARAMETER_CSV>", file=sys.stderr)
+        return 2
+    return extract(*args)
+
+
+COMMANDS = {
+    'parse': parse,
+    'calc': calc,
+    'plot': plot,
+    'download': download,
+    'extract': extract,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] in (['-h'], ['--help']):
+        print(__doc__.strip())
+        return 0
+    if not argv or argv[0] not in COMMANDS:
+        print(__doc__.strip(), file=sys.stderr)
+        return 2
+    command, args = argv[0], argv[1:]
+    # show the command in the usage messages of the argument parsers:
+    sys.argv[0] = '{} {}'.format(os.path.basename(sys.argv[0]), command)
+    return COMMANDS[command](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
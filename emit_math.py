@@ -7,6 +7,8 @@ the corresponding transfer maps.
 from __future__ import unicode_literals
 
 from math import sqrt
+import itertools
+import warnings
 import numpy as np
 
 nan = float("nan")
@@ -98,6 +100,313 @@ def calc_emit(records,
     }
 
 
+def calc_emit_batch(envelopes,
+                    transfer_maps,
+                    calc_long=True,
+                    calc_4D=False,
+                    envelope_errors=None):
+    """
+    Calculate emittances for many settings at once.
+
+    This is equivalent to calling :func:`calc_emit` (without dispersion) for
+    every setting, but all systems are set up and solved in a single
+    vectorized pass.
+
+    :param envelopes:       array of shape (n_settings, n_monitors, 2) with
+                            the measured beam envelopes (envx, envy)
+    :param transfer_maps:   array of shape (n_settings, n_monitors, 7, 7)
+                            with the transfer maps between the monitors
+    :param bool calc_long:  use the sectormaps from the start of the sequence.
+    :param bool calc_4D:    calculate with 4D sectormap, rather than 2*2D
+    :param envelope_errors: standard errors of the envelopes, same shape as
+                            ``envelopes``. Where not given (or NaN), the
+                            error is estimated from the fit residuals.
+    :returns:   dict of arrays with shape (n_settings,). Keys 'ex', 'ey',
+                'betx', 'bety', 'alfx', 'alfy', 'pt' as for :func:`calc_emit`
+                plus their standard errors 'dex', 'dey', 'dbetx', 'dbety',
+                'dalfx', 'dalfy' and the fit diagnostics: 'res_x', 'res_y'
+                (sum of squared residuals), 'rank_x', 'rank_y' (rank of the
+                system) and the flags 'coupled', 'dispersive'. In 4D mode
+                both planes are solved together and share the same
+                diagnostics.
+    """
+    envelopes = np.asarray(envelopes, dtype=float)
+    assert envelopes.ndim == 3 and envelopes.shape[2] == 2
+    assert envelopes.shape[1] >= 3
+    tms = _accumulate_batch(transfer_maps, calc_long)
+    assert tms.shape[:2] == envelopes.shape[:2]
+
+    coup_xy = ~np.all(np.isclose(tms[:,:,0:2,2:4], 0), axis=(1,2,3))
+    coup_yx = ~np.all(np.isclose(tms[:,:,2:4,0:2], 0), axis=(1,2,3))
+    coup_xt = ~np.all(np.isclose(tms[:,:,0:2,5:6], 0), axis=(1,2,3))
+    coup_yt = ~np.all(np.isclose(tms[:,:,2:4,5:6], 0), axis=(1,2,3))
+
+    if envelope_errors is None:
+        envelope_errors = np.full(envelopes.shape, nan)
+    # error of the squared envelopes:
+    var_sq = (2 * envelopes * np.asarray(envelope_errors, dtype=float))**2
+
+    results = {
+        'coupled': coup_xy | coup_yx,
+        'dispersive': coup_xt | coup_yt,
+    }
+    systems = _emit_systems(tms, calc_4D)
+    for system in systems:
+        lhs, pinv, rank = system['lhs'], system['pinv'], system['rank']
+        rhs = _emit_rhs(envelopes**2, system['cols'])
+        x0 = np.einsum('skm,sm->sk', pinv, rhs)
+        residuals = ((np.einsum('smk,sk->sm', lhs, x0) - rhs)**2).sum(axis=1)
+        # covariance of the solution, using the residual variance where
+        # no measurement errors are available:
+        dof = rhs.shape[1] - rank
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var_res = np.where(dof > 0, residuals / dof, nan)
+        var_rhs = _emit_rhs(var_sq, system['cols'])
+        var_rhs = np.where(np.isnan(var_rhs), var_res[:,None], var_rhs)
+        cov = np.einsum('skm,sm,slm->skl', pinv, var_rhs, pinv)
+        for plane, index in system['planes']:
+            twiss = _twiss_from_entries(x0[:,index])
+            errors = _twiss_errors(x0[:,index], cov[:,index][:,:,index])
+            for i, name in enumerate(('e', 'bet', 'alf')):
+                results[name + plane] = twiss[i]
+                results['d' + name + plane] = errors[i]
+            results['res_' + plane] = residuals
+            results['rank_' + plane] = rank
+        # last entry is sigma[-1,-1]. pt only valid if use_dispersion=True,
+        # which is not supported here:
+        results.setdefault('pt', x0[:,-1])
+    return results
+
+
+def bootstrap_emit(shots,
+                   transfer_maps,
+                   num_samples=1000,
+                   calc_long=True,
+                   calc_4D=False,
+                   seed=None,
+                   max_elements=1<<24,
+                   min_shots=2):
+    """
+    Estimate the standard errors of the emittances and Twiss parameters by
+    resampling the individual shots of every monitor.
+
+    The errors are NaN for settings where any monitor has fewer than
+    ``min_shots`` shots, since resampling a single shot does not vary.
+
+    The resampled systems share their transfer maps with the original
+    systems, so all resamples are solved together using the precomputed
+    pseudo-inverses.
+
+    :param shots:           array of shape (n_settings, n_monitors, n_shots,
+                            2) with the individual envelopes (envx, envy).
+                            Unused entries (for monitors with fewer shots)
+                            must be NaN.
+    :param transfer_maps:   array of shape (n_settings, n_monitors, 7, 7)
+    :param int num_samples: number of bootstrap samples
+    :param bool calc_long:  use the sectormaps from the start of the sequence.
+    :param bool calc_4D:    calculate with 4D sectormap, rather than 2*2D
+    :param seed:            seed for the random number generator
+    :param int max_elements: limits the size of the temporary arrays by
+                            processing the settings in chunks
+    :param int min_shots:   minimum number of shots per monitor
+    :returns:   dict of arrays with shape (n_settings,) with keys 'dex',
+                'dey', 'dbetx', 'dbety', 'dalfx', 'dalfy'
+    """
+    shots = np.asarray(shots, dtype=float)
+    # move the valid shots to the front:
+    order = np.argsort(np.isnan(shots[...,0]), axis=-1, kind='mergesort')
+    shots = np.take_along_axis(shots, order[...,None], axis=2)
+    counts = (~np.isnan(shots[...,0])).sum(axis=-1)
+    n_set, n_mon, n_shots = shots.shape[:3]
+
+    systems = _emit_systems(
+        _accumulate_batch(transfer_maps, calc_long), calc_4D)
+    rng = np.random.RandomState(seed)
+    chunk = max(1, max_elements // (num_samples * n_mon * n_shots * 2))
+    results = {}
+    for start in range(0, n_set, chunk):
+        sel = slice(start, start + chunk)
+        num = counts[sel]
+        # draw ``count`` shots with replacement for every monitor:
+        idx = rng.random_sample((num_samples,) + shots[sel].shape[:3])
+        idx = (idx * num[...,None]).astype(int)
+        samples = shots[sel][
+            np.arange(idx.shape[1])[:,None,None],
+            np.arange(n_mon)[:,None],
+            idx]
+        valid = np.arange(n_shots) < num[...,None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            env = np.where(valid[...,None], samples, 0).sum(axis=3)
+            env /= num[...,None]
+        for system in systems:
+            rhs = _emit_rhs(env**2, system['cols'])
+            x0 = np.einsum('skm,bsm->bsk', system['pinv'][sel], rhs)
+            for plane, index in system['planes']:
+                twiss = _twiss_from_entries(x0[...,index])
+                for i, name in enumerate(('e', 'bet', 'alf')):
+                    with warnings.catch_warnings():
+                        # all-NaN slices for unsolvable settings:
+                        warnings.simplefilter('ignore', RuntimeWarning)
+                        err = np.nanstd(twiss[i], axis=0, ddof=1)
+                    results.setdefault('d' + name + plane, []).append(err)
+    too_few = (counts < min_shots).any(axis=1)
+    return {key: np.where(too_few, nan, np.concatenate(val))
+            for key, val in results.items()}
+
+
+def rank_monitor_subsets(envelopes,
+                         transfer_maps,
+                         calc_long=True,
+                         envelope_errors=None,
+                         min_size=3):
+    """
+    Solve the (2*2D) emittance systems for every subset of at least
+    ``min_size`` monitors in one batched computation and rank the subsets.
+
+    The score of a subset is the larger condition number of the x and y
+    systems, multiplied by the reduced chi² of the fit where it exceeds one.
+    The chi² is only known for overdetermined subsets with known envelope
+    errors. Exactly determined subsets fit any envelopes without residual,
+    so if a setting has overdetermined subsets with known chi², only these
+    are ranked. Otherwise, all subsets are ranked by their condition number.
+    Subsets without a valid emittance in both planes (or not ranked) get an
+    infinite score.
+
+    :param envelopes:       array of shape (n_settings, n_monitors, 2)
+    :param transfer_maps:   array of shape (n_settings, n_monitors, 7, 7)
+    :param bool calc_long:  use the sectormaps from the start of the sequence.
+    :param envelope_errors: standard errors of the envelopes, same shape as
+                            ``envelopes``
+    :param int min_size:    minimum number of monitors per subset
+    :returns:   dict with the list 'subsets' of tuples of monitor indices,
+                arrays of shape (n_settings, n_subsets) 'cond', 'chi2',
+                'ex', 'ey' and 'score', and arrays of shape (n_settings,)
+                'best' (index of the best subset, -1 if no subset is
+                valid) and 'loo_ex', 'loo_ey' (largest relative change of
+                the emittance of all monitors if a single monitor is left
+                out, NaN if there are not enough monitors).
+    """
+    envelopes = np.asarray(envelopes, dtype=float)
+    num_settings, num_monitors = envelopes.shape[:2]
+    assert num_monitors >= min_size >= 3
+    tms = _accumulate_batch(transfer_maps, calc_long)
+    if envelope_errors is None:
+        envelope_errors = np.full(envelopes.shape, nan)
+    env_sq = envelopes**2
+    var_sq = (2 * envelopes * np.asarray(envelope_errors, dtype=float))**2
+
+    subsets = [subset
+               for size in range(min_size, num_monitors+1)
+               for subset in itertools.combinations(range(num_monitors), size)]
+    shape = (num_settings, len(subsets))
+    results = {key: np.full(shape, nan) for key in ('ex', 'ey', 'chi2')}
+    results['cond'] = np.zeros(shape)
+    index = _plane_index(2, 0)
+    begin = 0
+    for size in range(min_size, num_monitors+1):
+        members = np.array([s for s in subsets if len(s) == size])
+        part = slice(begin, begin + len(members))
+        begin += len(members)
+        for plane, Ms, col in [('x', tms[:,:,0:2,0:2], 0),
+                               ('y', tms[:,:,2:4,2:4], 1)]:
+            lhs = _design_matrix_batch(Ms, [0])[:,members]
+            lhs = lhs.reshape((-1, size, lhs.shape[-1]))
+            rhs = env_sq[:,members,col].reshape((-1, size))
+            var = var_sq[:,members,col].reshape((-1, size))
+            pinv, rank = _pinv_batch(lhs)
+            x0 = np.einsum('skm,sm->sk', pinv, rhs)
+            residuals = np.einsum('smk,sk->sm', lhs, x0) - rhs
+            sv = np.linalg.svd(lhs, compute_uv=False)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cond = np.where(rank == sv.shape[1],
+                                sv[:,0] / sv[:,-1], np.inf)
+                chi2 = ((residuals**2 / var).sum(axis=1) / (size - rank)
+                        if size > 3 else np.full(len(rhs), nan))
+            emit = _twiss_from_entries(x0[:,index])[0]
+            results['e' + plane][:,part] = emit.reshape((num_settings, -1))
+            results['cond'][:,part] = np.maximum(
+                results['cond'][:,part], cond.reshape((num_settings, -1)))
+            results['chi2'][:,part] = np.fmax(
+                results['chi2'][:,part], chi2.reshape((num_settings, -1)))
+
+    valid = ~np.isnan(results['ex']) & ~np.isnan(results['ey'])
+    # a chi² of (at most) one must not favour the exactly determined
+    # subsets, which have no chi² at all:
+    tested = valid & ~np.isnan(results['chi2'])
+    ranked = np.where(tested.any(axis=1)[:,None], tested, valid)
+    penalty = np.where(np.isnan(results['chi2']), 1,
+                       np.maximum(results['chi2'], 1))
+    results['score'] = np.where(ranked, results['cond'] * penalty, np.inf)
+    results['best'] = np.where(ranked.any(axis=1),
+                               np.argmin(results['score'], axis=1), -1)
+    results['subsets'] = subsets
+
+    # leave-one-out: subsets of size n-1 relative to the last (full) subset
+    loo = [i for i, s in enumerate(subsets) if len(s) == num_monitors - 1]
+    for key in ('ex', 'ey'):
+        full = results[key][:,-1:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = np.abs(results[key][:,loo] - full) / full
+        change = np.where(np.isnan(change) & ~np.isnan(full), np.inf, change)
+        results['loo_' + key] = (change.max(axis=1) if loo else
+                                 np.full(num_settings, nan))
+    return results
+
+
+def _accumulate_batch(transfer_maps, calc_long):
+    """Return the transfer maps from the start to the individual monitors."""
+    tms = np.array(transfer_maps, dtype=float)
+    if not calc_long:
+        tms[:,0] = np.eye(7)
+    for i in range(1, tms.shape[1]):
+        tms[:,i] = np.matmul(tms[:,i], tms[:,i-1])
+    return tms
+
+
+def _emit_systems(tms, calc_4D):
+    """
+    Set up the least squares systems for the accumulated transfer maps.
+
+    Returns a list of dicts with the design matrices 'lhs', their
+    pseudo-inverses 'pinv' and ranks 'rank', the envelope columns 'cols'
+    that enter the RHS, and a list 'planes' of ``(plane, index)`` where
+    index selects the entries (S11, S12, S22) of the plane from the solution
+    vector.
+    """
+    if calc_4D:
+        layout = [(tms[:,:,0:4,0:4], [0, 2], [0, 1], [('x', 0), ('y', 2)])]
+    else:
+        layout = [(tms[:,:,0:2,0:2], [0], [0], [('x', 0)]),
+                  (tms[:,:,2:4,2:4], [0], [1], [('y', 0)])]
+    systems = []
+    for Ms, rows, cols, planes in layout:
+        lhs = _design_matrix_batch(Ms, rows)
+        pinv, rank = _pinv_batch(lhs)
+        systems.append({
+            'lhs': lhs,
+            'pinv': pinv,
+            'rank': rank,
+            'cols': cols,
+            'planes': [(plane, _plane_index(Ms.shape[-1], offset))
+                       for plane, offset in planes],
+        })
+    return systems
+
+
+def _emit_rhs(env_sq, cols):
+    """Arrange squared envelopes (..., n_monitors, 2) as RHS vectors."""
+    rhs = env_sq[...,cols]
+    return rhs.reshape(rhs.shape[:-2] + (-1,))
+
+
+def _plane_index(d, offset):
+    """Indices of (S11, S12, S22) of the 2x2 block at offset in the
+    solution vector of :func:`_design_matrix_batch`."""
+    I, J, W = _ut_index_table(d)
+    pairs = list(zip(I, J))
+    return [pairs.index((offset+i, offset+j)) for i, j in [(0,0), (0,1), (1,1)]]
+
+
 def accumulate(iterable, func):
     """Return running totals."""
     # Stolen from:
@@ -130,11 +439,7 @@ def solve_emit_sys(Ms, XCs):
         for x, _ in xc                      # and measured constraint
     ]
 
-    sq_matrix_basis = np.eye(d*d,d*d).reshape((d*d,d,d))
-    is_upper_triang = [i for i, m in enumerate(sq_matrix_basis)
-                       if np.allclose(np.triu(m), m)
-                       and (d < 4 or np.allclose(m[0:2,2:4], 0))]
-    ut_matrix_basis = sq_matrix_basis[is_upper_triang]
+    ut_matrix_basis = _ut_matrix_basis(d)
 
     lhs = np.vstack([
         con_func(2*u-np.tril(u))    # double weight for off-diagonal entries
@@ -149,6 +454,98 @@ def solve_emit_sys(Ms, XCs):
     return res, sum(residuals), (rank<len(x0))
 
 
+def _ut_matrix_basis(d, _cache={}):
+    """
+    Return the basis of upper triangular d×d matrices that span the sigma
+    matrix (without x-y coupling block for d=4). Cached by dimension.
+    """
+    if d not in _cache:
+        sq_matrix_basis = np.eye(d*d,d*d).reshape((d*d,d,d))
+        is_upper_triang = [i for i, m in enumerate(sq_matrix_basis)
+                           if np.allclose(np.triu(m), m)
+                           and (d < 4 or np.allclose(m[0:2,2:4], 0))]
+        _cache[d] = sq_matrix_basis[is_upper_triang]
+    return _cache[d]
+
+
+def _ut_index_table(d, _cache={}):
+    """
+    Return index arrays ``(I, J, W)`` for the entries of the sigma matrix that
+    correspond to :func:`_ut_matrix_basis`, with W the weight (1 on the
+    diagonal, 2 for off-diagonal entries). Cached by dimension.
+    """
+    if d not in _cache:
+        I, J = np.nonzero(_ut_matrix_basis(d))[1:]
+        _cache[d] = I, J, np.where(I == J, 1.0, 2.0)
+    return _cache[d]
+
+
+def _design_matrix_batch(Ms, rows):
+    """
+    Build the design matrices for the stacked transfer matrices ``Ms`` of
+    shape (n_settings, n_monitors, d, d) and the constrained rows (e.g.
+    ``[0, 2]`` for x and y in 4D). Returns an array of shape (n_settings,
+    n_monitors*len(rows), n_unknowns).
+    """
+    d = Ms.shape[-1]
+    I, J, W = _ut_index_table(d)
+    Mx = Ms[:,:,rows,:]
+    outer = np.einsum('smci,smcj->smcij', Mx, Mx)
+    lhs = outer[..., I, J] * W
+    return lhs.reshape((Ms.shape[0], -1, len(I)))
+
+
+def _pinv_batch(A):
+    """
+    Pseudo-inverse and rank of a stack of matrices. Singular values below
+    machine precision (relative to the largest one) are treated as zero,
+    consistent with ``np.linalg.lstsq(..., rcond=-1)``.
+    """
+    U, s, Vt = np.linalg.svd(A, full_matrices=False)
+    cutoff = np.finfo(float).eps * s[:,:1]
+    nonzero = s > cutoff
+    s_inv = np.where(nonzero, 1/np.where(nonzero, s, 1), 0)
+    pinv = np.einsum('ski,sk,smk->sim', Vt, s_inv, U)
+    return pinv, nonzero.sum(axis=1)
+
+
+def twiss_from_sigma_batch(sigma):
+    """Compute 1D twiss parameters from a stack of 2x2 sigma matrices."""
+    sigma = np.asarray(sigma)
+    entries = np.stack([sigma[...,0,0], sigma[...,0,1], sigma[...,1,1]], -1)
+    return _twiss_from_entries(entries)
+
+
+def _twiss_from_entries(entries):
+    """Compute 1D twiss parameters from a stack of (S11, S12, S22)."""
+    b, a, c = entries[...,0], entries[...,1], entries[...,2]
+    det = b*c - a*a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        emit = np.sqrt(np.where(det > 0, det, nan))
+        beta = b/emit
+        alfa = a/emit * (-1)
+    return emit, beta, alfa
+
+
+def _twiss_errors(entries, cov):
+    """
+    Propagate the covariance (..., 3, 3) of (S11, S12, S22) to the standard
+    errors of the twiss parameters (emit, beta, alfa) by linearization.
+    """
+    b, a, c = entries[...,0], entries[...,1], entries[...,2]
+    emit = _twiss_from_entries(entries)[0]
+    zero = np.zeros_like(emit)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        d_emit = np.stack([c/(2*emit), -a/emit, b/(2*emit)], -1)
+        d_beta = (np.stack([1/emit, zero, zero], -1)
+                  - (b/emit**2)[...,None] * d_emit)
+        d_alfa = (np.stack([zero, -1/emit, zero], -1)
+                  + (a/emit**2)[...,None] * d_emit)
+        jac = np.stack([d_emit, d_beta, d_alfa], -2)
+        var = np.einsum('...ij,...jk,...ik->...i', jac, cov, jac)
+    return tuple(np.moveaxis(np.sqrt(var), -1, 0))
+
+
 def twiss_from_sigma(sigma):
     """Compute 1D twiss parameters from 2x2 sigma matrix."""
     # S = [[b a], [a c]]
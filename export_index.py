@@ -0,0 +1,288 @@
+# encoding: utf-8
+"""
+Persistent index of the parsed summaries of all device exports in a
+measurement folder.
+
+The index is a SQLite database keyed by the path of the file relative to the
+measurement folder. Files are only parsed again if their size or
+modification time changed. Files that can not be used for the evaluation
+are kept in the index together with the reason for skipping them. Beam
+widths computed from the raw profiles are cached in the index as well.
+
+By default, the index is kept in the user's cache folder (one file per
+measurement folder), so that nothing is written into the measurement data.
+
+Usage:
+
+    export_index.py <DATA_FOLDER> [--index FILE] [--jobs N] [--verbose]
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+
+import os
+import sys
+import sqlite3
+import hashlib
+import argparse
+
+from device_export import parse_device_export
+
+
+# Name of the index file that older versions wrote into the measurement
+# folder, ignored when scanning the folder:
+INDEX_FILENAME = '.calc_emit_index.sqlite'
+
+
+def cache_folder():
+    """Return the folder for the default index files."""
+    base = (os.environ.get('XDG_CACHE_HOME') or
+            os.environ.get('LOCALAPPDATA') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'calc_emit')
+
+
+def default_index(data_folder):
+    """
+    Return the default index file of the measurement folder, a file in the
+    :func:`cache_folder` named after the absolute path of the folder.
+    """
+    path = os.path.abspath(data_folder)
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(cache_folder(), 'index-{}.sqlite'.format(digest[:16]))
+
+FIELDS = ('device', 'vacc', 'energy', 'focus', 'intensity', 'gantry',
+          'tint', 'posx', 'posy', 'envx', 'envy')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS exports (
+    path        TEXT PRIMARY KEY,
+    size        INTEGER,
+    mtime       REAL,
+    device      TEXT,
+    vacc        INTEGER,
+    energy      INTEGER,
+    focus       INTEGER,
+    intensity   INTEGER,
+    gantry      INTEGER,
+    tint        REAL,
+    posx        REAL,
+    posy        REAL,
+    envx        REAL,
+    envy        REAL,
+    skipped     TEXT
+)
+'''
+
+WIDTHS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS widths (
+    path        TEXT,
+    method      TEXT,
+    size        INTEGER,
+    mtime       REAL,
+    envx        REAL,
+    envy        REAL,
+    error       TEXT,
+    PRIMARY KEY (path, method)
+)
+'''
+
+
+def skip_reason(data):
+    """Return why the parsed export can not be used, or ``None``."""
+    # NOTE: the control system exports -9999 for failed measurements, which
+    # ends up as negative envelope after unit conversion:
+    if data['envx'] < 0 or data['envy'] < 0:
+        return 'invalid envelope (-9999)'
+    return None
+
+
+def parse_entry(filename):
+    """Parse an export file. Returns ``(data, reason)``."""
+    try:
+        data = parse_device_export(filename)
+    except Exception as e:
+        return None, 'parse error: {}'.format(e)
+    return data, skip_reason(data)
+
+
+class ExportIndex(object):
+
+    """
+    Index of the device exports in a measurement folder.
+
+    :param str filename: SQLite database file, created (including its
+                         folder) if necessary
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        folder = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.db = sqlite3.connect(filename)
+        self.db.execute(SCHEMA)
+        self.db.execute(WIDTHS_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, folder, jobs=1):
+        """
+        Scan the folder and parse new or changed files in a thread pool.
+        Entries of deleted files are removed from the index.
+
+        :returns: number of parsed files
+        """
+        known = {path: (size, mtime) for path, size, mtime in
+                 self.db.execute('SELECT path, size, mtime FROM exports')}
+        found = {}
+        ignore = os.path.abspath(self.filename)
+        for dirpath, dirnames, filenames in os.walk(folder):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if (os.path.abspath(path).startswith(ignore) or
+                        filename.startswith(INDEX_FILENAME)):
+                    continue    # database and journal files
+                stat = os.stat(path)
+                found[os.path.relpath(path, folder)] = (
+                    stat.st_size, stat.st_mtime)
+
+        changed = sorted(path for path, stat in found.items()
+                         if known.get(path) != stat)
+        paths = [os.path.join(folder, path) for path in changed]
+        if jobs > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(jobs)
+            try:
+                parsed = pool.map(parse_entry, paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            parsed = [parse_entry(path) for path in paths]
+
+        with self.db:
+            deleted = [(path,) for path in set(known) - set(found)]
+            self.db.executemany('DELETE FROM exports WHERE path=?', deleted)
+            self.db.executemany('DELETE FROM widths WHERE path=?', deleted)
+            self.db.executemany(
+                'INSERT OR REPLACE INTO exports VALUES ({})'.format(
+                    ', '.join(['?'] * (len(FIELDS) + 4))), [
+                    (path,) + found[path] + _flatten(data) + (reason,)
+                    for path, (data, reason) in zip(changed, parsed)
+                ])
+        return len(changed)
+
+    def records(self):
+        """
+        Return the parsed data of all usable exports, sorted by path. The
+        key 'path' holds the path relative to the measurement folder.
+        """
+        return [
+            {
+                'path': row[0],
+                'device': row[1],
+                'mefi': tuple(row[2:7]),
+                'tint': row[7],
+                'posx': row[8],
+                'posy': row[9],
+                'envx': row[10],
+                'envy': row[11],
+            }
+            for row in self.db.execute(
+                'SELECT path, {} FROM exports WHERE skipped IS NULL '
+                'ORDER BY path'.format(', '.join(FIELDS)))
+        ]
+
+    def widths(self, folder, paths, method, columns, jobs=1):
+        """
+        Return the beam widths computed from the raw profiles of the given
+        exports, see :func:`profiles.profile_widths`. The widths are cached
+        and only computed again if the size or modification time of a file
+        changed since.
+
+        :param list paths: paths relative to the measurement folder, must
+                           be contained in the index
+        :returns: list of ``(envx, envy, error)``, see
+                  :func:`profiles.profile_widths`
+        """
+        # needs numpy, imported here to keep the startup fast:
+        from profiles import profile_widths, PROFILE_KEYS
+        # the cached widths depend on method and column layout:
+        variant = '{}:{}'.format(
+            method, ','.join(str(columns[key]) for key in PROFILE_KEYS))
+        cached = {
+            row[0]: row[1:] for row in self.db.execute(
+                'SELECT w.path, w.envx, w.envy, w.error FROM widths w '
+                'JOIN exports e ON w.path=e.path '
+                'AND w.size=e.size AND w.mtime=e.mtime '
+                'WHERE w.method=?', (variant,))
+        }
+        missing = sorted(set(paths) - set(cached))
+        if missing:
+            stats = {path: (size, mtime) for path, size, mtime in
+                     self.db.execute('SELECT path, size, mtime FROM exports')}
+            envx, envy, errors = profile_widths(
+                [os.path.join(folder, path) for path in missing],
+                columns, method, jobs)
+            computed = list(zip(missing, envx.tolist(), envy.tolist(),
+                                errors))
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO widths VALUES (?,?,?,?,?,?,?)', [
+                        (path, variant) + stats[path] + (x, y, error)
+                        for path, x, y, error in computed
+                    ])
+            cached.update((path, (x, y, error))
+                          for path, x, y, error in computed)
+        # NaN is stored as NULL:
+        nan = float('nan')
+        return [(nan if x is None else x, nan if y is None else y, error)
+                for x, y, error in (cached[path] for path in paths)]
+
+    def skipped(self):
+        """Return list of ``(path, reason)`` for all skipped files."""
+        return list(self.db.execute(
+            'SELECT path, skipped FROM exports '
+            'WHERE skipped IS NOT NULL ORDER BY path'))
+
+
+def _flatten(data):
+    if data is None:
+        return (None,) * len(FIELDS)
+    return ((data['device'],) + tuple(data['mefi']) +
+            tuple(data[key] for key in FIELDS[6:]))
+
+
+def main(data_folder, index=None, jobs=1, verbose=False):
+    index = ExportIndex(index or default_index(data_folder))
+    try:
+        num_parsed = index.update(data_folder, jobs)
+        num_records = len(index.records())
+        skipped = index.skipped()
+    finally:
+        index.close()
+    print("Parsed {} new or changed files, {} usable exports, skipping {}"
+          " files".format(num_parsed, num_records, len(skipped)))
+    if verbose:
+        for path, reason in skipped:
+            print("  {}: {}".format(path, reason))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Update the index of the device exports.")
+    parser.add_argument('data_folder')
+    parser.add_argument('--index', metavar='FILE',
+                        help="index file [default: in {}]"
+                        .format(cache_folder()))
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                        help="number of parser threads")
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help="list the skipped files")
+    return vars(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main(**parse_args()))
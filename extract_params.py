@@ -29,7 +29,7 @@ def extract(filename):
         'day',
     )
 
-    with open(sys.argv[1]) as f:
+    with open(filename) as f:
 
         for line in f:
             param = line.split(';')[1]
@@ -0,0 +1,467 @@
+# encoding: utf-8
+"""
+Linear transfer maps computed directly with numpy, as alternative to the
+MAD-X sectormap.
+
+The element list of a sequence is extracted from MAD-X once, keeping the
+(deferred) expressions of the element attributes. The 7×7 transfer maps
+(the last column contains the kicks) are then computed for many strength
+settings at once, by evaluating the expressions for all settings as numpy
+arrays and multiplying the element maps cumulatively.
+
+Only drifts, quadrupoles, sector bends, kickers and solenoids (as well as
+zero-strength or passive elements, e.g. monitors and markers) are
+supported. Expressions may not refer to element attributes (``q1->l``) or
+to undefined variables. The results should be checked against MAD-X with
+:func:`max_deviation` before use.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+
+import re
+import numbers
+
+import numpy as np
+
+
+class UnsupportedModel(ValueError):
+    """Raised if the model or strengths can not be handled by the engine."""
+
+
+# element types that act as drift:
+DRIFT_TYPES = (
+    'drift', 'marker', 'monitor', 'hmonitor', 'vmonitor', 'instrument',
+    'placeholder', 'collimator', 'ecollimator', 'rcollimator',
+)
+
+# attributes used for the map of each supported element type:
+ELEMENT_ATTRIBUTES = {
+    'quadrupole': ('k1', 'k1s', 'tilt'),
+    'sbend': ('angle', 'k1', 'e1', 'e2', 'fint', 'fintx', 'hgap', 'tilt'),
+    'hkicker': ('kick',),
+    'vkicker': ('kick',),
+    'kicker': ('hkick', 'vkick'),
+    'tkicker': ('hkick', 'vkick'),
+    'solenoid': ('ks',),
+}
+
+# MAD-X functions available in expressions:
+FUNCTIONS = {
+    'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log, 'log10': np.log10,
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+    'asin': np.arcsin, 'acos': np.arccos, 'atan': np.arctan,
+    'sinh': np.sinh, 'cosh': np.cosh, 'tanh': np.tanh,
+    'abs': np.abs, 'floor': np.floor, 'ceil': np.ceil, 'round': np.round,
+}
+
+_TOKEN = re.compile(r'''
+    (?P<number> (\d+\.?\d*|\.\d+)([ed][-+]?\d+)?)
+  | (?P<name>   [a-z_][\w.]*(->[a-z_]\w*)?)
+  | (?P<op>     [-+*/^(),])
+  | (?P<space>  \s+)
+''', re.X | re.I)
+
+
+def compile_expression(expr):
+    """
+    Translate a MAD-X expression into python code that looks up variables
+    via ``_var(name)`` and functions via ``_fun[name]``.
+
+    :raises UnsupportedModel: for unknown syntax
+    """
+    code = []
+    pos = 0
+    while pos < len(expr):
+        match = _TOKEN.match(expr, pos)
+        if not match:
+            raise UnsupportedModel(
+                "Can not parse expression: {!r}".format(expr))
+        pos = match.end()
+        kind, text = match.lastgroup, match.group()
+        if kind == 'number':
+            code.append(re.sub('[dD]', 'e', text))
+        elif kind == 'name':
+            text = text.lower()
+            if text in FUNCTIONS and expr[pos:].lstrip().startswith('('):
+                code.append('_fun[{!r}]'.format(text))
+            else:
+                code.append('_var({!r})'.format(text))
+        elif kind == 'op':
+            code.append('**' if text == '^' else text)
+    return compile(' '.join(code) or '0', '<madx>', 'eval')
+
+
+def expression_names(expr):
+    """Return the variable names used in a MAD-X expression (or number)."""
+    if expr is None or isinstance(expr, numbers.Number):
+        return set()
+    return set(
+        match.group('name').lower()
+        for match in _TOKEN.finditer(expr)
+        if match.group('name') and not (
+            match.group('name').lower() in FUNCTIONS and
+            expr[match.end():].lstrip().startswith('(')))
+
+
+def assignment_matrix(settings):
+    """
+    Convert a list of ``[(name, value)]`` assignments per setting to a
+    matrix.
+
+    :returns: ``(names, values)`` where values has the shape
+              (len(settings), len(names)), NaN where a variable is not
+              assigned
+    :raises UnsupportedModel: for non-numeric assignments
+    """
+    names = sorted(set(name.lower() for s in settings for name, _ in s))
+    column = {name: j for j, name in enumerate(names)}
+    values = np.full((len(settings), len(names)), np.nan)
+    for i, assignments in enumerate(settings):
+        for name, value in assignments:
+            try:
+                values[i, column[name.lower()]] = float(value)
+            except ValueError:
+                raise UnsupportedModel(
+                    "Non-numeric assignment: {} = {}".format(name, value))
+    return names, values
+
+
+class Expressions(object):
+
+    """
+    Evaluates MAD-X expressions for many settings at once.
+
+    :param dict definitions: ``{name: value or expression}`` of the model
+    :param list names: names of the assigned variables
+    :param values: array of shape (n_settings, len(names)) with the values
+                   overriding the model definitions, or NaN to keep the
+                   definition, see :func:`assignment_matrix`
+    """
+
+    def __init__(self, definitions, names, values):
+        self.definitions = {k.lower(): v for k, v in definitions.items()}
+        values = np.asarray(values, dtype=float)
+        self.num = values.shape[0]
+        self.overrides = {name.lower(): values[:,j]
+                          for j, name in enumerate(names)}
+        self._values = {}
+        self._code = {}
+
+    def var(self, name):
+        """
+        Return the value of a variable as array over all settings.
+
+        :raises UnsupportedModel: for element attributes (``elem->attr``)
+                                  and for variables that are neither defined
+                                  in the model nor assigned in every setting
+        """
+        if name not in self._values:
+            if '->' in name:
+                raise UnsupportedModel(
+                    "element attributes are not supported: {}".format(name))
+            override = self.overrides.get(name)
+            if name not in self.definitions and (
+                    override is None or np.any(np.isnan(override))):
+                raise UnsupportedModel(
+                    "undefined variable: {}".format(name))
+            # avoid infinite recursion for self-referencing definitions:
+            self._values[name] = np.zeros(self.num)
+            value = self.eval(self.definitions.get(name, 0.0))
+            if override is not None:
+                value = np.where(np.isnan(override), value, override)
+            self._values[name] = value
+        return self._values[name]
+
+    def eval(self, expr):
+        """Evaluate a number or expression for all settings."""
+        if expr is None:
+            expr = 0.0
+        if isinstance(expr, numbers.Number):
+            return np.full(self.num, float(expr))
+        if expr not in self._code:
+            self._code[expr] = compile_expression(expr)
+        value = eval(self._code[expr], {
+            '_var': self.var, '_fun': FUNCTIONS, '__builtins__': {},
+        })
+        return np.broadcast_to(np.asarray(value, dtype=float),
+                               (self.num,)).copy()
+
+
+class Element(object):
+
+    """Element of the beamline with attribute expressions."""
+
+    def __init__(self, name, type, length, attrs):
+        self.name = name
+        self.type = type
+        self.length = length
+        self.attrs = attrs      # {attr: value or expression}
+
+
+def extract_elements(madx, seq_name):
+    """
+    Return the list of :class:`Element` in the (expanded) sequence,
+    including the implicit drifts.
+
+    :raises UnsupportedModel: if an element type is not supported
+    """
+    sequence = madx.sequences[seq_name]
+    elements = []
+    for elem in sequence.expanded_elements:
+        type_ = elem.base_type.name
+        length = float(elem.length)
+        if type_ in DRIFT_TYPES:
+            attrs = {}
+            type_ = 'drift'
+        elif type_ in ELEMENT_ATTRIBUTES:
+            attrs = {}
+            for attr in ELEMENT_ATTRIBUTES[type_]:
+                par = elem.cmdpar[attr]
+                attrs[attr] = par.value if par.expr is None else par.expr
+        elif type_ == 'multipole' and not any(
+                any(elem.cmdpar[attr].value) or any(elem.cmdpar[attr].expr)
+                for attr in ('knl', 'ksl')):
+            attrs = {}
+            type_ = 'drift'
+        else:
+            raise UnsupportedModel(
+                "{}: element type {!r} is not supported"
+                .format(elem.name, type_))
+        elements.append(Element(elem.name, type_, length, attrs))
+    return elements
+
+
+class LinearOptics(object):
+
+    """
+    Linear optics of a sequence, for computing the sectormaps of many
+    strength settings at once.
+
+    :param madx: MAD-X instance with the model loaded
+    :param str seq_name: sequence name
+    :raises UnsupportedModel: if the sequence can not be handled
+    """
+
+    def __init__(self, madx, seq_name):
+        self.elements = extract_elements(madx, seq_name)
+        self.names = [elem.name for elem in self.elements]
+        beam = madx.sequences[seq_name].beam
+        self.beta = float(beam.beta)
+        self.gamma = float(beam.gamma)
+        self.definitions = {
+            name: madx.globals.defs[name] for name in madx.globals}
+
+    def variables(self, elem=None):
+        """
+        Return the names of all variables that the element maps up to (and
+        including) the given element depend on, directly or via other
+        variables.
+        """
+        stop = len(self.elements) if elem is None else \
+            self.names.index(elem.lower()) + 1
+        pending = set()
+        for element in self.elements[:stop]:
+            for expr in element.attrs.values():
+                pending |= expression_names(expr)
+        found = set()
+        while pending:
+            name = pending.pop()
+            found.add(name)
+            pending |= expression_names(
+                self.definitions.get(name)) - found
+        return found
+
+    def element_maps(self, strengths):
+        """
+        Compute the transfer maps of all elements for all settings.
+
+        :param list strengths: list of ``[(name, value)]`` per setting
+        :returns: array of shape (n_settings, n_elements, 7, 7)
+        """
+        expr = Expressions(self.definitions, *assignment_matrix(strengths))
+        return np.stack([self._element_map(elem, expr)
+                         for elem in self.elements], axis=1)
+
+    def sectormaps(self, elems, strengths):
+        """
+        Compute the transfer maps from the start of the sequence to the
+        first element, and between the subsequent elements, as returned by
+        MAD-X ``sectormap``.
+
+        :param list elems: element names, sorted by position
+        :param list strengths: list of ``[(name, value)]`` per setting
+        :returns: array of shape (n_settings, len(elems), 7, 7)
+        """
+        return self.transfer_maps(elems, *assignment_matrix(strengths))
+
+    def transfer_maps(self, elems, names, values):
+        """
+        Same as :meth:`sectormaps`, but with the strengths given as matrix,
+        see :func:`assignment_matrix`.
+        """
+        expr = Expressions(self.definitions, names, values)
+        stops = [self.names.index(el.lower()) for el in elems]
+        result = np.empty((expr.num, len(elems), 7, 7))
+        total = np.tile(np.eye(7), (expr.num, 1, 1))
+        start = 0
+        # element maps are computed on the fly to avoid keeping the full
+        # (n_settings, n_elements, 7, 7) array in memory:
+        for j, stop in enumerate(stops):
+            for elem in self.elements[start:stop+1]:
+                total = np.matmul(self._element_map(elem, expr), total)
+            result[:,j] = total
+            total = np.tile(np.eye(7), (expr.num, 1, 1))
+            start = stop + 1
+        return result
+
+    def _element_map(self, elem, expr):
+        attrs = {key: expr.eval(val) for key, val in elem.attrs.items()}
+        return element_map(elem.type, elem.length, attrs, expr.num,
+                           self.beta, self.gamma)
+
+
+def element_map(type_, length, attrs, num, beta, gamma):
+    """
+    Return the transfer maps of an element for ``num`` settings.
+
+    :param dict attrs: attribute values as arrays of shape (num,)
+    :returns: array of shape (num, 7, 7)
+    """
+    L = np.full(num, length)
+    if type_ == 'drift':
+        return drift_map(L, beta, gamma)
+    if type_ == 'quadrupole':
+        if np.any(attrs['k1s']):
+            raise UnsupportedModel("skew quadrupoles are not supported")
+        M = quadrupole_map(L, attrs['k1'], beta, gamma)
+        return _tilted(M, attrs['tilt'])
+    if type_ == 'sbend':
+        fintx = np.where(attrs['fintx'] < 0, attrs['fint'], attrs['fintx'])
+        h = np.where(L > 0, attrs['angle'] / np.where(L > 0, L, 1), 0)
+        M = sbend_map(L, h, attrs['k1'], beta, gamma)
+        M = np.matmul(M, edge_map(h, attrs['e1'], attrs['fint'],
+                                  attrs['hgap']))
+        M = np.matmul(edge_map(h, attrs['e2'], fintx, attrs['hgap']), M)
+        return _tilted(M, attrs['tilt'])
+    if type_ in ('hkicker', 'vkicker', 'kicker', 'tkicker'):
+        zero = np.zeros(num)
+        if type_ == 'hkicker':
+            hkick, vkick = attrs['kick'], zero
+        elif type_ == 'vkicker':
+            hkick, vkick = zero, attrs['kick']
+        else:
+            hkick, vkick = attrs['hkick'], attrs['vkick']
+        kick = np.tile(np.eye(7), (num, 1, 1))
+        kick[:,1,6] = hkick
+        kick[:,3,6] = vkick
+        half = drift_map(L/2, beta, gamma)
+        return np.matmul(half, np.matmul(kick, half))
+    if type_ == 'solenoid':
+        return solenoid_map(L, attrs['ks'], beta, gamma)
+    raise UnsupportedModel("element type {!r} is not supported"
+                             .format(type_))
+
+
+def drift_map(L, beta, gamma):
+    M = np.tile(np.eye(7), (len(L), 1, 1))
+    M[:,0,1] = L
+    M[:,2,3] = L
+    M[:,4,5] = L / (beta*gamma)**2
+    return M
+
+
+def _focusing(K, L):
+    """
+    Return ``cos(√K L)``, ``sin(√K L)/√K``, ``-√K sin(√K L)`` and
+    ``(1-cos(√K L))/K``, ``(L-sin(√K L)/√K)/K`` for arbitrary sign of K,
+    including the limit K → 0.
+    """
+    sqk = np.sqrt(np.abs(K))
+    phi = sqk * L
+    pos, neg = K > 0, K < 0
+    safe = np.where(K == 0, 1, K)
+    sqs = np.where(sqk == 0, 1, sqk)
+    C = np.where(pos, np.cos(phi), np.where(neg, np.cosh(phi), 1))
+    S = np.where(pos, np.sin(phi), np.where(neg, np.sinh(phi), 0))
+    S = np.where(K == 0, L, S / sqs)
+    Cp = np.where(pos, -sqk*np.sin(phi),
+                  np.where(neg, sqk*np.sinh(phi), 0))
+    D = np.where(K == 0, L**2/2, (1 - C) / safe)
+    F = np.where(K == 0, L**3/6, (L - S) / safe)
+    return C, S, Cp, D, F
+
+
+def quadrupole_map(L, k1, beta, gamma):
+    M = drift_map(L, beta, gamma)
+    for i, K in ((0, k1), (2, -k1)):
+        C, S, Cp, _, _ = _focusing(K, L)
+        M[:,i,i] = C
+        M[:,i,i+1] = S
+        M[:,i+1,i] = Cp
+        M[:,i+1,i+1] = C
+    return M
+
+
+def sbend_map(L, h, k1, beta, gamma):
+    """Body of a sector bend with curvature h and gradient k1."""
+    M = quadrupole_map(L, k1, beta, gamma)
+    C, S, Cp, D, F = _focusing(h**2 + k1, L)
+    M[:,0,0] = C
+    M[:,0,1] = S
+    M[:,1,0] = Cp
+    M[:,1,1] = C
+    M[:,0,5] = h * D / beta
+    M[:,1,5] = h * S / beta
+    M[:,4,0] = -h * S / beta
+    M[:,4,1] = -h * D / beta
+    M[:,4,5] = L / (beta*gamma)**2 - h**2 * F / beta**2
+    return M
+
+
+def edge_map(h, e, fint, hgap):
+    """Thin edge focusing of a dipole pole face."""
+    psi = 2 * h * hgap * fint * (1 + np.sin(e)**2) / np.cos(e)
+    M = np.tile(np.eye(7), (len(h), 1, 1))
+    M[:,1,0] = h * np.tan(e)
+    M[:,3,2] = -h * np.tan(e - psi)
+    return M
+
+
+def solenoid_map(L, ks, beta, gamma):
+    K = ks / 2
+    C = np.cos(K*L)
+    S = np.sin(K*L)
+    SK = np.where(K == 0, L, S / np.where(K == 0, 1, K))
+    M = drift_map(L, beta, gamma)
+    M[:,0,:4] = np.stack([C*C, SK*C, S*C, SK*S], axis=-1)
+    M[:,1,:4] = np.stack([-K*S*C, C*C, -K*S*S, S*C], axis=-1)
+    M[:,2,:4] = np.stack([-S*C, -SK*S, C*C, SK*C], axis=-1)
+    M[:,3,:4] = np.stack([K*S*S, -S*C, -K*S*C, C*C], axis=-1)
+    return M
+
+
+def _tilted(M, tilt):
+    """Rotate the element maps by the tilt angle around the s axis."""
+    if not np.any(tilt):
+        return M
+    c, s = np.cos(tilt), np.sin(tilt)
+    R = np.tile(np.eye(7), (len(tilt), 1, 1))
+    R[:,0,0] = R[:,1,1] = R[:,2,2] = R[:,3,3] = c
+    R[:,0,2] = R[:,1,3] = s
+    R[:,2,0] = R[:,3,1] = -s
+    Rinv = np.transpose(R, (0, 2, 1))
+    return np.matmul(Rinv, np.matmul(M, R))
+
+
+def max_deviation(maps, reference):
+    """
+    Return the largest deviation between two sets of sectormaps, relative
+    to the magnitude of the reference entries (but at least 1). The result
+    is NaN if any entry is NaN, so compare with ``not deviation <=
+    tolerance``.
+    """
+    maps = np.asarray(maps)
+    reference = np.asarray(reference)
+    scale = np.maximum(np.abs(reference), 1)
+    return float(np.max(np.abs(maps - reference) / scale))
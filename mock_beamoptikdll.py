@@ -0,0 +1,330 @@
+# encoding: utf-8
+"""
+Pure python stand-in for 'BeamOptikDLL.dll'.
+
+The mock can be passed as DLL proxy object to :class:`BeamOptikDLL` to test
+and benchmark the parameter download without access to the control system:
+
+>>> dll = BeamOptikDLL(MockBeamOptikDLL(latency=0.002))
+>>> dll.GetInterfaceInstance()
+
+The known parameters and their nominal values are taken from the DVM
+parameter export. Returned values depend on the selected MEFI combination
+in a simple, deterministic way. Call latency and error codes (as
+understood by :meth:`BeamOptikDLL.check_return`) can be injected.
+
+All functions declared in ``beamoptikdll._load_functions`` are implemented:
+
+- measurements (``GetFloatValueSD``, ``GetLastFloatValueSD[_RKA]``) are
+  pseudo-random but reproducible values per name and MEFI combination
+- ``StartRampDataGeneration`` registers a MEFI combination, for which
+  ``GetRampDataValue`` returns the flat top value of the parameter
+  ``<parameter>_<device>``, independent of event and delay
+- the callback installed with ``SetNewValueCallback`` is called for every
+  changed parameter in ``ExecuteChanges``
+- ``SelectMEFI_EXT[_RKA]`` ignores the additional argument, and
+  ``SetIPC_DVM_ID`` only stores its arguments
+"""
+
+# NOTE: like beamoptikdll.py, this module depends only on the standard library.
+
+from __future__ import division
+
+import csv
+import ctypes
+import io
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+from beamoptikdll import DVMStatus, _decode
+
+
+DATA_FOLDER = os.path.dirname(__file__)
+
+PARAM_FILE = os.path.join(DATA_FOLDER, 'DVM-Parameter_v2.10.0-HIT.csv')
+
+# exit codes, see BeamOptikDLL.error_messages:
+INVALID_INTERFACE = 1
+PARAM_NOT_FOUND = 2
+GET_VALUE_FAILED = 3
+RUNTIME_ERROR = 7
+RAMP_DATA_NOT_AVAILABLE = 9
+INVALID_RAMP_OFFSET = 10
+
+
+def read_param_list(filename=PARAM_FILE):
+    """
+    Read the parameter names and nominal values from the DVM parameter
+    export. Values are converted from display units using the unit factor
+    of the parameter. Parameters without value default to zero.
+
+    :returns: dict ``{name: value}``
+    """
+    with io.open(filename, encoding='latin1') as f:
+        rows = list(csv.reader(f, delimiter=';'))
+    params = {}
+    for row in rows:
+        if len(row) < 20 or not row[1]:
+            continue
+        try:
+            factor = float(row[18] or 1)
+            value = float(row[19] or 0) / factor
+        except ValueError:
+            value = 0.0
+        params[row[1]] = value
+    return params
+
+
+def param_scale(name, mefi):
+    """
+    Return the factor by which a parameter deviates from its nominal value
+    for the given MEFI combination. Structure and geometry parameters are
+    constant, quadrupoles depend on energy and focus, kickers and dipoles
+    on energy only, and the gantry kickers on the gantry angle as well.
+    """
+    vacc, energy, focus, intensity, angle = mefi
+    kind = name.lower().rsplit('_', 1)[0]
+    element = name.rsplit('_', 1)[-1]
+    if kind in ('kl', 'kl_efg', 'ks'):
+        return (1 + 0.002*energy) * (1 + 0.05*(focus - 1))
+    if kind in ('ax', 'ay', 'dax', 'day'):
+        scale = 1 + 0.002*energy
+        if element.startswith('G'):
+            scale *= 1 + 0.01*angle
+        return scale
+    if name in ('E_HEBT', 'beta_HEBT', 'BRho_HEBT'):
+        return 1 + 0.01*energy
+    return 1.0
+
+
+class MockFunction(object):
+
+    """Callable mimicking a ctypes function pointer of the DLL."""
+
+    def __init__(self, dll, name, impl):
+        self.dll = dll
+        self.__name__ = name
+        self.impl = impl
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        return self.dll._invoke(self.__name__, self.impl, args)
+
+
+class MockBeamOptikDLL(object):
+
+    """
+    Fake DLL object with the interface of ``ctypes.windll.LoadLibrary``.
+
+    :param float latency: seconds to sleep in each call, or dict
+                          ``{function: seconds}``
+    :param float fail_rate: probability for GetFloatValue to fail with
+                            "GetValue failed."
+    :param missing: parameter names to be reported as not found
+    :param str param_file: DVM parameter export with the known parameters
+    :param seed: seed for the random error injection
+    """
+
+    def __init__(self, latency=0.0, fail_rate=0.0, missing=(),
+                 param_file=PARAM_FILE, seed=None):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.params = read_param_list(param_file)
+        for name in missing:
+            self.params.pop(name, None)
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._errors = {}
+        self._iids = set()
+        self._next_iid = 1
+        self._vacc = 1
+        self._mefi = (1, 1, 1, 1, 1)
+        self._changes = {}
+        self._callback = None
+        self._ramps = []
+        self._ipc_dvm_id = None
+
+    def __getitem__(self, name):
+        impl = getattr(self, '_' + name, self._unsupported)
+        return MockFunction(self, name, impl)
+
+    def inject_error(self, function, code, count=1):
+        """Let the next ``count`` calls of ``function`` exit with ``code``."""
+        with self._lock:
+            self._errors[function] = (code, count)
+
+    def value(self, name, mefi=None):
+        """Return the value of a parameter for a MEFI combination."""
+        mefi = self._mefi if mefi is None else mefi
+        return self.params[name] * param_scale(name, mefi)
+
+    def measured_value(self, name, mefi=None):
+        """Return the (pseudo-random) measurement for a MEFI combination."""
+        mefi = self._mefi if mefi is None else mefi
+        rng = random.Random('{}:{}'.format(name, tuple(mefi)))
+        return rng.uniform(0.5, 5.0)
+
+    def _invoke(self, name, impl, args):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(name, 0.0)
+        if latency:
+            time.sleep(latency)
+        with self._lock:
+            self.calls[name] += 1
+            code, count = self._errors.pop(name, (0, 0))
+            if count > 1:
+                self._errors[name] = (code, count - 1)
+        if name.startswith('SelectMEFI_EXT'):
+            done = _ref(args[7])
+        elif name.startswith('SelectMEFI'):
+            done = _ref(args[6])
+        else:
+            done = _ref(args[-1])
+        if code:
+            done.value = code
+        elif (name != 'GetInterfaceInstance' and
+              _value(args[0]) not in self._iids):
+            done.value = INVALID_INTERFACE
+        else:
+            done.value = impl(*args) or 0
+
+    # DLL functions, must return the exit code (or None for success)
+
+    def _GetInterfaceInstance(self, iid, done):
+        with self._lock:
+            _ref(iid).value = self._next_iid
+            self._iids.add(self._next_iid)
+            self._next_iid += 1
+
+    def _FreeInterfaceInstance(self, iid, done):
+        self._iids.discard(_value(iid))
+
+    def _DisableMessageBoxes(self, iid, done):
+        pass
+
+    def _GetDVMStatus(self, iid, status, done):
+        _ref(status).value = DVMStatus.Ready
+
+    def _SelectVAcc(self, iid, vaccnum, done):
+        self._vacc = _value(vaccnum)
+
+    def _GetSelectedVAcc(self, iid, vaccnum, done):
+        _ref(vaccnum).value = self._vacc
+
+    def _SelectMEFI(self, iid, vaccnum, energy, focus, intensity, angle,
+                    done, *values):
+        if _value(vaccnum) != self._vacc:
+            return RUNTIME_ERROR
+        self._mefi = tuple(map(_value, (vaccnum, energy, focus,
+                                        intensity, angle)))
+        for ref, value in zip(values, self._efi_values()):
+            _ref(ref).value = value
+
+    _SelectMEFI_RKA = _SelectMEFI
+
+    def _SelectMEFI_EXT(self, iid, vaccnum, energy, focus, intensity, angle,
+                        ext, done, *values):
+        return self._SelectMEFI(iid, vaccnum, energy, focus, intensity,
+                                angle, done, *values)
+
+    _SelectMEFI_EXT_RKA = _SelectMEFI_EXT
+
+    def _GetMEFIValue(self, iid, *args):
+        values, channels = args[:4], args[4:8]
+        for ref, value in zip(values, self._efi_values()):
+            _ref(ref).value = value
+        for ref, value in zip(channels, self._mefi[1:]):
+            _ref(ref).value = value
+
+    def _GetMEFIValue_RKA(self, iid, *args):
+        for ref, value in zip(args[:4], self._efi_values()):
+            _ref(ref).value = value
+
+    def _GetFloatValue(self, iid, name, value, options, done):
+        name = _decode(_value(name))
+        if name not in self.params:
+            return PARAM_NOT_FOUND
+        if self.fail_rate and self._random.random() < self.fail_rate:
+            return GET_VALUE_FAILED
+        _ref(value).value = self._changes.get(name, self.value(name))
+
+    def _SetFloatValue(self, iid, name, value, options, done):
+        name = _decode(_value(name))
+        if name not in self.params:
+            return PARAM_NOT_FOUND
+        self._changes[name] = _value(value)
+
+    def _ExecuteChanges(self, iid, options, done):
+        if self._callback:
+            for name, value in sorted(self._changes.items()):
+                self._callback(name.encode('utf-8'),
+                               ctypes.pointer(ctypes.c_double(value)),
+                               ctypes.pointer(ctypes.c_int(0)))
+
+    def _SetNewValueCallback(self, iid, callback, done):
+        self._callback = callback if callable(callback) else None
+
+    def _GetFloatValueSD(self, iid, name, value, options, done):
+        name = _decode(_value(name))
+        if '_' not in name:
+            return PARAM_NOT_FOUND
+        _ref(value).value = self.measured_value(name)
+
+    def _GetLastFloatValueSD(self, iid, name, value, vaccnum, options,
+                             energy, focus, intensity, angle, done):
+        name = _decode(_value(name))
+        if '_' not in name:
+            return PARAM_NOT_FOUND
+        mefi = tuple(map(_value, (vaccnum, energy, focus, intensity, angle)))
+        _ref(value).value = self.measured_value(name, mefi)
+
+    _GetLastFloatValueSD_RKA = _GetLastFloatValueSD
+
+    def _StartRampDataGeneration(self, iid, vaccnum, energy, focus,
+                                 intensity, order_num, done):
+        with self._lock:
+            self._ramps.append(tuple(map(_value, (
+                vaccnum, energy, focus, intensity))) + (1,))
+            _ref(order_num).value = len(self._ramps)
+
+    def _GetRampDataValue(self, iid, order_num, event_num, delay,
+                          parameter_name, device_name, value, done):
+        order_num = _value(order_num)
+        if not 0 < order_num <= len(self._ramps):
+            return RAMP_DATA_NOT_AVAILABLE
+        if _value(delay) < 0:
+            return INVALID_RAMP_OFFSET
+        name = '{}_{}'.format(_decode(_value(parameter_name)),
+                              _decode(_value(device_name)))
+        if name not in self.params:
+            return PARAM_NOT_FOUND
+        _ref(value).value = self.value(name, self._ramps[order_num - 1])
+
+    def _SetIPC_DVM_ID(self, iid, *args):
+        self._ipc_dvm_id = tuple(map(_value, args[:-1]))
+
+    def _unsupported(self, *args):
+        return RUNTIME_ERROR
+
+    def _efi_values(self):
+        """Physical energy [MeV/u], focus [mm], intensity, gantry angle."""
+        _, energy, focus, intensity, angle = self._mefi
+        return (48 + (430 - 48) * (energy - 1) / 254,
+                2.5 + 1.5 * focus,
+                2e6 * 1.5 ** (intensity - 1),
+                10.0 * angle)
+
+
+def _ref(arg):
+    """Dereference pointers, pass through ctypes instances."""
+    return getattr(arg, 'contents', arg)
+
+
+def _value(arg):
+    return _ref(arg).value
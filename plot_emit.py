@@ -1,9 +1,40 @@
+"""
+Plot the results of calc_emit.py.
+
+Usage:
+
+    plot_emit.py [<RESULTS_FILE>] [--jobs N] [--force]
+
+Options:
+
+    --jobs N    render the figures in N worker processes
+    --force     render all figures, even those whose data did not change
+                since the last run
+"""
 
-import itertools
 import os
+import sys
+import json
+import hashlib
+import argparse
+import itertools
+import multiprocessing
 
 import numpy as np
-import matplotlib.pyplot as plt
+
+from results_store import load_results
+
+
+GRAPHS_FOLDER = 'graphs'
+
+# file containing the data hashes of the last rendered figures:
+HASHES_FILE = '.hashes.json'
+
+# (foreach, xname, ynames):
+PLOTS = [
+    ('E', 'I', ('ex', 'ey')),
+    ('I', 'E', ('ex', 'ey', 'betx', 'bety', 'alfx', 'alfy')),
+]
 
 
 def is_nan(n):
@@ -14,8 +45,14 @@ def reslice(tup, indices):
     return tuple(tup[i] for i in indices)
 
 
-def plot_var(data, foreach, xname, yname):
+def figure_specs(data, foreach, xname, ynames, folder=GRAPHS_FOLDER):
+    """
+    Group the data for plotting ``yname(xname)`` with one curve for each
+    value of ``foreach``, and one file for each combination of the remaining
+    MEFI values. The data is sorted and grouped only once for all ynames.
 
+    :returns: list of figure specifications, see :func:`render_figure`
+    """
     order = 'MEFIG'
     var_order = [c for c in order if c not in (foreach, xname)]
     var_order += [foreach, xname]
@@ -23,39 +60,111 @@ def plot_var(data, foreach, xname, yname):
 
     mefis = sorted(data, key=lambda mefi: reslice(mefi, var_order))
 
+    specs = []
     # iterate over settings going to different files (MFG)
     for k_file, mefis_file in itertools.groupby(
             mefis, lambda mefi: reslice(mefi, var_order[:-2])):
 
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-        ax.set_xlabel(xname)
-        ax.set_ylabel(yname)
-        ax.yaxis.get_major_formatter().set_powerlimits([-3, +3])
-
         # iterate over multiple curves plotted into the same file (E)
-        for k_curve, mefis_curve in itertools.groupby(
-                mefis_file, lambda mefi: mefi[var_order[-2]]):
-            # get X, Y values for
-            curve = [
-                (xval, yval)
-                for mefi in mefis_curve
-                for xval in [mefi[var_order[-1]]]
-                for yval in [data[mefi][yname]]
-                #if not is_nan(yval)
-            ]
-            x, y = zip(*curve)
-            ax.plot(x, y, '-x', label="{}{}".format(foreach, k_curve))
-
-        ax.legend()
+        curves = [
+            ("{}{}".format(foreach, k_curve), list(mefis_curve))
+            for k_curve, mefis_curve in itertools.groupby(
+                mefis_file, lambda mefi: mefi[var_order[-2]])
+        ]
         basename = '-'.join('{}{}'.format(order[i], v)
                             for i, v in zip(var_order, k_file))
-        fig.savefig('graphs/{}({})_{}.pdf'.format(yname, xname, basename), bbox_inches='tight')
-        plt.close(fig)
+        for yname in ynames:
+            specs.append({
+                'filename': os.path.join(folder, '{}({})_{}.pdf'.format(
+                    yname, xname, basename)),
+                'xname': xname,
+                'yname': yname,
+                'curves': [
+                    (label,
+                     [int(mefi[var_order[-1]]) for mefi in curve],
+                     [float(data[mefi][yname]) for mefi in curve])
+                    for label, curve in curves
+                ],
+            })
+    return specs
+
+
+def _pyplot():
+    # matplotlib is slow to import, load only when rendering:
+    import matplotlib
+    matplotlib.use('Agg')           # non-interactive, only saving files
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def render_figure(spec):
+    """Render a figure specification to PDF."""
+    plt = _pyplot()
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    ax.set_xlabel(spec['xname'])
+    ax.set_ylabel(spec['yname'])
+    ax.yaxis.get_major_formatter().set_powerlimits([-3, +3])
+    for label, x, y in spec['curves']:
+        ax.plot(x, y, '-x', label=label)
+    ax.legend()
+    fig.savefig(spec['filename'], bbox_inches='tight')
+    plt.close(fig)
+    return spec['filename']
+
+
+def spec_hash(spec):
+    text = json.dumps(spec, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def render_all(specs, folder=GRAPHS_FOLDER, jobs=1, force=False):
+    """
+    Render all figures whose data changed since the last run (or whose file
+    is missing).
+
+    :returns: list of rendered filenames
+    """
+    try:
+        os.makedirs(folder)
+    except OSError:     # no exist_ok on py2
+        pass
+    hashes_file = os.path.join(folder, HASHES_FILE)
+    try:
+        with open(hashes_file) as f:
+            hashes = json.load(f)
+    except (IOError, ValueError):
+        hashes = {}
+
+    todo = [spec for spec in specs
+            if force
+            or hashes.get(spec['filename']) != spec_hash(spec)
+            or not os.path.exists(spec['filename'])]
+    if jobs > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            rendered = pool.map(render_figure, todo, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rendered = [render_figure(spec) for spec in todo]
+
+    hashes.update({spec['filename']: spec_hash(spec) for spec in todo})
+    with open(hashes_file, 'w') as f:
+        json.dump(hashes, f, indent=0, sort_keys=True)
+    return rendered
+
+
+def plot_var(data, foreach, xname, yname):
+    render_all(figure_specs(data, foreach, xname, [yname]))
 
 
 def load_data(path):
-    data = np.genfromtxt(path, names=True)
+    if path.endswith('.npy'):
+        data = load_results(path)
+    else:
+        data = np.genfromtxt(path, names=True)
     return {
         tuple(map(int, (
             d['vacc'], d['energy'], d['focus'], d['intensity'], d['gantry']
@@ -68,17 +177,25 @@ def row_as_dict(row):
     return dict(zip(row.dtype.names, row))
 
 
-def main(input_file='results.txt'):
+def main(input_file='results.txt', jobs=1, force=False):
     data = load_data(input_file)
-    plot_var(data, 'E', 'I', 'ex')
-    plot_var(data, 'E', 'I', 'ey')
-    plot_var(data, 'I', 'E', 'ex')
-    plot_var(data, 'I', 'E', 'ey')
-    plot_var(data, 'I', 'E', 'betx')
-    plot_var(data, 'I', 'E', 'bety')
-    plot_var(data, 'I', 'E', 'alfx')
-    plot_var(data, 'I', 'E', 'alfy')
+    specs = [spec
+             for foreach, xname, ynames in PLOTS
+             for spec in figure_specs(data, foreach, xname, ynames)]
+    rendered = render_all(specs, jobs=jobs, force=force)
+    print("Rendered {} of {} figures".format(len(rendered), len(specs)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Plot the results of calc_emit.py.")
+    parser.add_argument('input_file', nargs='?', default='results.txt')
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                        help="number of worker processes")
+    parser.add_argument('--force', action='store_true',
+                        help="render all figures")
+    return vars(parser.parse_args(argv))
 
 
 if __name__ == '__main__':
-    import sys; sys.exit(main(*sys.argv[1:]))
+    sys.exit(main(**parse_args()))
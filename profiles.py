@@ -0,0 +1,219 @@
+# encoding: utf-8
+"""
+Beam widths from the raw grid profiles in the device exports.
+
+The FWHM values in the export summary are converted to RMS widths assuming
+a gaussian beam, which biases the emittance for non-gaussian beams. This
+module parses the per-wire measurements that follow the ``</CUSTOM>``
+marker and computes background subtracted RMS widths (or gaussian fit
+widths) for many files at once.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+
+import re
+import warnings
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from device_export import HEADER_END
+
+
+# Keys of the columns of the raw measurement block that are used:
+PROFILE_KEYS = ('posx', 'ampx', 'posy', 'ampy')
+
+_NUMERIC_LINE = re.compile(
+    br'^([-+0-9.eE;\t ]*[0-9][-+0-9.eE;\t ]*)\r?$', re.M)
+
+
+def parse_columns(text):
+    """
+    Parse the column layout of the raw measurement block, given as comma
+    separated (zero based) column numbers of the wire position and
+    amplitude in x and y, e.g. ``1,2,3,4`` for rows of the form
+    ``wire;pos x;amp x;pos y;amp y``.
+
+    :returns: ``{key: column}`` for the keys in :data:`PROFILE_KEYS`
+    :raises ValueError: if the layout is malformed
+    """
+    columns = [int(col) for col in text.split(',')]
+    if len(columns) != len(PROFILE_KEYS) or min(columns) < 0:
+        raise ValueError(
+            "expected four column numbers (posx,ampx,posy,ampy): {!r}"
+            .format(text))
+    return dict(zip(PROFILE_KEYS, columns))
+
+
+def read_raw_profile(filename):
+    """
+    Parse the numeric rows of the raw measurement block of a device export.
+    Non-numeric lines (tags, column titles) are ignored.
+
+    :returns: array of shape (n_rows, n_columns)
+    :raises ValueError: if the rows have different numbers of columns
+    """
+    with open(filename, 'rb') as f:
+        text = f.read()
+    start = text.find(HEADER_END)
+    if start == -1:
+        return np.zeros((0, 0))
+    lines = _NUMERIC_LINE.findall(text, start + len(HEADER_END))
+    if not lines:
+        return np.zeros((0, 0))
+    num_cols = lines[0].count(b';') + 1
+    block = b' '.join(lines).replace(b';', b' ').decode('ascii')
+    values = np.fromstring(block, sep=' ')
+    if values.size != len(lines) * num_cols:
+        raise ValueError("rows with different numbers of columns")
+    return values.reshape((-1, num_cols))
+
+
+def _read_profile(filename, columns):
+    """Read a single file, returns ``(rows, error)``."""
+    try:
+        rows = read_raw_profile(filename)
+    except (IOError, OSError, ValueError) as e:
+        return None, 'raw data: {}'.format(e)
+    if not len(rows):
+        return None, 'no raw data'
+    if rows.shape[1] <= max(columns.values()):
+        return None, 'raw data has only {} columns'.format(rows.shape[1])
+    return rows, None
+
+
+def load_profiles(filenames, columns, jobs=1):
+    """
+    Read the raw profiles of many files into padded arrays.
+
+    :param dict columns: column layout, see :func:`parse_columns`
+    :returns: dict with arrays 'posx', 'ampx', 'posy', 'ampy' of shape
+              (n_files, n_wires), padded with NaN, and the list 'error' with
+              the reason why a file could not be read (or ``None``)
+    """
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        raw = pool.map(lambda filename: _read_profile(filename, columns),
+                       filenames)
+    finally:
+        pool.close()
+        pool.join()
+    num_wires = max([len(rows) for rows, _ in raw if rows is not None] + [1])
+    result = {key: np.full((len(raw), num_wires), np.nan) for key in columns}
+    for i, (rows, _) in enumerate(raw):
+        if rows is not None:
+            for key, col in columns.items():
+                result[key][i, :len(rows)] = rows[:,col]
+    result['error'] = [error for _, error in raw]
+    return result
+
+
+def rms_widths(pos, amp, num_edge=3):
+    """
+    Compute centroid and RMS width of many profiles at once.
+
+    The background is estimated as the mean of the ``num_edge`` outermost
+    wires on each side of the profile and subtracted before computing the
+    moments. Negative amplitudes are clipped.
+
+    :param pos: wire positions, shape (n_profiles, n_wires), NaN padded
+    :param amp: wire amplitudes, same shape
+    :returns: centroid, rms (shape (n_profiles,))
+    """
+    valid, background = _background(pos, amp, num_edge)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(valid, np.clip(amp - background[:,None], 0, None), 0)
+        pos = np.where(valid, pos, 0)
+        total = weight.sum(axis=1)
+        mean = (weight * pos).sum(axis=1) / total
+        var = (weight * (pos - mean[:,None])**2).sum(axis=1) / total
+        return mean, np.sqrt(var)
+
+
+def gauss_widths(pos, amp, num_edge=3, threshold=0.2):
+    """
+    Fit gaussians to many profiles at once.
+
+    After background subtraction (see :func:`rms_widths`), a parabola is
+    fitted to the logarithm of all amplitudes above ``threshold`` times the
+    peak, weighted with the squared amplitudes. Fits that do not describe a
+    gaussian peak, or that are wider than the grid or centered outside of
+    it, give NaN.
+
+    :returns: centroid, sigma (shape (n_profiles,))
+    """
+    valid, background = _background(pos, amp, num_edge)
+    mean, rms = rms_widths(pos, amp, num_edge)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y = np.where(valid, amp - background[:,None], 0)
+        peak = y.max(axis=1)
+        use = valid & (y > threshold * peak[:,None])
+        w = np.where(use, y**2, 0)
+        logy = np.log(np.where(use, y, 1))
+        # center positions for better conditioning:
+        offset = np.nan_to_num(mean)
+        x = np.where(valid, pos - offset[:,None], 0)
+        powers = np.stack([np.ones_like(x), x, x**2], axis=-1)
+        lhs = np.einsum('pw,pwi,pwj->pij', w, powers, powers)
+        rhs = np.einsum('pw,pwi,pw->pi', w, powers, logy)
+    sigma = np.full(len(pos), np.nan)
+    center = np.full(len(pos), np.nan)
+    ok = np.isfinite(lhs).all(axis=(1,2)) & (np.abs(np.linalg.det(lhs)) > 0)
+    if ok.any():
+        _, b, c = np.linalg.solve(lhs[ok], rhs[ok][...,None])[...,0].T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sigma[ok] = np.sqrt(-1 / (2*c))
+            center[ok] = offset[ok] - b / (2*c)
+        # a parabola that is open at the top (e.g. for flat-top or
+        # single-wire profiles) is no gaussian:
+        sigma[np.flatnonzero(ok)[c >= 0]] = np.nan
+    # discard fits that are wider than the grid or centered outside:
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        # profiles without valid wires:
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lo = np.nanmin(np.where(valid, pos, np.nan), axis=1)
+        hi = np.nanmax(np.where(valid, pos, np.nan), axis=1)
+        bad = ~((sigma <= hi - lo) & (center >= lo) & (center <= hi))
+    sigma[bad] = np.nan
+    center[bad] = np.nan
+    return center, sigma
+
+
+def _background(pos, amp, num_edge):
+    """
+    Return the mask of valid wires and the background level estimated from
+    the ``num_edge`` outermost valid wires on each side of the profiles.
+    """
+    valid = ~(np.isnan(pos) | np.isnan(amp))
+    num = valid.sum(axis=1)
+    # valid wires are at the front:
+    idx = np.arange(pos.shape[1])
+    edge = valid & ((idx < num_edge) | (idx >= num[:,None] - num_edge))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        background = (np.where(edge, amp, 0).sum(axis=1) /
+                      edge.sum(axis=1))
+    return valid, background
+
+
+def profile_widths(filenames, columns, method='rms', jobs=1):
+    """
+    Compute the beam widths in x and y from the raw profiles of the given
+    export files.
+
+    :param dict columns: column layout, see :func:`parse_columns`
+    :param str method: 'rms' or 'gauss'
+    :returns: envx, envy in meters (shape (n_files,)), and the list of
+              reasons why no width could be computed for a file (or
+              ``None``), in which case the widths are NaN
+    """
+    widths = {'rms': rms_widths, 'gauss': gauss_widths}[method]
+    profiles = load_profiles(filenames, columns, jobs)
+    _, envx = widths(profiles['posx'], profiles['ampx'])
+    _, envy = widths(profiles['posy'], profiles['ampy'])
+    errors = [
+        error or (None if np.isfinite(x) and np.isfinite(y) else
+                  '{} width failed'.format(method))
+        for error, x, y in zip(profiles['error'], envx, envy)
+    ]
+    return envx / 1000, envy / 1000, errors
@@ -0,0 +1,140 @@
+# encoding: utf-8
+"""
+Binary storage of the emittance results.
+
+The results are stored as a single structured numpy array in a ``.npy`` file
+(which can be memory mapped), sorted by MEFI setting. In contrast to the
+text output, values are stored with full double precision and include the
+fit diagnostics. The standard errors from the bootstrap (if requested) are
+stored next to the analytic ones in the ``boot_*`` fields.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import tempfile
+
+import numpy as np
+
+
+MEFI_FIELDS = ('vacc', 'energy', 'focus', 'intensity', 'gantry')
+
+# Minimum number of characters of the 'subset' field, the field is widened
+# as needed for longer monitor lists:
+SUBSET_WIDTH = 128
+
+
+def result_dtype(subset_width=SUBSET_WIDTH):
+    """Return the dtype of the results with the given width of 'subset'."""
+    return np.dtype(
+        [(name, 'i4') for name in MEFI_FIELDS] +
+        [(name, 'f8') for name in (
+            'ex', 'ey', 'pt', 'alfx', 'alfy', 'betx', 'bety',
+            'dex', 'dey', 'dalfx', 'dalfy', 'dbetx', 'dbety',
+            'boot_dex', 'boot_dey', 'boot_dalfx', 'boot_dalfy',
+            'boot_dbetx', 'boot_dbety',
+            'res_x', 'res_y')] +
+        [('rank_x', 'i4'), ('rank_y', 'i4'),
+         ('coupled', '?'), ('dispersive', '?')] +
+        [(name, 'f8') for name in (
+            'cond', 'cond_subset', 'loo_ex', 'loo_ey')] +
+        [('subset', 'U{}'.format(max(subset_width, SUBSET_WIDTH)))])
+
+
+RESULT_DTYPE = result_dtype()
+
+VALUE_FIELDS = RESULT_DTYPE.names[len(MEFI_FIELDS):]
+
+
+def subset_width(data):
+    """
+    Return the number of characters of the 'subset' field of a results
+    array, 0 if there is no such field.
+    """
+    if 'subset' not in (data.dtype.names or ()):
+        return 0
+    return data.dtype['subset'].itemsize // np.dtype('U1').itemsize
+
+
+def to_array(rows):
+    """Convert ``{mefi: {column: value}}`` to a sorted structured array."""
+    width = max([len(row.get('subset', '')) for row in rows.values()] + [0])
+    data = np.zeros(len(rows), dtype=result_dtype(width))
+    for name in VALUE_FIELDS:
+        if data.dtype[name].kind == 'f':
+            data[name] = np.nan
+    for i, mefi in enumerate(sorted(rows)):
+        for name, value in zip(MEFI_FIELDS, mefi):
+            data[name][i] = value
+        for name, value in rows[mefi].items():
+            data[name][i] = value
+    return data
+
+
+def mefi_index(data):
+    """Return ``{mefi: row}`` index for a results array."""
+    mefis = zip(*[data[name].tolist() for name in MEFI_FIELDS])
+    return {mefi: i for i, mefi in enumerate(mefis)}
+
+
+def load_results(filename, mmap_mode=None):
+    """
+    Load a results array, returns an empty array if the file is missing.
+    Stores written by older versions are converted to the current layout,
+    with missing fields set to NaN.
+    """
+    if not os.path.exists(filename):
+        return np.zeros(0, dtype=RESULT_DTYPE)
+    data = np.load(filename, mmap_mode=mmap_mode)
+    if data.dtype != result_dtype(subset_width(data)):
+        data = _upgrade(data)
+    return data
+
+
+def _upgrade(old, width=0):
+    dtype = result_dtype(max(width, subset_width(old)))
+    data = np.zeros(len(old), dtype=dtype)
+    for name in dtype.names:
+        if name in old.dtype.names:
+            data[name] = old[name]
+        elif data.dtype[name].kind == 'f':
+            data[name] = np.nan
+    return data
+
+
+def save_results(filename, data):
+    """Atomically write the results array to a ``.npy`` file."""
+    data = np.asarray(data, dtype=result_dtype(subset_width(data)))
+    data = data[np.lexsort([data[name] for name in MEFI_FIELDS[::-1]])]
+    folder = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, data)
+    replace_file(tmp, filename)
+
+
+def replace_file(src, dst):
+    """Move ``src`` to ``dst``, replacing ``dst`` if it exists."""
+    try:
+        os.replace(src, dst)
+    except AttributeError:      # py2
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def append_results(filename, rows, remove=()):
+    """
+    Add the results ``{mefi: {column: value}}`` to the store. Existing rows
+    for the same MEFI settings are replaced, and existing rows for the MEFI
+    settings in ``remove`` are deleted.
+    """
+    old = load_results(filename)
+    new = to_array(rows)
+    remove = set(remove)
+    keep = [i for mefi, i in sorted(mefi_index(old).items())
+            if mefi not in rows and mefi not in remove]
+    # use the wider 'subset' field of both:
+    width = max(subset_width(old), subset_width(new))
+    save_results(filename, np.concatenate([
+        _upgrade(old[keep], width), _upgrade(new, width)]))
@@ -0,0 +1,151 @@
+# encoding: utf-8
+"""
+Persistent on-disk cache for sectormaps.
+
+Entries are content addressed, i.e. the file name is a hash of everything
+the sectormaps depend on (model file and the files it calls, strength file,
+monitor list, TWISS arguments). Each entry is a single memory-mappable
+``.npy`` file. When the total size of the cache exceeds its limit, the least
+recently used entries are removed.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+def file_digest(filename):
+    """Return the SHA1 hex digest of the file contents."""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+_CALL = re.compile(
+    r'''\bcall\s*,?\s*file\s*=\s*(?:"([^"]*)"|'([^']*)'|([^;,\s]+))''',
+    re.I)
+
+_COMMENT = re.compile(r'/\*.*?\*/|//[^\n]*|![^\n]*', re.S)
+
+
+def model_files(filename):
+    """
+    Return the model file and all files it loads with ``call, file=...``
+    (recursively), in order of first occurence. As with ``Madx.call(...,
+    chdir=True)``, relative names are resolved against the folder of the
+    model file. Files that do not exist are included as well.
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    files = []
+    pending = [filename]
+    while pending:
+        name = pending.pop(0)
+        if name in files:
+            continue
+        files.append(name)
+        try:
+            with open(name) as f:
+                text = _COMMENT.sub('', f.read())
+        except (IOError, OSError):
+            continue
+        pending.extend(
+            os.path.join(folder, ''.join(match.groups('')))
+            for match in _CALL.finditer(text))
+    return files
+
+
+def model_digest(filename):
+    """
+    Return a digest of the model file together with all files that it
+    calls, see :func:`model_files`. Missing files enter with their name.
+    """
+    digests = []
+    for name in model_files(filename):
+        try:
+            digests.append(file_digest(name))
+        except (IOError, OSError):
+            digests.append('missing:' + os.path.abspath(name))
+    if len(digests) == 1:
+        return digests[0]
+    text = '\n'.join(digests)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class SectormapCache(object):
+
+    """
+    Size bounded LRU cache of numpy arrays in a folder.
+
+    :param str folder:      cache folder, created if necessary
+    :param int max_size:    maximum total size of all entries in bytes
+    """
+
+    def __init__(self, folder, max_size=256*1024*1024):
+        self.folder = folder
+        self.max_size = max_size
+        try:
+            os.makedirs(folder)
+        except OSError:     # no exist_ok on py2
+            pass
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def key(self, *parts):
+        """Compute the cache key for the given JSON serializable parts."""
+        text = json.dumps(parts, sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        """Return the cached array (memory mapped) or ``None`` on a miss."""
+        path = self._path(key)
+        try:
+            data = np.load(path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        # update access time for LRU eviction:
+        os.utime(path, None)
+        return data
+
+    def store(self, key, data):
+        """Store an array under the given key."""
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.folder)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.asarray(data))
+        path = self._path(key)
+        if os.path.exists(path):
+            self._size -= os.path.getsize(path)
+            os.remove(path)     # no atomic replace on py2/windows
+        os.rename(tmp, path)
+        self._size += os.path.getsize(path)
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the size fits."""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:     # e.g. still mapped on windows
+                continue
+            self._size -= size
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.npy')
+
+    def _entries(self):
+        for name in os.listdir(self.folder):
+            if name.endswith('.npy'):
+                path = os.path.join(self.folder, name)
+                stat = os.stat(path)
+                yield path, stat.st_size, stat.st_mtime
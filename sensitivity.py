@@ -0,0 +1,278 @@
+# encoding: utf-8
+"""
+Sensitivity of the emittance results to errors of the magnet strengths.
+
+The derivatives of the results with respect to every strength variable that
+enters the optics up to the last monitor are computed by central finite
+differences. All perturbed settings are evaluated in a single vectorized
+pass of the numpy optics engine (see linear_optics.py), which describes the
+linear optics around the design orbit. The engine is first compared with
+MAD-X for a few settings (as with ``calc_emit.py --engine=auto``); if it
+does not support the model or deviates by more than the tolerance, the
+perturbed settings are computed with MAD-X one by one instead, which is much
+slower. Multiplied with the relative calibration error of the magnets this
+gives an error budget per setting.
+
+Usage:
+
+    sensitivity.py <DATA_FOLDER> <MADX_MODEL_FILE> <MADX_SEQUENCE_NAME> <OUTPUT_FILE>
+                   [--error REL] [--step REL] [--pattern REGEX]
+                   [--strengths FILE] [--index FILE]
+                   [--widths METHOD [--profile-columns COLS]]
+                   [--tolerance TOL]
+
+Options:
+
+    --error REL         relative calibration error of the strengths
+                        [default: 0.01]
+    --step REL          relative step of the finite differences
+                        [default: 1e-4]
+    --pattern REGEX     consider only the variables whose name matches the
+                        (case insensitive) regular expression
+                        [default: ^(kl|ks)_]
+    --strengths FILE    read the magnet strengths from a strength store
+                        instead of the files in params/
+    --index FILE        index of the parsed device exports
+    --widths METHOD     source of the beam widths, see calc_emit.py
+    --profile-columns COLS
+                        layout of the raw profiles, see calc_emit.py
+    --tolerance TOL     maximum deviation of the numpy engine from MAD-X
+                        [default: 1e-6]
+
+The output file contains for every setting one line per variable with the
+change of the results if the strength is off by the relative error, one line
+``total`` with the quadratic sum of these contributions and one line
+``stat`` with the statistical errors of the fit for comparison.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import sys
+import tempfile
+import argparse
+
+import numpy as np
+
+from emit_math import calc_emit_batch
+from linear_optics import assignment_matrix, UnsupportedModel
+from results_store import replace_file
+from profiles import parse_columns
+from calc_emit import (
+    load_records, sort_monitors, load_strength_store,
+    measured_envelopes, strength_assignments, strength_source,
+    missing_monitors, format_channel, format_float, numpy_sectormaps,
+    DEFAULT_TOLERANCE)
+
+
+SENSITIVITY_FIELDS = ('ex', 'ey', 'alfx', 'alfy', 'betx', 'bety')
+
+DEFAULT_PATTERN = r'^(kl|ks)_'
+
+# Limits the number of perturbed settings that are evaluated at once:
+MAX_ROWS = 20000
+
+
+def strength_jacobian(optics, elems, envelopes, errors, names, values,
+                      variables, step=1e-4, max_rows=MAX_ROWS):
+    """
+    Compute the derivatives of the results with respect to relative changes
+    of the given variables by central finite differences.
+
+    :param optics: optics engine, :class:`linear_optics.LinearOptics` or
+                   :class:`MadxOptics`
+    :param list elems: monitor names, sorted by position
+    :param envelopes: measured envelopes (n_settings, n_monitors, 2)
+    :param errors: standard errors of the envelopes, same shape
+    :param list names: assigned variables, see :func:`assignment_matrix`
+    :param values: strengths (n_settings, len(names))
+    :param list variables: names of the variables to perturb
+    :param float step: relative step size
+    :returns: ``{field: array of shape (n_settings, len(variables))}``,
+              zero for variables that are not assigned in a setting
+    """
+    num_settings = len(values)
+    num_vars = len(variables)
+    cols = [names.index(var) for var in variables]
+    indices = np.arange(num_vars)
+    chunk = max(1, max_rows // max(1, 2*num_vars))
+    jacobian = {field: np.zeros((num_settings, num_vars))
+                for field in SENSITIVITY_FIELDS}
+    for begin in range(0, num_settings, chunk):
+        part = slice(begin, begin + chunk)
+        base = values[part]
+        num = len(base)
+        perturbed = np.repeat(base[:,None,None,:], num_vars, axis=1)
+        perturbed = np.repeat(perturbed, 2, axis=2)
+        perturbed[:,indices,0,cols] *= 1 + step
+        perturbed[:,indices,1,cols] *= 1 - step
+        sectormaps = optics.transfer_maps(
+            elems, names, perturbed.reshape((-1, len(names))))
+        results = calc_emit_batch(
+            np.repeat(envelopes[part], 2*num_vars, axis=0), sectormaps,
+            calc_long=True, calc_4D=False,
+            envelope_errors=np.repeat(errors[part], 2*num_vars, axis=0))
+        for field in SENSITIVITY_FIELDS:
+            value = results[field].reshape((num, num_vars, 2))
+            diff = (value[:,:,0] - value[:,:,1]) / (2*step)
+            # unassigned variables are not perturbed:
+            jacobian[field][part] = np.where(
+                np.isnan(base[:,cols]), 0, diff)
+    return jacobian
+
+
+class MadxOptics(object):
+
+    """
+    Computes the transfer maps with MAD-X, one setting after the other, for
+    models that the numpy engine can not reproduce. Provides the
+    ``transfer_maps`` method of :class:`linear_optics.LinearOptics`.
+
+    :param Session session: MAD-X session with the model loaded
+    :param str seq_name: sequence name
+    """
+
+    def __init__(self, session, seq_name):
+        self.session = session
+        self.twiss = dict(sequence=seq_name, betx=1, bety=1)
+
+    def transfer_maps(self, elems, names, values):
+        return np.array([
+            self.session.sectormaps(self.twiss, elems, [
+                (name, value) for name, value in zip(names, row)
+                if not np.isnan(value)])
+            for row in values
+        ])
+
+
+def write_budget(output_file, mefis, variables, jacobian, results, error):
+    """
+    Write the error budget table, see module documentation.
+
+    :param dict jacobian: result of :func:`strength_jacobian`
+    :param dict results: unperturbed results from :func:`calc_emit_batch`
+    :param float error: relative error of the strengths
+    """
+    folder = os.path.dirname(os.path.abspath(output_file))
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    with os.fdopen(fd, 'wt') as f:
+        print("# vacc energy focus intensity gantry param",
+              *SENSITIVITY_FIELDS, file=f)
+        for i, mefi in enumerate(mefis):
+            contrib = np.array([jacobian[field][i] * error
+                                for field in SENSITIVITY_FIELDS]).T
+            total = np.sqrt(np.sum(contrib**2, axis=0))
+            stat = [results['d' + field][i] for field in SENSITIVITY_FIELDS]
+            lines = list(zip(variables, contrib))
+            lines += [('total', total), ('stat', stat)]
+            M, E, F, I, G = mefi
+            chn = format_channel
+            for name, row in lines:
+                print(chn(M, 2), chn(E, 3), chn(F, 2), chn(I, 2), chn(G, 3),
+                      '{:<16}'.format(name), *map(format_float, row),
+                      file=f)
+    replace_file(tmp, output_file)
+
+
+def main(data_folder, madx_file, seq_name, output_file='sensitivity.txt',
+         error=0.01, step=1e-4, pattern=DEFAULT_PATTERN, strengths=None,
+         index=None, widths='fwhm', profile_columns=None,
+         tolerance=DEFAULT_TOLERANCE):
+
+    all_records = load_records(data_folder, index, widths=widths,
+                               columns=profile_columns)
+    elements, session = sort_monitors(
+        madx_file, seq_name,
+        set(dev for devs in all_records.values() for dev in devs))
+
+    mefis = sorted(all_records)
+    if strengths is not None:
+        strengths, mefis = load_strength_store(strengths, mefis)
+
+    # skip the settings that calc_emit.py can not evaluate either:
+    settings = {}
+    skipped = {}
+    for mefi in mefis:
+        missing = missing_monitors(all_records[mefi], elements)
+        if missing:
+            skipped[mefi] = "no data for monitors: {}".format(
+                ', '.join(missing))
+            continue
+        try:
+            settings[mefi] = strength_assignments(
+                strength_source(mefi, strengths))
+        except (IOError, OSError, ValueError) as e:
+            skipped[mefi] = "{}: {}".format(type(e).__name__, e)
+    if skipped:
+        print("Warning: skipping {} settings:".format(len(skipped)))
+        for mefi, reason in sorted(skipped.items()):
+            print("  M{}-E{}-F{}-I{}-G{}: {}".format(*(mefi + (reason,))))
+    mefis = sorted(settings)
+    names, values = assignment_matrix([settings[mefi] for mefi in mefis])
+
+    twiss = dict(sequence=seq_name, betx=1, bety=1)
+    try:
+        sectormaps = numpy_sectormaps(
+            session, twiss, elements, [settings[mefi] for mefi in mefis],
+            tolerance)
+        optics = session.linear_optics(seq_name)
+        used = optics.variables(elements[-1])
+    except UnsupportedModel as e:
+        print("Using MAD-X for the sensitivity: {}".format(e))
+        optics = MadxOptics(session, seq_name)
+        sectormaps = optics.transfer_maps(elements, names, values)
+        # the variables that enter the optics are not known:
+        used = set(names)
+    variables = sorted(
+        name for name in used & set(names)
+        if re.search(pattern, name, re.I))
+    print("Computing the sensitivity to {} strengths for {} settings"
+          .format(len(variables), len(mefis)))
+
+    _, envelopes, errors = measured_envelopes(mefis, all_records, elements)
+    results = calc_emit_batch(
+        envelopes, sectormaps,
+        calc_long=True, calc_4D=False, envelope_errors=errors)
+    jacobian = strength_jacobian(
+        optics, elements, envelopes, errors, names, values, variables, step)
+    write_budget(output_file, mefis, variables, jacobian, results, error)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Error budget of the emittances for strength errors.")
+    parser.add_argument('data_folder')
+    parser.add_argument('madx_file')
+    parser.add_argument('seq_name')
+    parser.add_argument('output_file', nargs='?', default='sensitivity.txt')
+    parser.add_argument('--error', type=float, default=0.01, metavar='REL',
+                        help="relative calibration error of the strengths")
+    parser.add_argument('--step', type=float, default=1e-4, metavar='REL',
+                        help="relative step of the finite differences")
+    parser.add_argument('--pattern', default=DEFAULT_PATTERN,
+                        metavar='REGEX', help="variables to consider")
+    parser.add_argument('--strengths', metavar='FILE',
+                        help="strength store to use instead of params/")
+    parser.add_argument('--index', metavar='FILE',
+                        help="index file of the parsed device exports")
+    parser.add_argument('--widths', choices=('fwhm', 'rms', 'gauss'),
+                        default='fwhm', help="source of the beam widths")
+    parser.add_argument('--profile-columns', type=parse_columns,
+                        metavar='COLS',
+                        help="columns posx,ampx,posy,ampy of the raw profiles")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        metavar='TOL',
+                        help="maximum deviation of the numpy engine from"
+                             " MAD-X")
+    args = parser.parse_args(argv)
+    if args.widths != 'fwhm' and args.profile_columns is None:
+        parser.error("--widths={} requires --profile-columns"
+                     .format(args.widths))
+    return vars(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(**parse_args()))
@@ -0,0 +1,168 @@
+# encoding: utf-8
+"""
+Consolidated storage of the downloaded magnet strengths.
+
+Instead of one small MAD-X file per MEFI setting, the values of all
+settings are kept in a single ``.npz`` file containing
+
+- ``params``: the parameter names (n_params,)
+- ``mefis``: the MEFI settings (n_mefis, 5), sorted
+- ``values``: float64 matrix (n_mefis, n_params), NaN where a parameter
+  was not available for a setting
+
+Existing ``params/`` folders can be imported with:
+
+    strength_store.py <PARAMS_FOLDER> <STORE_FILE>
+
+Settings that are already in the store are replaced by the imported ones.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import re
+import sys
+import tempfile
+
+import numpy as np
+
+from results_store import replace_file
+
+
+_STRENGTH_FILE = re.compile(r'^M(\d+)-E(\d+)-F(\d+)-I(\d+)-G(\d+)\.str$')
+
+
+class StrengthStore(object):
+
+    """
+    Dense matrix of the parameter values of many MEFI settings.
+
+    :param params: parameter names
+    :param mefis: MEFI tuples, one per row of ``values``
+    :param values: array of shape (len(mefis), len(params))
+    """
+
+    def __init__(self, params=(), mefis=(), values=None):
+        self.params = [str(p) for p in params]
+        self.mefis = [tuple(int(x) for x in mefi) for mefi in mefis]
+        if values is None:
+            values = np.zeros((len(self.mefis), len(self.params)))
+        self.values = np.asarray(values, dtype=float)
+        self._index = {mefi: i for i, mefi in enumerate(self.mefis)}
+
+    def __contains__(self, mefi):
+        return tuple(mefi) in self._index
+
+    def __len__(self):
+        return len(self.mefis)
+
+    def get(self, mefi):
+        """
+        Return the assignments for a MEFI setting as list of ``(name,
+        value)`` pairs, skipping unavailable parameters.
+        """
+        row = self.values[self._index[tuple(mefi)]]
+        return [(name, float(value))
+                for name, value in zip(self.params, row)
+                if not np.isnan(value)]
+
+    def merge(self, rows):
+        """
+        Return a new store with the settings ``{mefi: [(name, value)]}``
+        added. Existing settings are replaced.
+        """
+        params = list(self.params)
+        known = set(params)
+        for assignments in rows.values():
+            for name, _ in assignments:
+                if name not in known:
+                    known.add(name)
+                    params.append(name)
+        col = {name: j for j, name in enumerate(params)}
+        mefis = sorted(set(self.mefis) | set(map(tuple, rows)))
+        values = np.full((len(mefis), len(params)), np.nan)
+        row = {mefi: i for i, mefi in enumerate(mefis)}
+        if self.mefis:
+            keep = [row[mefi] for mefi in self.mefis]
+            values[np.ix_(keep, range(len(self.params)))] = self.values
+        for mefi, assignments in rows.items():
+            i = row[tuple(mefi)]
+            values[i] = np.nan
+            for name, value in assignments:
+                values[i, col[name]] = value
+        return StrengthStore(params, mefis, values)
+
+
+def load_store(filename):
+    """Load a strength store, returns an empty store if the file is missing."""
+    if not os.path.exists(filename):
+        return StrengthStore()
+    with np.load(filename) as data:
+        return StrengthStore(data['params'].tolist(),
+                             data['mefis'].reshape((-1, 5)).tolist(),
+                             data['values'])
+
+
+def save_store(filename, store):
+    """Atomically write the store to a ``.npz`` file."""
+    folder = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f,
+                 params=np.array(store.params, dtype='U'),
+                 mefis=np.array(store.mefis, dtype='i4').reshape((-1, 5)),
+                 values=store.values)
+    replace_file(tmp, filename)
+
+
+def append_strengths(filename, rows):
+    """
+    Add the settings ``{mefi: [(name, value)]}`` to the store file.
+    Existing settings are replaced.
+    """
+    store = load_store(filename).merge(rows)
+    save_store(filename, store)
+    return store
+
+
+def read_strengths(filename):
+    """
+    Read the ``name = value;`` assignments from a strength file as written
+    by ``download_settings.py``. Returns a list of ``(name, value)`` pairs in
+    file order, where value is the (unevaluated) right hand side.
+    """
+    with open(filename) as f:
+        return re.findall(r'^\s*(\w+)\s*:?=\s*([^;]*?)\s*;', f.read(), re.M)
+
+
+def read_params_folder(folder):
+    """
+    Read all strength files ``M*-E*-F*-I*-G*.str`` in a folder.
+
+    :returns: ``{mefi: [(name, value)]}``
+    :raises ValueError: if a file contains non-numeric assignments
+    """
+    rows = {}
+    for basename in sorted(os.listdir(folder)):
+        match = _STRENGTH_FILE.match(basename)
+        if match:
+            mefi = tuple(map(int, match.groups()))
+            filename = os.path.join(folder, basename)
+            try:
+                rows[mefi] = [(name, float(value)) for name, value in
+                              read_strengths(filename)]
+            except ValueError as e:
+                raise ValueError("{}: {}".format(filename, e))
+    return rows
+
+
+def main(params_folder='params', store_file='strengths.npz'):
+    rows = read_params_folder(params_folder)
+    store = append_strengths(store_file, rows)
+    print("Imported {} settings, {} settings and {} parameters in store"
+          .format(len(rows), len(store), len(store.params)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,135 @@
+# encoding: utf-8
+"""
+Quick-look approximation of the sectormaps by interpolation in energy.
+
+For every group of MEFI settings that differ only in the energy channel,
+the exact sectormaps are computed only for a sparse subset of the energies
+(nodes). The matrix elements for the remaining energies are interpolated
+with piecewise cubic Hermite polynomials. In every group, one of the
+remaining energies (in the middle of the largest gap between nodes) is
+computed exactly as well, to report the interpolation error.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from linear_optics import max_deviation
+
+
+def hermite_interpolate(x, y, xi):
+    """
+    Interpolate with piecewise cubic Hermite polynomials, using the centered
+    finite differences of the neighbouring nodes as slopes (one-sided at the
+    boundaries). Falls back to linear interpolation for two nodes and to a
+    constant for a single node. Values outside the range of the nodes are
+    extrapolated from the first/last interval.
+
+    :param x: sorted node positions (n,)
+    :param y: values at the nodes (n, ...)
+    :param xi: positions to interpolate (m,)
+    :returns: interpolated values (m, ...)
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    xi = np.asarray(xi, dtype=float)
+    if len(x) == 1:
+        return np.repeat(y, len(xi), axis=0)
+    extra = (1,) * (y.ndim - 1)
+    h = np.diff(x).reshape((-1,) + extra)
+    delta = np.diff(y, axis=0) / h
+    slope = np.empty_like(y)
+    slope[0] = delta[0]
+    slope[-1] = delta[-1]
+    slope[1:-1] = (delta[:-1] + delta[1:]) / 2
+    k = np.clip(np.searchsorted(x, xi, side='right') - 1, 0, len(x) - 2)
+    h = h[k]
+    t = ((xi - x[k]) / h.reshape(-1)).reshape((-1,) + extra)
+    h00 = (1 + 2*t) * (1 - t)**2
+    h10 = t * (1 - t)**2
+    h01 = t**2 * (3 - 2*t)
+    h11 = t**2 * (t - 1)
+    return (h00 * y[k] + h10 * h * slope[k] +
+            h01 * y[k+1] + h11 * h * slope[k+1])
+
+
+def energy_groups(mefis):
+    """
+    Group MEFI settings by everything except the energy channel.
+
+    :returns: ``{(vacc, focus, intensity, gantry): [mefi]}``, sorted by
+              energy
+    """
+    groups = {}
+    for mefi in sorted(mefis, key=lambda m: m[1]):
+        key = (mefi[0],) + tuple(mefi[2:])
+        groups.setdefault(key, []).append(mefi)
+    return groups
+
+
+def select_nodes(mefis, step):
+    """
+    Select every ``step``-th setting (and the last) of a group sorted by
+    energy as node, and the setting in the middle of the largest gap
+    between nodes for checking.
+
+    :returns: ``(nodes, check)``, where check may be ``None``
+    """
+    nodes = mefis[::step]
+    if nodes[-1] != mefis[-1]:
+        nodes.append(mefis[-1])
+    pos = [mefis.index(m) for m in nodes]
+    gaps = [(b - a, a, b) for a, b in zip(pos, pos[1:]) if b - a > 1]
+    if not gaps:
+        return nodes, None
+    _, a, b = max(gaps)
+    return nodes, mefis[(a + b) // 2]
+
+
+def surrogate_sectormaps(mefis, compute, step):
+    """
+    Approximate the sectormaps by interpolation in energy.
+
+    :param list mefis: MEFI settings
+    :param compute: function returning the list of exact sectormaps for a
+                    list of MEFI settings
+    :param int step: compute every ``step``-th energy of a group exactly
+    :returns: ``(sectormaps, exact)``, the list of (approximate) sectormaps
+              in the same order as ``mefis``, and ``{mefi: sectormaps}``
+              of the exactly computed settings
+    :raises ValueError: if ``step`` is less than 2
+    """
+    if step < 2:
+        raise ValueError("step must be at least 2: {}".format(step))
+    groups = energy_groups(mefis)
+    selected = {key: select_nodes(group, step)
+                for key, group in groups.items()}
+    required = sorted(set(
+        m for nodes, check in selected.values()
+        for m in nodes + [check] if m is not None))
+    exact = dict(zip(required, compute(required)))
+
+    result = dict(exact)
+    errors = []
+    for key, group in groups.items():
+        nodes, check = selected[key]
+        x = [m[1] for m in nodes]
+        y = [exact[m] for m in nodes]
+        todo = [m for m in group if m not in exact]
+        if check is not None:
+            todo.append(check)
+        if not todo:
+            continue
+        values = hermite_interpolate(x, y, [m[1] for m in todo])
+        if check is not None:
+            errors.append(max_deviation(values[-1], exact[check]))
+            todo, values = todo[:-1], values[:-1]
+        result.update(zip(todo, values))
+    print("Interpolated {} of {} sectormaps, max error at {} held-out"
+          " energies: {}".format(
+              len(mefis) - len(set(mefis) & set(exact)), len(mefis),
+              len(errors),
+              '{:.2g}'.format(max(errors)) if errors else 'n/a'))
+    return [result[m] for m in mefis], exact